@@ -1,8 +1,35 @@
 #!/usr/bin/env python3
 import multiprocessing
+import os
 
 workers = multiprocessing.cpu_count() * 2 + 1
 worker_class = 'uvicorn.workers.UvicornWorker'
 loglevel = 'error'
 pidfile = 'gunicorn.pid'
-reload = True
+
+# With GPH_PRELOAD=1, the master process loads the site and warms up its
+# caches (see puzzles/warmup.py) once, then forks workers that start
+# immediately and share that memory. Workers that are restarted mid-hunt come
+# back instantly too. Code changes then need a full restart rather than a
+# reload, since the master process has the old code loaded.
+preload_app = os.environ.get('GPH_PRELOAD') == '1'
+reload = not preload_app
+
+
+def when_ready(server):
+    if preload_app:
+        from puzzles.warmup import warm_up
+        warm_up()
+
+
+def pre_fork(server, worker):
+    if preload_app:
+        # Don't hand the master's connections down to workers, or anything
+        # still waiting to be logged.
+        from django.core.cache import caches
+        from django.db import connections
+        from gph.logutils import flush_all
+        connections.close_all()
+        for cache in caches.all():
+            cache.close()
+        flush_all()
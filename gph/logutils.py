@@ -0,0 +1,206 @@
+# Logging that stays out of the way of requests. A QueuedHandler formats a
+# record and puts it on a queue; a thread in each process hands the queue to
+# its target handler, only flushing when it runs dry, so a burst of records is
+# written in one go. QueuedRotatingFileHandler writes to files rotated by
+# size. The filters let busy call sites log only a sample of their records, or
+# at most so many per second.
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where the dev server only runs one process anyway.
+    fcntl = None
+
+
+# Targets for QueuedHandler write without flushing, leaving that to
+# flush_buffer.
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def flush(self):
+        pass
+
+    def flush_buffer(self):
+        super().flush()
+
+    def follow_rotation(self):
+        '''
+        If another process has rotated the file out from under us, starts on
+        the new file and returns True.
+        '''
+        if self.stream is not None:
+            try:
+                if os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino:
+                    self.stream.close()
+                    self.stream = self._open()
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def shouldRollover(self, record):
+        if self.follow_rotation():
+            return False
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        # Each process has its own handler on the same file, so several may
+        # decide to rotate it at once. They take turns, and once it's our
+        # turn, we only rotate if nobody else has in the meantime; otherwise
+        # backups would be shifted twice and one of them lost.
+        with open(self.baseFilename + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if not self.follow_rotation():
+                super().doRollover()
+
+    def close(self):
+        self.flush_buffer()
+        super().close()
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            # Caught up, so it's time to write out everything so far.
+            for handler in self.handlers:
+                handler.flush_buffer()
+            return self.queue.get(block)
+
+
+class QueuedHandler(logging.handlers.QueueHandler):
+    '''
+    Hands records to target from a background thread. The handler's formatter
+    is applied before queueing.
+    '''
+
+    def __init__(self, target):
+        super().__init__(queue.Queue())
+        self.target = target
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        _handlers.append(self)
+
+    def start(self):
+        # Threads don't survive forking, so each process needs its own.
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.listener = BatchingQueueListener(self.queue, self.target)
+                self.listener.start()
+                self.pid = os.getpid()
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        super().emit(record)
+
+    def flush(self):
+        '''Waits until everything queued so far is on disk.'''
+        if self.pid == os.getpid():
+            self.queue.join()
+        self.target.flush_buffer()
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+        if self in _handlers:
+            _handlers.remove(self)
+        self.target.close()
+        super().close()
+
+
+class QueuedRotatingFileHandler(QueuedHandler):
+    '''
+    Use in place of logging.FileHandler, with the same filename argument plus
+    RotatingFileHandler's maxBytes and backupCount.
+    '''
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, encoding=None):
+        super().__init__(BufferedRotatingFileHandler(
+            filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding, delay=True))
+        self.filename = filename
+
+
+_handlers = []
+
+def flush_all():
+    '''Flushes every queued handler; call before forking.'''
+    for handler in _handlers:
+        handler.flush()
+
+# logging.shutdown flushes handlers before closing them, but only the ones
+# still referenced by the logging config.
+atexit.register(flush_all)
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Lets a record through with the probability given by its `sample`
+    attribute, like logger.info(..., extra={'sample': 0.01}), or `rate` if it
+    has none. Records above max_level always get through.
+    '''
+
+    def __init__(self, rate=1.0, max_level=logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.max_level = max_level
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        return random.random() < getattr(record, 'sample', self.rate)
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Lets through at most `burst` records at a time from each line of code,
+    refilling at `per_second`. Records above max_level always get through.
+    The next record let through from a line has how many were dropped in
+    between as its `dropped` attribute, for DroppedCountFormatter.
+    '''
+
+    def __init__(self, per_second=10, burst=None, max_level=logging.INFO):
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst or per_second
+        self.max_level = max_level
+        self.lock = threading.Lock()
+        self.sites = {}
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        site = (record.pathname, record.lineno)
+        with self.lock:
+            now = time.monotonic()
+            (tokens, last, dropped) = self.sites.get(site, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.per_second)
+            if tokens < 1:
+                self.sites[site] = (tokens, now, dropped + 1)
+                return False
+            self.sites[site] = (tokens - 1, now, 0)
+        # Other handlers see this record too, so leave its message alone.
+        record.dropped = dropped
+        return True
+
+
+class DroppedCountFormatter(logging.Formatter):
+    '''Adds how many similar records RateLimitFilter dropped, if any.'''
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        dropped = getattr(record, 'dropped', 0)
+        if dropped:
+            message = '{} ({} similar records dropped)'.format(message, dropped)
+        return message
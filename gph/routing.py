@@ -1,8 +1,9 @@
 from django.urls import re_path
 
-from puzzles.messaging import TeamNotificationsConsumer, HintsConsumer
+from puzzles.messaging import TeamNotificationsConsumer, HintsConsumer, BigboardConsumer
 
 websocket_urlpatterns = [
     re_path('^ws/team$', TeamNotificationsConsumer.as_asgi()),
     re_path('^ws/hints$', HintsConsumer.as_asgi()),
+    re_path('^ws/bigboard$', BigboardConsumer.as_asgi()),
 ]
@@ -30,6 +30,10 @@ RECAPTCHA_SITEKEY = None
 RECAPTCHA_SECRETKEY = None
 RECAPTCHA_SCORE_THRESHOLD = 0
 
+# Lets Prometheus scrape /bridge/metrics with "Authorization: Bearer <token>"
+# instead of an admin login.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = False
 
@@ -53,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'puzzles.metrics.metrics_middleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -188,6 +193,11 @@ EMAIL_SUBJECT_PREFIX = '[FDUPH] '
 #     'formatter': 'django',
 # },
 
+# Log files are written from a background thread in each process (see
+# gph/logutils.py), and rotated when they reach this size.
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -196,34 +206,62 @@ LOGGING = {
             'format': '%(asctime)s (PID %(process)d) [%(levelname)s] %(module)s\n%(message)s'
         },
         'puzzles': {
-            'format': '%(asctime)s (PID %(process)d) [%(levelname)s] %(name)s %(message)s'
+            '()': 'gph.logutils.DroppedCountFormatter',
+            'fmt': '%(asctime)s (PID %(process)d) [%(levelname)s] %(name)s %(message)s'
         },
     },
     # FIXME you may want to change the filenames to something like
     # /srv/logs/django.log or similar
+    'filters': {
+        # Busy code can log with extra={'sample': 0.01} to keep 1% of records.
+        'sampled': {
+            '()': 'gph.logutils.SampleFilter',
+        },
+        # At most 10 INFO (or DEBUG) records a second from any one line of
+        # code; warnings and errors always get through.
+        'hot_path': {
+            '()': 'gph.logutils.RateLimitFilter',
+            'per_second': 10,
+        },
+    },
     'handlers': {
         'django': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'django.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
             'formatter': 'django',
         },
         'general': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'general.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
+            'filters': ['sampled', 'hot_path'],
             'formatter': 'puzzles',
         },
         'puzzle': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'puzzle.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
             'formatter': 'puzzles',
         },
+        # The same entries, in a database for the viewer at /bridge/puzzle-log.
+        'puzzle-store': {
+            'level': 'INFO',
+            'class': 'puzzles.puzzlelog.QueuedPuzzleLogHandler',
+            'filename': os.path.join(LOGS_DIR, 'puzzle.sqlite3'),
+        },
         'request': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'request.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
             'formatter': 'puzzles',
         },
     },
@@ -239,7 +277,7 @@ LOGGING = {
             'propagate': True,
         },
         'puzzles.puzzle': {
-            'handlers': ['puzzle'],
+            'handlers': ['puzzle', 'puzzle-store'],
             'level': 'INFO',
             'propagate': False,
         },
@@ -32,7 +32,8 @@ LOGGING = {
             'format': '%(asctime)s (PID %(process)d) [%(levelname)s] %(module)s\n%(message)s'
         },
         'puzzles-file': {
-            'format': '%(asctime)s (PID %(process)d) [%(levelname)s] %(name)s %(message)s'
+            '()': 'gph.logutils.DroppedCountFormatter',
+            'fmt': '%(asctime)s (PID %(process)d) [%(levelname)s] %(name)s %(message)s'
         },
         'django-console': {
             'format': '\033[34;1m%(asctime)s \033[35;1m[%(levelname)s] \033[34;1m%(module)s\033[0m\n%(message)s'
@@ -41,29 +42,56 @@ LOGGING = {
             'format': '\033[36;1m%(asctime)s \033[35;1m[%(levelname)s] \033[36;1m%(name)s\033[0m %(message)s'
         },
     },
+    'filters': {
+        # Busy code can log with extra={'sample': 0.01} to keep 1% of records.
+        'sampled': {
+            '()': 'gph.logutils.SampleFilter',
+        },
+        # At most 10 INFO (or DEBUG) records a second from any one line of
+        # code; warnings and errors always get through.
+        'hot_path': {
+            '()': 'gph.logutils.RateLimitFilter',
+            'per_second': 10,
+        },
+    },
     'handlers': {
         'django': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'django.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
             'formatter': 'django-file',
         },
         'general': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'general.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
+            'filters': ['sampled', 'hot_path'],
             'formatter': 'puzzles-file',
         },
         'puzzle': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'puzzle.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
             'formatter': 'puzzles-file',
         },
+        # The same entries, in a database for the viewer at /bridge/puzzle-log.
+        'puzzle-store': {
+            'level': 'INFO',
+            'class': 'puzzles.puzzlelog.QueuedPuzzleLogHandler',
+            'filename': os.path.join(LOGS_DIR, 'puzzle.sqlite3'),
+        },
         'request': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
+            'class': 'gph.logutils.QueuedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'request.log'),
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
             'formatter': 'puzzles-file',
         },
         'django-console': {
@@ -103,7 +131,7 @@ LOGGING = {
             'propagate': True,
         },
         'puzzles.puzzle': {
-            'handlers': ['puzzle', 'puzzles-console'],
+            'handlers': ['puzzle', 'puzzle-store', 'puzzles-console'],
             'level': 'INFO',
             'propagate': False,
         },
@@ -96,6 +96,7 @@ urlpatterns = [
     #     name='interactive_demo_submit'),
     path('puzzle/r2q8/submit', puzzlehandlers.r2q8_submit, name='r2q8'),
     path('puzzle/r3q3/submit', puzzlehandlers.r3q3_submit, name='r3q3'),
+    path('puzzle/r3q3/history', puzzlehandlers.r3q3_history, name='r3q3-history'),
 
     path('story', views.story, name='story'),
     path('victory', views.victory, name='victory'),
@@ -109,7 +110,10 @@ urlpatterns = [
     path('biggraph', views.biggraph, name='biggraph'),
     path('bridge/guess.csv', views.guess_csv, name='guess-csv'),
     path('bridge/hint.csv', views.hint_csv, name='hint-csv'),
-    path('bridge/puzzle.log', views.puzzle_log, name='puzzle-log'),
+    path('bridge/unlock.csv', views.unlock_csv, name='unlock-csv'),
+    path('bridge/survey.csv', views.survey_csv, name='survey-csv'),
+    path('bridge/puzzle-log', views.puzzle_log, name='puzzle-log'),
+    path('bridge/metrics', views.metrics, name='metrics'),
     path('shortcuts', views.shortcuts, name='shortcuts'),
     path('robots.txt', views.robots),
     # see https://docs.djangoproject.com/en/4.0/topics/i18n/translation/#note-on-performance
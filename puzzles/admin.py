@@ -10,6 +10,7 @@ from puzzles.models import (
     PuzzleUnlock,
     AnswerSubmission,
     ExtraGuessGrant,
+    PuzzleGameState,
     PuzzleMessage,
     Erratum,
     Survey,
@@ -61,6 +62,11 @@ class TeamAdmin(admin.ModelAdmin):
     search_fields = ('team_name',)
     readonly_fields = ('id',)
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Offsets and time unlock settings change what the team can see.
+        Team.expire_unlocks([obj.id])
+
 class PuzzleUnlockAdmin(admin.ModelAdmin):
     list_display = ('team', 'puzzle', 'unlock_datetime')
     list_filter = ('puzzle', 'puzzle__round', 'team')
@@ -74,6 +80,11 @@ class ExtraGuessGrantAdmin(admin.ModelAdmin):
     list_display = ('team', 'puzzle', 'extra_guesses')
     list_filter = ('puzzle', 'puzzle__round', 'team')
 
+class PuzzleGameStateAdmin(admin.ModelAdmin):
+    list_display = ('team', 'puzzle', 'schema_version', 'modified_time')
+    list_filter = ('puzzle', 'schema_version')
+    search_fields = ('team__team_name',)
+
 class ErratumAdmin(admin.ModelAdmin):
     list_display = ('puzzle', 'timestamp', 'published')
     list_filter = ('puzzle', 'puzzle__round', 'published')
@@ -99,6 +110,7 @@ admin.site.register(TeamMember, TeamMemberAdmin)
 admin.site.register(PuzzleUnlock, PuzzleUnlockAdmin)
 admin.site.register(AnswerSubmission, AnswerSubmissionAdmin)
 admin.site.register(ExtraGuessGrant, ExtraGuessGrantAdmin)
+admin.site.register(PuzzleGameState, PuzzleGameStateAdmin)
 admin.site.register(Erratum, ErratumAdmin)
 admin.site.register(Survey, SurveyAdmin)
 admin.site.register(Hint, HintAdmin)
@@ -0,0 +1,182 @@
+# The big board is a teams x puzzles matrix of everybody's progress, which is
+# by far the most expensive thing on the site to compute. Instead of doing it
+# on every page load, we build a snapshot of it that's shared through the
+# cache, either whenever it's older than SNAPSHOT_TIMEOUT or continuously from
+# `./manage.py refresh_bigboard`. Open boards then keep themselves current
+# with small deltas pushed over the 'bigboard' websocket as submissions, hints
+# and unlocks happen (see send_bigboard_delta in messaging.py and
+# static/js/bigboard.js).
+import datetime
+import logging
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from puzzles import stats as stats_service
+from puzzles.catalog import get_catalog
+from puzzles.hunt_config import HUNT_END_TIME, META_META_SLUG
+from puzzles.models import AnswerSubmission, PuzzleUnlock, Team
+
+logger = logging.getLogger(__name__)
+
+# If nothing is refreshing the snapshot in the background, a page load
+# rebuilds it once it's this old (in seconds).
+SNAPSHOT_TIMEOUT = 60
+
+
+def snapshot_key(hide_hidden):
+    return 'bigboard:%d' % hide_hidden
+
+
+def build_snapshot(hide_hidden):
+    '''
+    Computes the whole board. Each team row's cells are tuples of (solve
+    position, wrong guesses, hints, CSS classes), in catalog puzzle order, and
+    each puzzle's column summary is a tuple of (solves, free answers, guesses,
+    unlocks, hints).
+    '''
+    puzzles = get_catalog().puzzles
+    puzzle_metas = {}
+    meta_meta_id = None
+    for puzzle in puzzles:
+        if puzzle.slug == META_META_SLUG:
+            meta_meta_id = puzzle.id
+        if not puzzle.is_meta:
+            puzzle_metas[puzzle.id] = puzzle.round.meta_id
+
+    wrong_guesses_map = defaultdict(int) # key (team, puzzle)
+    wrong_guesses_by_team_map = defaultdict(int) # key team
+    solve_position_map = dict() # key (team, puzzle); value n if team is nth to solve this puzzle
+    solve_count_map = defaultdict(int) # puzzle -> number of counts
+    total_guess_map = defaultdict(int) # puzzle -> number of guesses
+    used_hints_map = defaultdict(int) # (team, puzzle) -> number of hints
+    used_hints_by_team_map = defaultdict(int) # team -> number of hints
+    used_hints_by_puzzle_map = defaultdict(int) # puzzle -> number of hints
+    meta_solves_map = defaultdict(int) # team -> number of meta solves
+    solve_time_map = defaultdict(dict) # team -> {puzzle id -> solve time}
+    during_hunt_solve_time_map = defaultdict(dict) # team -> {puzzle id -> solve time}
+    free_answer_map = defaultdict(set) # team -> {puzzle id}
+    free_answer_by_puzzle_map = defaultdict(int) # puzzle -> number of free answers
+
+    correct_q = Q(is_correct=True)
+    if hide_hidden:
+        correct_q &= Q(team__is_hidden=False)
+
+    for team_id, puzzle_id, used_free_answer, submitted_datetime in (
+        AnswerSubmission.objects
+        .filter(correct_q)
+        .order_by('submitted_datetime')
+        .values_list('team_id', 'puzzle_id', 'used_free_answer', 'submitted_datetime')
+    ):
+        total_guess_map[puzzle_id] += 1
+        if used_free_answer:
+            free_answer_map[team_id].add(puzzle_id)
+            free_answer_by_puzzle_map[puzzle_id] += 1
+        else:
+            solve_count_map[puzzle_id] += 1
+            solve_position_map[(team_id, puzzle_id)] = solve_count_map[puzzle_id]
+            solve_time_map[team_id][puzzle_id] = submitted_datetime
+            if submitted_datetime < HUNT_END_TIME:
+                during_hunt_solve_time_map[team_id][puzzle_id] = submitted_datetime
+        if puzzle_id not in puzzle_metas:
+            meta_solves_map[team_id] += 1
+
+    for (team_id, puzzle_id), count in stats_service.wrong_guess_counts(hide_hidden, refresh=True).items():
+        total_guess_map[puzzle_id] += count
+        wrong_guesses_map[(team_id, puzzle_id)] += count
+        wrong_guesses_by_team_map[team_id] += count
+
+    for (team_id, puzzle_id), count in stats_service.answered_hint_counts(refresh=True).items():
+        used_hints_map[(team_id, puzzle_id)] += count
+        used_hints_by_team_map[team_id] += count
+        used_hints_by_puzzle_map[puzzle_id] += count
+
+    if hide_hidden:
+        teams = Team.objects.filter(is_hidden=False)
+    else:
+        teams = Team.objects.all()
+
+    # Reproduce Team.leaderboard behavior for ignoring solves after hunt end,
+    # but not _teams_ created after hunt end. They'll just all be at the bottom.
+    leaderboard = sorted(teams, key=lambda team: (
+        during_hunt_solve_time_map[team.id].get(meta_meta_id, HUNT_END_TIME),
+        -len(during_hunt_solve_time_map[team.id]),
+        team.last_solve_time or team.creation_time,
+    ))
+    unlocks = set(PuzzleUnlock.objects.values_list('team_id', 'puzzle_id'))
+    unlock_count_map = defaultdict(int)
+
+    def classes_of(team_id, puzzle_id):
+        unlocked = (team_id, puzzle_id) in unlocks
+        if unlocked:
+            unlock_count_map[puzzle_id] += 1
+        solve_time = solve_time_map[team_id].get(puzzle_id)
+        if puzzle_id in free_answer_map[team_id]:
+            yield 'F' # free answer
+        elif solve_time:
+            yield 'S' # solved
+        elif wrong_guesses_map.get((team_id, puzzle_id)):
+            yield 'W' # wrong
+        elif unlocked:
+            yield 'U' # unlocked
+        if used_hints_map.get((team_id, puzzle_id)):
+            yield 'H' # hinted
+        if solve_time and solve_time > HUNT_END_TIME:
+            yield 'P' # post-hunt solve
+        if solve_time and puzzle_id in puzzle_metas:
+            meta_time = solve_time_map[team_id].get(puzzle_metas[puzzle_id])
+            if meta_time and solve_time > meta_time - datetime.timedelta(minutes=5):
+                yield 'B' # backsolved
+
+    board = []
+    for team in leaderboard:
+        board.append({
+            'team': {
+                'id': team.id,
+                'team_name': team.team_name,
+                'num_hints_total': team.num_hints_total,
+            },
+            'last_solve_time': max([team.creation_time, *solve_time_map[team.id].values()]),
+            'total_solves': len(solve_time_map[team.id]),
+            'free_solves': len(free_answer_map[team.id]),
+            'wrong_guesses': wrong_guesses_by_team_map[team.id],
+            'used_hints': used_hints_by_team_map[team.id],
+            'finished': solve_position_map.get((team.id, meta_meta_id)),
+            'meta_solves': meta_solves_map[team.id],
+            'cells': [(
+                solve_position_map.get((team.id, puzzle.id)),
+                wrong_guesses_map[(team.id, puzzle.id)],
+                used_hints_map[(team.id, puzzle.id)],
+                ' '.join(classes_of(team.id, puzzle.id)),
+            ) for puzzle in puzzles],
+        })
+
+    return {
+        'built': timezone.now(),
+        'puzzle_ids': [puzzle.id for puzzle in puzzles],
+        'puzzle_totals': [(
+            solve_count_map[puzzle.id],
+            free_answer_by_puzzle_map[puzzle.id],
+            total_guess_map[puzzle.id],
+            unlock_count_map[puzzle.id],
+            used_hints_by_puzzle_map[puzzle.id],
+        ) for puzzle in puzzles],
+        'board': board,
+    }
+
+
+def refresh_snapshot(hide_hidden, timeout=SNAPSHOT_TIMEOUT):
+    snapshot = build_snapshot(hide_hidden)
+    cache.set(snapshot_key(hide_hidden), snapshot, timeout)
+    return snapshot
+
+
+def get_snapshot(hide_hidden):
+    snapshot = cache.get(snapshot_key(hide_hidden))
+    if snapshot is None or snapshot['puzzle_ids'] != [p.id for p in get_catalog().puzzles]:
+        logger.debug('Rebuilding bigboard snapshot (hide_hidden=%s)', hide_hidden)
+        snapshot = refresh_snapshot(hide_hidden)
+    return snapshot
+
@@ -0,0 +1,98 @@
+# The puzzle catalog (rounds, puzzles and their messages) is read on nearly
+# every request but only changes when someone edits it in /admin. So we keep
+# it in the shared cache, plus a copy in each process, both labeled with a
+# version token that lives in the shared cache. Saving or deleting any of
+# those objects replaces the token (see the receivers in models.py), and each
+# process notices the next time it looks and reloads the catalog, so outside
+# of that the catalog costs one cache read per request and no queries.
+import logging
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = 'catalog:version'
+# Old catalogs are never read again once the version changes, so let them
+# expire eventually rather than keeping them around forever.
+CATALOG_TIMEOUT = 60 * 60 * 24
+
+_lock = threading.Lock()
+_local_catalog = None
+
+
+class Catalog:
+    '''
+    An immutable snapshot of the rounds and puzzles. Treat the objects in it as
+    read-only, since they're shared between all requests in this process.
+    '''
+
+    def __init__(self, version, puzzles):
+        self.version = version
+        # Each puzzle's round is loaded, and puzzle.puzzlemessage_set.all()
+        # doesn't hit the database.
+        self.puzzles = tuple(puzzles)
+        self.puzzles_by_slug = {puzzle.slug: puzzle for puzzle in self.puzzles}
+        self.puzzles_by_id = {puzzle.id: puzzle for puzzle in self.puzzles}
+        self.rounds_by_slug = {puzzle.round.slug: puzzle.round for puzzle in self.puzzles}
+        # puzzle id -> semicleaned guess -> messages, so that checking a guess
+        # for keep-going messages doesn't normalize every message again.
+        self.messages_by_guess = {}
+        for puzzle in self.puzzles:
+            messages = self.messages_by_guess[puzzle.id] = {}
+            for message in puzzle.puzzlemessage_set.all():
+                messages.setdefault(message.semicleaned_guess, []).append(message)
+
+    def puzzle_messages(self, puzzle, semicleaned_guess):
+        return self.messages_by_guess.get(puzzle.id, {}).get(semicleaned_guess, [])
+
+
+def load_catalog(version):
+    from puzzles.models import Puzzle
+    return Catalog(version, (
+        Puzzle.objects
+        .select_related('round')
+        .prefetch_related('puzzlemessage_set')
+        .order_by('round__order', 'order')
+    ))
+
+
+def current_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Nobody has set one since the cache was last cleared. If several
+        # processes race here, whoever gets there first wins.
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_catalog():
+    global _local_catalog
+    version = current_version()
+    catalog = _local_catalog
+    if catalog is not None and catalog.version == version:
+        return catalog
+    with _lock:
+        catalog = _local_catalog
+        if catalog is not None and catalog.version == version:
+            return catalog
+        key = 'catalog:{}'.format(version)
+        catalog = cache.get(key)
+        if catalog is None:
+            logger.debug('Loading puzzle catalog %s', version)
+            catalog = load_catalog(version)
+            cache.set(key, catalog, CATALOG_TIMEOUT)
+        _local_catalog = catalog
+        return catalog
+
+
+def invalidate():
+    '''Make every process reload the catalog the next time it's used.'''
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+    # If we're in a transaction (e.g. an admin save), some other process
+    # might load the old data between now and the commit. Bump the version
+    # again once it's committed so nobody keeps that around.
+    transaction.on_commit(lambda: cache.set(VERSION_KEY, uuid.uuid4().hex, None))
@@ -14,7 +14,7 @@ from django.utils import timezone
 
 from puzzles import hunt_config
 from puzzles.hunt_config import HUNT_START_TIME, HUNT_END_TIME, HUNT_CLOSE_TIME, META_META_SLUG
-from puzzles import models
+from puzzles import catalog, metrics, models
 from puzzles.shortcuts import get_shortcuts
 
 
@@ -33,13 +33,17 @@ def context_processor(request):
 
 # Construct a get/set property from a name and a function to compute a value.
 # Doing this with name="foo" causes accesses to self.foo to call fn and cache
-# the result.
+# the result. Hits and misses are counted for metrics.py.
 def wrap_cacheable(name, fn):
+    qualname = fn.__qualname__
     def fget(self):
         if not hasattr(self, '_cache'):
             self._cache = {}
         if name not in self._cache:
+            metrics.count_cache(qualname, False)
             self._cache[name] = fn(self)
+        else:
+            metrics.count_cache(qualname, True)
         return self._cache[name]
     def fset(self, value):
         if not hasattr(self, '_cache'):
@@ -145,7 +149,16 @@ class Context:
         return self.request_user.is_superuser
 
     def team(self):
-        return getattr(self.request_user, 'team', None)
+        if not self.request_user.is_authenticated:
+            return None
+        # The old game state fields can be big, and only PuzzleGameState
+        # reads them.
+        return (
+            models.Team.objects
+            .defer(*models.PuzzleGameState.LEGACY_FIELDS)
+            .filter(user=self.request_user)
+            .first()
+        )
 
     def shortcuts(self):
         return tuple(get_shortcuts(self))
@@ -159,8 +172,11 @@ class Context:
     def unlocks(self):
         return models.Team.compute_unlocks(self)
 
+    def catalog(self):
+        return catalog.get_catalog()
+
     def all_puzzles(self):
-        return tuple(models.Puzzle.objects.select_related('round').order_by('round__order', 'order'))
+        return self.catalog.puzzles
 
     def unclaimed_hints(self):
         return models.Hint.objects.filter(status=models.Hint.NO_RESPONSE, claimer='').count()
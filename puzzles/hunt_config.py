@@ -32,6 +32,8 @@ HUNT_CLOSE_TIME = settings.HUNT_CLOSE_TIME
 
 MAX_GUESSES_PER_PUZZLE = 20
 MAX_MEMBERS_PER_TEAM = 6
+# Number of teams shown on each page of the public team list.
+TEAMS_PER_PAGE = 100
 
 # If this is disabled, teams will not get any hints.
 HINTS_ENABLED = True
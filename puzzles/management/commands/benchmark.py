@@ -0,0 +1,222 @@
+# Times the functions that run on most requests, so optimizations can be
+# measured. Each benchmark runs in a scratch database filled by
+# generate_scale_hunt with a fixed seed, so runs on the same machine see the
+# same data, and is timed like timeit does: with garbage collection off, in
+# loops long enough to time accurately, keeping the best of several repeats.
+#
+# `--save` stores the results as the baseline, and later runs compare against
+# it and fail if anything got slower by more than --threshold. Timings depend
+# on the machine, so baselines aren't checked in; save one on your machine
+# before starting on an optimization.
+import json
+import os
+import platform
+import random
+import statistics
+import timeit
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.template import Context as TemplateContext, Engine
+from django.test import RequestFactory, override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from puzzles import views
+from puzzles.context import Context
+from puzzles.management.commands import generate_scale_hunt
+from puzzles.models import AnswerSubmission, Puzzle, Team
+from puzzles.puzzlehandlers import r2q8, r3q3
+
+BASELINE = os.path.join(settings.BASE_DIR, 'benchmark_baseline.json')
+
+# name -> function(team, admin) returning the function to time
+BENCHMARKS = {}
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def make_request(user):
+    request = RequestFactory().get('/')
+    request.user = user
+    request.context = Context(request)
+    return request
+
+
+@benchmark
+def compute_unlocks(team, admin):
+    return lambda: Team.compute_unlocks(make_request(team.user).context)
+
+@benchmark
+def leaderboard_teams(team, admin):
+    return lambda: Team.leaderboard_teams(team)
+
+@benchmark
+def normalize_answer(team, admin):
+    guesses = list(AnswerSubmission.objects.values_list('submitted_answer', flat=True)[:1000])
+    guesses += ['Ｆｕｌｌｗｉｄｔｈ ａｎｓｗｅｒ', 'café au lait', '科学 PUZZLE 2024', "it's a trap!"] * 25
+    def run():
+        for guess in guesses:
+            Puzzle.normalize_answer(guess)
+    return run
+
+@benchmark
+def render_puzzles(team, admin):
+    return lambda: views.render_puzzles(make_request(team.user))
+
+@benchmark
+def bigboard_generic(team, admin):
+    return lambda: views.bigboard_generic(make_request(admin), hide_hidden=True)
+
+@benchmark
+def r2q8_rules(team, admin):
+    words = random.Random(0).sample(sorted(r2q8.dictionary_words()), 200)
+    def run():
+        for word in words:
+            r2q8.evaluate_rules(word)
+    return run
+
+@benchmark
+def get_sample_word(team, admin):
+    def run():
+        for index in range(len(r2q8.RULES_LIST)):
+            r2q8.get_sample_word(index)
+    return run
+
+@benchmark
+def r3q3_get_one(team, admin):
+    def run():
+        for _ in range(100):
+            r3q3.get_one()
+    return run
+
+PUZZLE_BODY_MD = '''
+This puzzle has **bold**, *italic* and `code` in it, and a [link](https://example.com).
+
+| Clue | Enumeration | Answer |
+|------|-------------|--------|
+''' + ''.join('| Clue number {} | ({}) | ____ |\n'.format(i, i % 9 + 3) for i in range(30)) + '''
+
+1. A list
+2. of several
+3. items
+
+> And a quote, with a footnote.[^1]
+
+[^1]: Here it is.
+'''
+
+@benchmark
+def puzzleblock(team, admin):
+    # Just the tag, in the same arrangement as puzzle bodies and puzzle.html.
+    engine = Engine(
+        loaders=[('django.template.loaders.locmem.Loader', {
+            'puzzle.html': '{% load puzzle_tags %}{% puzzleblock puzzle-body %}{{ puzzle_body }}',
+            'body.html': '{% extends "puzzle.html" %}{% block puzzle-body-md %}' + PUZZLE_BODY_MD + '{% endblock %}',
+        })],
+        libraries={'puzzle_tags': 'puzzles.templatetags.puzzle_tags'},
+    )
+    template = engine.get_template('body.html')
+    return lambda: template.render(TemplateContext())
+
+
+def measure(fn, repeat):
+    '''Returns the best and median seconds per call.'''
+    random.seed(0)
+    # The first call fills caches, as on a site that's been up a while.
+    fn()
+    timer = timeit.Timer(fn)
+    (number, _) = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return (min(times), statistics.median(times))
+
+
+def environment(options):
+    '''What the results depend on besides the code.'''
+    return {
+        'teams': options['teams'],
+        'guesses': options['guesses'],
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'r2q8_masks': r2q8.compiled_rules() is not None,
+    }
+
+
+def format_time(seconds):
+    for (unit, scale) in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3g} {}'.format(seconds / scale, unit)
+    return '{:.3g} ns'.format(seconds / 1e-9)
+
+
+class Command(BaseCommand):
+    help = 'Time the hot model, view and handler functions against seeded data, and compare with a saved baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all of them)')
+        parser.add_argument('--baseline', default=BASELINE)
+        parser.add_argument('--save', action='store_true', help='Save the results as the new baseline')
+        parser.add_argument('--threshold', type=float, default=0.2,
+            help='How much slower than the baseline counts as a regression (0.2 is 20%%)')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--teams', type=int, default=500)
+        parser.add_argument('--guesses', type=int, default=50000)
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError('No benchmark named {}; there are {}'.format(name, ', '.join(BENCHMARKS)))
+        baseline = {}
+        if not options['save'] and os.path.exists(options['baseline']):
+            with open(options['baseline']) as fp:
+                baseline = json.load(fp)
+            if baseline.get('environment') != environment(options):
+                self.stdout.write(self.style.WARNING('The baseline was saved in a different environment: {}'.format(
+                    baseline.get('environment'))))
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            # DEBUG would also keep a list of every query.
+            with override_settings(DEBUG=False):
+                results = self.run_benchmarks(names, options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        regressions = []
+        self.stdout.write('{:<20} {:>10} {:>10} {:>10} {:>8}'.format('benchmark', 'best', 'median', 'baseline', 'change'))
+        for (name, result) in results.items():
+            previous = baseline.get('results', {}).get(name)
+            change = ''
+            style = lambda line: line
+            if previous:
+                ratio = result['best'] / previous['best'] - 1
+                change = '{:+.0%}'.format(ratio)
+                if ratio > options['threshold']:
+                    regressions.append(name)
+                    style = self.style.ERROR
+                elif ratio < -options['threshold']:
+                    style = self.style.SUCCESS
+            self.stdout.write(style('{:<20} {:>10} {:>10} {:>10} {:>8}'.format(
+                name, format_time(result['best']), format_time(result['median']),
+                format_time(previous['best']) if previous else '-', change)))
+
+        if options['save']:
+            with open(options['baseline'], 'w') as fp:
+                json.dump({'environment': environment(options), 'results': results}, fp, indent=2)
+            self.stdout.write('Saved the baseline to {}'.format(options['baseline']))
+        if regressions:
+            raise CommandError('Slower than the baseline: {}'.format(', '.join(regressions)))
+
+    def run_benchmarks(self, names, options):
+        self.stdout.write('Generating {} teams...'.format(options['teams']))
+        generate_scale_hunt.generate(teams=options['teams'], guesses=options['guesses'])
+        team = Team.objects.filter(is_hidden=False).order_by('id').first()
+        admin = User.objects.create_superuser('benchmark-admin', 'admin@example.com', 'password')
+        results = {}
+        for name in names:
+            (best, median) = measure(BENCHMARKS[name](team, admin), options['repeat'])
+            results[name] = {'best': best, 'median': median}
+        return results
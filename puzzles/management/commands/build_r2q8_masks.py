@@ -0,0 +1,13 @@
+import time
+
+from django.core.management.base import BaseCommand
+from puzzles.puzzlehandlers import r2q8
+
+class Command(BaseCommand):
+    help = 'Precompute which r2q8 rules each dictionary word triggers (rerun after changing the rules or dictionary)'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        count = r2q8.build_masks()
+        self.stdout.write(self.style.SUCCESS('Wrote masks for {} words to {} in {:.1f}s.'.format(
+            count, r2q8.MASKS_PATH, time.time() - start)))
@@ -1,11 +1,15 @@
-from django.core.management.base import BaseCommand
-from puzzles.models import PuzzleUnlock, TeamMember
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+from puzzles.messaging import mail_queue, send_mail_wrapper
+from puzzles.models import Puzzle, PuzzleUnlock, TeamMember
 
 class Command(BaseCommand):
     help = 'List all email addresses of players on teams that have unlocked a certain puzzle'
 
     def add_arguments(self, parser):
         parser.add_argument('puzzle_slug', nargs=1, type=str)
+        parser.add_argument('--send', metavar='TEXT',
+            help='Also email them this erratum (Bcc, in batches)')
 
     def handle(self, *args, **options):
         slug = options['puzzle_slug'][0]
@@ -17,3 +21,16 @@ class Command(BaseCommand):
             self.stdout.write(self.style.SUCCESS('\nFound {} team members.'.format(len(members))))
         else:
             self.stdout.write(self.style.ERROR('Found nothing.'))
+            return
+        if options['send']:
+            puzzle = Puzzle.objects.get(slug=slug)
+            failures = mail_queue.failures
+            send_mail_wrapper(
+                _('Erratum for {}').format(puzzle.name), 'erratum_email',
+                {'puzzle': puzzle, 'text': options['send']},
+                list(dict.fromkeys(members)), bcc=True)
+            mail_queue.join()
+            if mail_queue.failures > failures:
+                raise CommandError('Could not send {} of the erratum messages; see the log for why.'.format(
+                    mail_queue.failures - failures))
+            self.stdout.write(self.style.SUCCESS('Sent the erratum.'))
@@ -0,0 +1,355 @@
+# Fills the database with a hunt in progress at the size we need to handle at
+# worst, for load testing and benchmarks: thousands of teams, each with
+# members, unlocks, right and wrong guesses, hints, surveys and interactive
+# puzzle state. Everything is written with bulk_create in batches, inside one
+# transaction, so no signals run; leaderboard entries are rebuilt and cached
+# team states dropped at the end.
+#
+# Teams are simulated rather than filled in uniformly: each has a skill, each
+# puzzle a difficulty, and a team works through the puzzles it has unlocked
+# (by the same round and local-solve rules as Team.refresh_unlocks) in order,
+# one at a time, until the present. Wrong guesses, hints and surveys land in
+# the time a team actually spent on a puzzle.
+import collections
+import heapq
+import itertools
+import random
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from puzzles import catalog, teamstate
+from puzzles.hunt_config import HUNT_START_TIME
+from puzzles.management.commands.generate_random_puzzles import adjectives as answer_adjectives
+from puzzles.management.commands.generate_random_puzzles import nouns as answer_nouns
+from puzzles.management.commands.generate_random_teams import adjectives, nouns
+from puzzles.models import (
+    AnswerSubmission, ExtraGuessGrant, GachaDraw, Hint, LeaderboardEntry, Puzzle, PuzzleGameState,
+    PuzzleUnlock, Round, Survey, Team, TeamMember,
+)
+from puzzles.puzzlehandlers import r2q8, r3q3
+
+BATCH_SIZE = 5000
+ROUND_SIZE = 10
+# Puzzles in a round open one per local solve after the first few.
+ROUND_OPEN = 4
+# Average minutes for an average team to solve an average puzzle.
+SOLVE_MINUTES = 90
+HIDDEN_RATE = 0.02
+MAX_MEMBERS = 6
+# Chance of asking for a hint, per hour spent on a puzzle.
+HINT_RATE = 0.05
+SURVEY_RATE = 0.6
+EXTRA_GUESS_RATE = 0.01
+# Share of teams that have played each interactive puzzle.
+GAME_RATE = 0.3
+
+
+@contextmanager
+def explicit_times():
+    '''Lets bulk_create keep the times we set instead of the current time.'''
+    fields = [
+        AnswerSubmission._meta.get_field('submitted_datetime'),
+        Hint._meta.get_field('submitted_datetime'),
+        Survey._meta.get_field('submitted_datetime'),
+        PuzzleGameState._meta.get_field('modified_time'),
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for (field, auto_now, auto_now_add) in saved:
+            (field.auto_now, field.auto_now_add) = (auto_now, auto_now_add)
+
+
+def insert(model, objects, batch_size, log):
+    '''Bulk creates objects from any iterable, batch_size at a time.'''
+    objects = iter(objects)
+    total = 0
+    while True:
+        batch = list(itertools.islice(objects, batch_size))
+        if not batch:
+            break
+        model.objects.bulk_create(batch)
+        total += len(batch)
+    log('{} {}'.format(total, model._meta.verbose_name_plural))
+    return total
+
+
+def create_puzzles(rng, count):
+    rounds = [
+        Round(name='Round {}'.format(r), slug='round-{}'.format(r), order=r)
+        for r in range((count + ROUND_SIZE - 1) // ROUND_SIZE)
+    ]
+    Round.objects.bulk_create(rounds)
+    rounds = {round.order: round for round in Round.objects.filter(slug__in=[r.slug for r in rounds])}
+    Puzzle.objects.bulk_create([
+        Puzzle(
+            name='Puzzle {}'.format(i), slug='puzzle-{}'.format(i), body_template='sample.html',
+            answer='{} {}'.format(rng.choice(answer_adjectives), rng.choice(answer_nouns)),
+            round=rounds[i // ROUND_SIZE], order=i % ROUND_SIZE,
+            is_meta=i % ROUND_SIZE == ROUND_SIZE - 1, unlock_local=max(0, i % ROUND_SIZE - ROUND_OPEN),
+        ) for i in range(count)
+    ])
+
+
+def simulate(rng, puzzles, difficulty, skill, start, now):
+    '''
+    Plays the hunt for one team from start to now. Returns when each puzzle
+    was unlocked and solved, as dicts of puzzle -> datetime.
+    '''
+    by_round = collections.defaultdict(list)
+    for puzzle in puzzles:
+        by_round[puzzle.round.order].append(puzzle)
+    unlocked = {}
+    solved = {}
+    local_solves = collections.Counter()
+    metas = 0
+    # Unlocked puzzles not yet solved, in the order the team goes through them
+    todo = []
+
+    def unlock(round_order, time):
+        if round_order != 0 and round_order > metas:
+            return
+        for puzzle in by_round.get(round_order, ()):
+            if puzzle not in unlocked and 0 <= puzzle.unlock_local <= local_solves[round_order]:
+                unlocked[puzzle] = time
+                heapq.heappush(todo, (puzzle.round.order, puzzle.order, puzzle.id, puzzle))
+
+    for puzzle in puzzles:
+        if 0 <= puzzle.unlock_hours:
+            time = start + timedelta(hours=puzzle.unlock_hours)
+            if time <= now:
+                unlocked[puzzle] = time
+                heapq.heappush(todo, (puzzle.round.order, puzzle.order, puzzle.id, puzzle))
+    for round_order in by_round:
+        unlock(round_order, start)
+    time = start
+    while todo:
+        puzzle = todo[0][-1]
+        minutes = rng.expovariate(skill / (SOLVE_MINUTES * difficulty[puzzle]))
+        time = max(time, unlocked[puzzle]) + timedelta(minutes=minutes)
+        if time > now:
+            break
+        heapq.heappop(todo)
+        solved[puzzle] = time
+        if puzzle.is_meta:
+            metas += 1
+            for round_order in by_round:
+                unlock(round_order, time)
+        else:
+            local_solves[puzzle.round.order] += 1
+            unlock(puzzle.round.order, time)
+    return (unlocked, solved)
+
+
+def between(rng, start, end):
+    return start + (end - start) * rng.random()
+
+
+def bingo_state(rng, words):
+    data = PuzzleGameState.game('r2q8').default()
+    for index in rng.sample(range(len(r2q8.RULES_LIST)), rng.randint(0, 10)):
+        data['known_rules'][index] = r2q8.RULES_LIST[index][1]
+    data['bingo_coin_num'] = rng.randint(0, 60)
+    data['word_history'] = [
+        '{} {}'.format(word, ','.join(str(1 + i) for i in sorted(rng.sample(range(25), rng.randint(0, 8)))))
+        for word in rng.sample(words, rng.randint(1, 100))
+    ]
+    return data
+
+
+def generate(teams=1000, puzzles=80, guesses=100000, hours=48, seed=0, prefix='scale',
+        batch_size=BATCH_SIZE, log=lambda message: None):
+    '''
+    Creates the given number of teams, who started the hunt the given number
+    of hours ago and have made about the given number of guesses between
+    them, plus puzzles for them to play (with puzzles=0, they play the ones
+    already in the database). Returns the created teams' ids.
+    '''
+    rng = random.Random(seed)
+    now = timezone.now()
+    start = now - timedelta(hours=hours)
+    with transaction.atomic(), explicit_times():
+        if puzzles:
+            create_puzzles(rng, puzzles)
+        puzzle_list = list(Puzzle.objects.select_related('round').order_by('round__order', 'order'))
+        if not puzzle_list:
+            raise CommandError('There are no puzzles to play')
+        difficulty = {
+            puzzle: rng.lognormvariate(0, 0.4) * (1.5 if puzzle.is_meta else 1) for puzzle in puzzle_list
+        }
+
+        password = make_password('password')
+        insert(User, (
+            User(username='{}{}'.format(prefix, i), email='{}{}@example.com'.format(prefix, i), password=password)
+            for i in range(teams)
+        ), batch_size, log)
+        users = list(User.objects.filter(username__in=['{}{}'.format(prefix, i) for i in range(teams)]).order_by('id'))
+
+        # Results of each team's simulated hunt, by index.
+        results = []
+        team_objects = []
+        for (i, user) in enumerate(users):
+            (unlocked, solved) = simulate(rng, puzzle_list, difficulty, rng.lognormvariate(0, 0.5), start, now)
+            results.append((unlocked, solved))
+            team_objects.append(Team(
+                user=user,
+                team_name='{} {} {}'.format(rng.choice(adjectives), rng.choice(nouns), i),
+                # Most teams register in the last week or so.
+                creation_time=start - timedelta(days=30) * rng.random() ** 3,
+                start_offset=HUNT_START_TIME - start,
+                last_solve_time=max(solved.values(), default=None),
+                is_hidden=rng.random() < HIDDEN_RATE,
+            ))
+        insert(Team, team_objects, batch_size, log)
+        team_ids = list(Team.objects.filter(user__in=users).order_by('user_id').values_list('id', flat=True))
+
+        insert(TeamMember, (
+            TeamMember(team_id=team_id, name='Member {}'.format(j), email='{}.{}@example.com'.format(team_id, j))
+            for team_id in team_ids for j in range(rng.randint(1, MAX_MEMBERS))
+        ), batch_size, log)
+        insert(PuzzleUnlock, (
+            PuzzleUnlock(
+                team_id=team_id, puzzle=puzzle, unlock_datetime=time,
+                view_datetime=min(now, time + timedelta(minutes=rng.expovariate(1 / 10))),
+            )
+            for (team_id, (unlocked, _)) in zip(team_ids, results)
+            for (puzzle, time) in unlocked.items()
+        ), batch_size, log)
+
+        # The time each team spent on each puzzle it unlocked.
+        attempts = [
+            (team_id, puzzle, time, solved.get(puzzle, now))
+            for (team_id, (unlocked, solved)) in zip(team_ids, results)
+            for (puzzle, time) in unlocked.items()
+        ]
+        correct = [
+            AnswerSubmission(
+                team_id=team_id, puzzle=puzzle, submitted_answer=puzzle.normalized_answer,
+                is_correct=True, used_free_answer=False, submitted_datetime=time,
+            )
+            for (team_id, (_, solved)) in zip(team_ids, results)
+            for (puzzle, time) in solved.items()
+        ]
+        # More guesses go to puzzles teams were stuck on for longer.
+        weights = list(itertools.accumulate(
+            (end - begin).total_seconds() + 1 for (_, _, begin, end) in attempts))
+
+        def wrong_guesses():
+            for n in range(0, max(0, guesses - len(correct)), batch_size):
+                k = min(batch_size, guesses - len(correct) - n)
+                for (i, (team_id, puzzle, begin, end)) in enumerate(
+                        rng.choices(attempts, cum_weights=weights, k=k), n):
+                    yield AnswerSubmission(
+                        team_id=team_id, puzzle=puzzle, submitted_answer='GUESS{}'.format(i),
+                        is_correct=False, used_free_answer=False, submitted_datetime=between(rng, begin, end),
+                    )
+
+        if attempts:
+            insert(AnswerSubmission, itertools.chain(correct, wrong_guesses()), batch_size, log)
+
+        def hints():
+            for (team_id, puzzle, begin, end) in attempts:
+                if rng.random() >= HINT_RATE * (end - begin).total_seconds() / 3600:
+                    continue
+                asked = between(rng, begin, end)
+                answered = asked + timedelta(minutes=rng.expovariate(1 / 20))
+                hint = Hint(
+                    team_id=team_id, puzzle=puzzle, submitted_datetime=asked,
+                    hint_question='We have {} so far, but are stuck.'.format(rng.choice(answer_nouns)),
+                )
+                if answered > end and end < now:
+                    hint.status = Hint.OBSOLETE
+                elif answered < now:
+                    hint.status = Hint.ANSWERED
+                    hint.claimer = 'Staff'
+                    hint.claimed_datetime = asked + (answered - asked) / 2
+                    hint.answered_datetime = answered
+                    hint.response = 'Have you tried looking at it from the other side?'
+                yield hint
+
+        insert(Hint, hints(), batch_size, log)
+        insert(Survey, (
+            Survey(
+                team_id=team_id, puzzle=puzzle, fun=rng.randint(1, 6), difficulty=rng.randint(1, 6),
+                submitted_datetime=min(now, time + timedelta(minutes=rng.expovariate(1 / 5))),
+            )
+            for (team_id, (_, solved)) in zip(team_ids, results)
+            for (puzzle, time) in solved.items() if rng.random() < SURVEY_RATE
+        ), batch_size, log)
+        insert(ExtraGuessGrant, (
+            ExtraGuessGrant(team_id=team_id, puzzle=puzzle, extra_guesses=rng.randint(5, 50))
+            for (team_id, puzzle, _, _) in attempts if rng.random() < EXTRA_GUESS_RATE
+        ), batch_size, log)
+
+        # Interactive puzzle state, already in the current schema.
+        words = sorted(r2q8.dictionary_words())[:5000]
+        players = {
+            slug: [team_id for team_id in team_ids if rng.random() < GAME_RATE]
+            for slug in PuzzleGameState.GAMES
+        }
+        draws = {team_id: 10 * rng.randint(1, 30) for team_id in players['r3q3']}
+        insert(PuzzleGameState, itertools.chain(
+            (
+                PuzzleGameState(
+                    team_id=team_id, puzzle='r2q8', data=bingo_state(rng, words),
+                    schema_version=PuzzleGameState.game('r2q8').schema_version, modified_time=between(rng, start, now),
+                )
+                for team_id in players['r2q8']
+            ),
+            (
+                PuzzleGameState(
+                    team_id=team_id, puzzle='r3q3', data={'draws': draws[team_id]},
+                    schema_version=PuzzleGameState.game('r3q3').schema_version, modified_time=between(rng, start, now),
+                )
+                for team_id in players['r3q3']
+            ),
+        ), batch_size, log)
+        insert(GachaDraw, (
+            GachaDraw(team_id=team_id, number=number, kind=GachaDraw.KINDS.index(kind), text=str(text))
+            for (team_id, count) in draws.items()
+            for (number, item) in enumerate((r3q3.get_one() for _ in range(count)), 1)
+            for (text, kind) in item.items()
+        ), batch_size, log)
+
+        log('{} leaderboard entries'.format(LeaderboardEntry.rebuild(team_ids)))
+    if puzzles:
+        catalog.invalidate()
+    teamstate.invalidate(team_ids)
+    return team_ids
+
+
+class Command(BaseCommand):
+    help = 'Generate a large hunt in progress with bulk inserts, for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--teams', type=int, default=1000)
+        parser.add_argument('--puzzles', type=int, default=80,
+            help='Puzzles to create; with 0, teams play the puzzles already in the database')
+        parser.add_argument('--guesses', type=int, default=100000,
+            help='Total answer submissions, right and wrong')
+        parser.add_argument('--hours', type=float, default=48,
+            help='How long ago the teams started the hunt')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='scale', help='Prefix for the teams\' usernames')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError('There are already users named {}*; pick another --prefix'.format(options['prefix']))
+        if options['puzzles'] and Puzzle.objects.filter(slug__startswith='puzzle-').exists():
+            raise CommandError('There are already generated puzzles; use --puzzles 0 to play those')
+        team_ids = generate(
+            teams=options['teams'], puzzles=options['puzzles'], guesses=options['guesses'],
+            hours=options['hours'], seed=options['seed'], prefix=options['prefix'],
+            batch_size=options['batch_size'], log=self.stdout.write,
+        )
+        self.stdout.write(self.style.SUCCESS('Generated {} teams'.format(len(team_ids))))
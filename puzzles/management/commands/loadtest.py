@@ -0,0 +1,271 @@
+# Replays hunt traffic against a copy of the site running locally, and
+# reports latency percentiles and throughput for each kind of request. Each
+# simulated team logs in as one of the teams made by generate_scale_hunt,
+# keeps the team websocket open like the site's pages do, and then loops
+# through a weighted mix of requests with some thinking time in between.
+#
+# With --serve, the site is started here under uvicorn, so nothing else needs
+# to be running; the dev settings keep the cache and channel layer in memory.
+import asyncio
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import aiohttp
+from django.core.management.base import BaseCommand, CommandError
+
+from puzzles.models import PuzzleUnlock, Team
+from puzzles.puzzlehandlers import r2q8
+
+# name -> weight
+MIX = {
+    'puzzles': 30,
+    'puzzle': 25,
+    'solve': 15,
+    'r2q8': 10,
+    'r3q3': 10,
+    'hints': 2,
+}
+PERCENTILES = (50, 95, 99)
+
+
+class Stats:
+    def __init__(self):
+        # endpoint -> [seconds]
+        self.latencies = collections.defaultdict(list)
+        # endpoint -> status (or exception name) -> count
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.messages = 0
+
+    def record(self, endpoint, status, seconds):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] += 1
+
+    def report(self, duration):
+        '''Returns endpoint -> summary, as plain data for printing or saving.'''
+        report = {}
+        for (endpoint, latencies) in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            report[endpoint] = {
+                'requests': len(latencies),
+                'per_second': len(latencies) / duration,
+                'statuses': dict(self.statuses[endpoint]),
+            }
+            for p in PERCENTILES:
+                report[endpoint]['p{}'.format(p)] = percentile(latencies, p)
+        return report
+
+
+def percentile(values, p):
+    '''The nearest-rank percentile of sorted values.'''
+    if not values:
+        return None
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+class Player:
+    '''One team's browser.'''
+
+    def __init__(self, url, username, password, slugs, words, stats, rng, think):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.slugs = slugs
+        self.words = words
+        self.stats = stats
+        self.rng = rng
+        self.think = think
+        self.guesses = 0
+
+    def csrf_token(self):
+        cookie = self.session.cookie_jar.filter_cookies(self.url).get('csrftoken')
+        return cookie.value if cookie else ''
+
+    async def request(self, endpoint, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with self.session.request(method, self.url + path, allow_redirects=False, **kwargs) as response:
+                await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = type(e).__name__
+        self.stats.record(endpoint, status, time.perf_counter() - start)
+        return status
+
+    def post_form(self, endpoint, path, data):
+        data = dict(data, csrfmiddlewaretoken=self.csrf_token())
+        return self.request(endpoint, 'POST', path, data=data)
+
+    def post_json(self, endpoint, path, data):
+        return self.request(endpoint, 'POST', path, data=json.dumps(data), headers={
+            'Content-Type': 'application/json', 'X-CSRFToken': self.csrf_token(),
+        })
+
+    async def listen(self):
+        start = time.perf_counter()
+        try:
+            async with self.session.ws_connect(self.url.replace('http', 'ws', 1) + '/ws/team') as ws:
+                self.stats.record('ws/team', 101, time.perf_counter() - start)
+                async for _ in ws:
+                    self.stats.messages += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.stats.record('ws/team', type(e).__name__, time.perf_counter() - start)
+
+    async def step(self, action):
+        slug = self.rng.choice(self.slugs) if self.slugs else None
+        if action == 'puzzles' or slug is None:
+            await self.request('puzzles', 'GET', '/puzzles')
+        elif action == 'puzzle':
+            await self.request('puzzle', 'GET', '/puzzle/' + slug)
+        elif action == 'solve':
+            self.guesses += 1
+            await self.post_form('solve', '/solve/' + slug, {
+                'answer': 'LOADTEST{}{}'.format(self.username.upper(), self.guesses),
+            })
+        elif action == 'r2q8':
+            await self.post_json('r2q8', '/puzzle/r2q8/submit', {
+                'mode': 'guess_a_word', 'word': self.rng.choice(self.words),
+            })
+        elif action == 'r3q3':
+            await self.post_json('r3q3', '/puzzle/r3q3/submit', {'num': 1})
+        elif action == 'hints':
+            await self.post_form('hints', '/hints/' + slug, {
+                'hint_question': 'Load test hint request', 'notify_emails': 'none',
+            })
+
+    async def play(self, deadline):
+        actions = list(MIX)
+        weights = list(MIX.values())
+        async with aiohttp.ClientSession(
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=60)) as self.session:
+            await self.request('login-form', 'GET', '/login')
+            status = await self.post_form('login', '/login', {
+                'username': self.username, 'password': self.password,
+            })
+            if status != 302:
+                return
+            listener = asyncio.ensure_future(self.listen())
+            try:
+                while time.monotonic() < deadline:
+                    await self.step(self.rng.choices(actions, weights)[0])
+                    await asyncio.sleep(self.rng.expovariate(1 / self.think) if self.think else 0)
+            finally:
+                listener.cancel()
+                await asyncio.gather(listener, return_exceptions=True)
+
+
+def run(url, players, duration, think, seed=0):
+    '''
+    Replays traffic from the given (username, password) players for duration
+    seconds, and returns the report from Stats, plus overall totals.
+    '''
+    names = [username for (username, _) in players]
+    slugs = collections.defaultdict(list)
+    for (username, slug) in PuzzleUnlock.objects.filter(
+            team__user__username__in=names).values_list('team__user__username', 'puzzle__slug'):
+        slugs[username].append(slug)
+    words = sorted(r2q8.dictionary_words())
+    stats = Stats()
+    rng = random.Random(seed)
+
+    async def main():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(
+            Player(url, username, password, slugs[username], words, stats, random.Random(rng.random()), think)
+            .play(deadline)
+            for (username, password) in players
+        ))
+
+    start = time.monotonic()
+    asyncio.run(main())
+    elapsed = time.monotonic() - start
+    report = stats.report(elapsed)
+    return {
+        'duration': elapsed,
+        'requests': sum(summary['requests'] for summary in report.values()),
+        'websocket_messages': stats.messages,
+        'endpoints': report,
+    }
+
+
+def wait_until_up(url, process, timeout=60):
+    async def check():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url + '/robots.txt') as response:
+                return response.status
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError('The server exited with status {}'.format(process.returncode))
+        try:
+            asyncio.run(check())
+            return
+        except aiohttp.ClientError:
+            time.sleep(0.2)
+    raise CommandError('The server didn\'t come up in {}s'.format(timeout))
+
+
+class Command(BaseCommand):
+    help = 'Replay hunt traffic from generated teams against a local server and report latency per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+            help='Where the site is running, or where to run it with --serve')
+        parser.add_argument('--serve', action='store_true',
+            help='Start the site (gph.asgi:application under uvicorn) for the test')
+        parser.add_argument('--workers', type=int, default=1, help='Server processes with --serve')
+        parser.add_argument('--teams', type=int, default=50, help='Teams playing at once')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to play for')
+        parser.add_argument('--think', type=float, default=1,
+            help='Average seconds each team waits between requests')
+        parser.add_argument('--prefix', default='scale',
+            help='Username prefix of the teams to log in as (see generate_scale_hunt)')
+        parser.add_argument('--password', default='password')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', help='Also write the report to this file')
+
+    def handle(self, *args, **options):
+        url = options['url'].rstrip('/')
+        usernames = list(Team.objects.filter(
+            user__username__startswith=options['prefix'], is_hidden=False,
+        ).order_by('id').values_list('user__username', flat=True)[:options['teams']])
+        if not usernames:
+            raise CommandError('No teams named {}*; make some with generate_scale_hunt'.format(options['prefix']))
+
+        server = None
+        if options['serve']:
+            (host, _, port) = url.split('://', 1)[1].partition(':')
+            server = subprocess.Popen([
+                sys.executable, '-m', 'uvicorn', 'gph.asgi:application',
+                '--host', host, '--port', port or '80', '--workers', str(options['workers']),
+                '--no-access-log', '--log-level', 'warning',
+            ], env=dict(os.environ))
+        try:
+            if server:
+                wait_until_up(url, server)
+            result = run(url, [(username, options['password']) for username in usernames],
+                options['duration'], options['think'], options['seed'])
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+        self.stdout.write('{} teams, {} requests in {:.1f}s ({:.1f}/s), {} websocket messages'.format(
+            len(usernames), result['requests'], result['duration'],
+            result['requests'] / result['duration'], result['websocket_messages']))
+        self.stdout.write('{:<12} {:>8} {:>8} {:>8} {:>8} {:>8}  statuses'.format(
+            'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for (endpoint, summary) in result['endpoints'].items():
+            self.stdout.write('{:<12} {:>8} {:>8.1f} {:>8.0f} {:>8.0f} {:>8.0f}  {}'.format(
+                endpoint, summary['requests'], summary['per_second'],
+                *(summary['p{}'.format(p)] * 1000 for p in PERCENTILES),
+                ' '.join('{}:{}'.format(status, n) for (status, n) in sorted(summary['statuses'].items(), key=str))))
+        if options['json']:
+            with open(options['json'], 'w') as fp:
+                json.dump(result, fp, indent=2)
@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+from puzzles.puzzlehandlers import r2q8_data
+
+class Command(BaseCommand):
+    help = 'Pack the puzzle handlers\' word lists into memory-mapped tables (rerun after changing any of them)'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        paths = r2q8_data.pack_tables()
+        for path in paths:
+            self.stdout.write(path)
+        self.stdout.write(self.style.SUCCESS('Packed {} tables in {:.1f}s.'.format(len(paths), time.time() - start)))
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from puzzles.models import LeaderboardEntry
+
+class Command(BaseCommand):
+    help = 'Recomputes every team\'s leaderboard entry from its submissions'
+
+    def handle(self, *args, **options):
+        count = LeaderboardEntry.rebuild()
+        self.stdout.write(self.style.SUCCESS('Rebuilt %d leaderboard entries' % count))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from puzzles import bigboard
+
+class Command(BaseCommand):
+    help = 'Rebuilds the big board snapshots, once or every few seconds'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=int, default=0,
+            help='Keep running and rebuild every this many seconds')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            start = time.monotonic()
+            for hide_hidden in (True, False):
+                # Keep snapshots around a bit longer than the refresh
+                # interval, so page loads don't rebuild them in between.
+                bigboard.refresh_snapshot(
+                    hide_hidden, timeout=max(bigboard.SNAPSHOT_TIMEOUT, 3 * interval))
+            elapsed = time.monotonic() - start
+            self.stdout.write('Rebuilt big board in %.2fs' % elapsed)
+            if not interval:
+                break
+            time.sleep(max(0, interval - elapsed))
@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def load_site():
+    # What a worker needs loaded to serve requests at full speed.
+    import gph.asgi
+    from django.urls import get_resolver
+    from puzzles.warmup import warm_up
+    get_resolver().url_patterns
+    warm_up()
+
+
+def report():
+    print(json.dumps({'pid': os.getpid()}), flush=True)
+    # Stay alive until the parent has measured us.
+    sys.stdin.read()
+
+
+def worker(mode, workers):
+    'Runs in a subprocess, standing in for one worker or a preloading master.'
+    load_site()
+    if mode == 'separate':
+        report()
+        return
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            load_site()
+            report()
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def memory(pid):
+    'Returns the (RSS, PSS) of a process in kB.'
+    values = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as fp:
+        for line in fp:
+            (key, _, rest) = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                values[key] = int(rest.split()[0])
+    return (values['Rss'], values['Pss'])
+
+
+class Command(BaseCommand):
+    help = 'Compare startup time and memory of separately loaded workers against preloading before forking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+
+    def measure(self, mode, workers):
+        code = 'from puzzles.management.commands.startup_benchmark import worker; worker({!r}, {})'.format(mode, workers)
+        start = time.time()
+        processes = [
+            subprocess.Popen([sys.executable, '-c', code], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            for _ in range(workers if mode == 'separate' else 1)
+        ]
+        try:
+            pids = []
+            for process in processes:
+                for _ in range(1 if mode == 'separate' else workers):
+                    line = process.stdout.readline()
+                    if not line:
+                        raise CommandError('A {} worker died before it was ready'.format(mode))
+                    pids.append(json.loads(line)['pid'])
+            elapsed = time.time() - start
+            if mode == 'preload':
+                pids.append(processes[0].pid)
+            usage = [memory(pid) for pid in pids]
+        finally:
+            for process in processes:
+                process.stdin.close()
+                process.wait()
+        self.stdout.write('{:>9}: {} workers ready in {:.2f}s, RSS {:.0f} MB, PSS {:.0f} MB'.format(
+            mode, workers, elapsed,
+            sum(rss for (rss, _) in usage) / 1024,
+            sum(pss for (_, pss) in usage) / 1024))
+
+    def handle(self, *args, **options):
+        if not os.path.exists('/proc/self/smaps_rollup'):
+            raise CommandError('This needs Linux to measure memory')
+        for mode in ('separate', 'preload'):
+            self.measure(mode, options['workers'])
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from puzzles import puzzlehandlers  # Registers the upgrades.
+from puzzles.models import PuzzleGameState, Team
+
+class Command(BaseCommand):
+    help = 'Upgrade every stored puzzle game state to its current schema version, so requests never have to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('puzzles', nargs='*', help='Puzzle slugs (default: all of them)')
+
+    def handle(self, *args, **options):
+        slugs = options['puzzles'] or list(PuzzleGameState.GAMES)
+        for slug in slugs:
+            if slug not in PuzzleGameState.GAMES:
+                raise CommandError('No game state for {}'.format(slug))
+        for slug in slugs:
+            game = PuzzleGameState.game(slug)
+            team_ids = set(PuzzleGameState.objects.filter(
+                puzzle=slug, schema_version__lt=game.schema_version,
+            ).values_list('team_id', flat=True))
+            if game.legacy_field:
+                # Teams that have only ever played with the old field.
+                team_ids.update(team_id for (team_id, data) in Team.objects.exclude(
+                    game_states__puzzle=slug,
+                ).values_list('id', game.legacy_field) if data)
+            for team in Team.objects.filter(id__in=team_ids).defer(*PuzzleGameState.LEGACY_FIELDS):
+                with PuzzleGameState.locked(team, slug):
+                    pass
+            self.stdout.write(self.style.SUCCESS('Upgraded {} {} states to version {}.'.format(
+                len(team_ids), slug, game.schema_version)))
@@ -1,8 +1,14 @@
+import abc
 import asyncio
+import atexit
 import collections
 import json
 import logging
+import os
+import queue
 import requests
+import threading
+import time
 import traceback
 
 from asgiref.sync import async_to_sync
@@ -12,6 +18,8 @@ import discord
 
 from django.conf import settings
 from django.contrib import messages
+from django import db
+from django.core.mail import get_connection
 from django.core.mail.message import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.urls import reverse
@@ -78,7 +86,9 @@ logger = logging.getLogger('puzzles.messaging')
 
 puzzle_logger = logging.getLogger('puzzles.puzzle')
 def log_puzzle_info(puzzle, team, content):
-    puzzle_logger.info('{}\t{}\t{}'.format(puzzle, team, content))
+    # The extra fields are what the puzzle log viewer stores and filters on.
+    puzzle_logger.info('{}\t{}\t{}'.format(puzzle, team, content), extra={
+        'puzzle': puzzle, 'team': team, 'content': content})
 
 request_logger = logging.getLogger('puzzles.request')
 def log_request_middleware(get_response):
@@ -88,37 +98,157 @@ def log_request_middleware(get_response):
     return middleware
 
 
+# A queue of work that each process hands off to a background thread, so that
+# requests can return without waiting for it. The worker takes whatever has
+# been queued within BATCH_WINDOW seconds of the first item and passes it to
+# process() in one go. In tests (and the dev server) items are processed right
+# away instead, so the results are observable without waiting.
+class BackgroundQueue(abc.ABC):
+    name = None
+    # How long to wait for more items after the first one, in seconds.
+    BATCH_WINDOW = 0
+
+    def __init__(self, synchronous=False):
+        self.synchronous = synchronous
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def start_worker(self):
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, name=self.name, daemon=True).start()
+
+    def put(self, item):
+        if self.synchronous:
+            self.process([item])
+            return
+        # Threads don't survive a fork, so check we have one in this process.
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start_worker()
+                    self.pid = os.getpid()
+        self.queue.put(item)
+
+    def join(self):
+        '''Wait until everything queued so far has been processed.'''
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    @abc.abstractmethod
+    def process(self, items):
+        '''Handles a batch of queued items, in the order they were put.'''
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            time.sleep(self.BATCH_WINDOW)
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self.process(items)
+            except Exception:
+                logger.exception('%s failed to process %d items', self.name, len(items))
+            finally:
+                for _item in items:
+                    self.queue.task_done()
+
+
+# Emails are rendered and sent by a background worker, which sends everything
+# queued around the same time over one SMTP connection, splits long recipient
+# lists into several messages and retries failed sends with backoff.
+class MailQueue(BackgroundQueue):
+    name = 'mail-queue'
+    BATCH_WINDOW = 1
+    # Recipients per message when a list is split up.
+    RECIPIENTS_PER_MESSAGE = 50
+    MAX_ATTEMPTS = 4
+    # Seconds before the first retry; doubled for each retry after that.
+    RETRY_DELAY = 2
+
+    def __init__(self, synchronous=False):
+        super().__init__(synchronous)
+        # Messages given up on since the process started, for anything that
+        # wants to report them once the queue has been joined.
+        self.failures = 0
+
+    def put(self, subject, template, context, recipients, bcc=False):
+        super().put((subject, template, context, list(recipients), bcc))
+
+    def build_messages(self, subject, template, context, recipients, bcc):
+        body = render_to_string(template + '.txt', context)
+        html = render_to_string(template + '.html', context)
+        logger.info(_('Sending mail <{}> to <{}>:\n{}').format(
+                subject, ', '.join(recipients), body))
+        for i in range(0, len(recipients), self.RECIPIENTS_PER_MESSAGE):
+            chunk = recipients[i:i + self.RECIPIENTS_PER_MESSAGE]
+            yield EmailMultiAlternatives(
+                subject=subject,
+                body=body,
+                from_email=MESSAGING_SENDER_EMAIL,
+                to=[] if bcc else chunk,
+                bcc=chunk if bcc else [],
+                alternatives=[(html, 'text/html')],
+                reply_to=[CONTACT_EMAIL])
+
+    def send(self, connection, mail):
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                connection.open()
+                if connection.send_messages([mail]) != 1:
+                    raise RuntimeError(_('Unknown failure???'))
+                return True
+            except Exception:
+                connection.close()
+                if attempt + 1 == self.MAX_ATTEMPTS:
+                    logger.info(('Could not send mail <{}> to <{}>:\n{}').format(
+                            mail.subject, ', '.join(mail.recipients()), traceback.format_exc()))
+                    return False
+                time.sleep(self.RETRY_DELAY * 2 ** attempt)
+
+    def process(self, items):
+        connection = get_connection()
+        try:
+            for (subject, template, context, recipients, bcc) in items:
+                for mail in self.build_messages(subject, template, context, recipients, bcc):
+                    if not self.send(connection, mail):
+                        with self.lock:
+                            self.failures += 1
+        finally:
+            connection.close()
+            if not self.synchronous:
+                # Rendering may have used this thread's database connection.
+                db.connection.close()
+
+mail_queue = MailQueue()
+
+# The worker thread is a daemon, so without this, mail still queued (or
+# waiting to be retried) when a process exits, e.g. when gunicorn restarts a
+# worker, would be dropped.
+atexit.register(mail_queue.join)
+
+
 # NOTE: we don't have a request available, so this doesn't render with a
 # RequestContext, so the magic from our context processor is not available! (We
 # maybe could sometimes provide a request, but I don't want to add that
 # coupling right now.)
-def send_mail_wrapper(subject, template, context, recipients):
+# Pass bcc=True for mass mailings, so recipients don't see each other.
+def send_mail_wrapper(subject, template, context, recipients, bcc=False):
     if not recipients:
         return
     # Manually plug in some template variables we know we want
     context['hunt_title'] = HUNT_TITLE
     context['hunt_organizers'] = HUNT_ORGANIZERS
     subject = settings.EMAIL_SUBJECT_PREFIX + subject
-    body = render_to_string(template + '.txt', context)
-    logger.info(_('Sending mail <{}> to <{}>:\n{}').format(
-            subject, ', '.join(recipients), body))
     if settings.IS_TEST:
+        body = render_to_string(template + '.txt', context)
+        logger.info(_('Sending mail <{}> to <{}>:\n{}').format(
+                subject, ', '.join(recipients), body))
         return
-    mail = EmailMultiAlternatives(
-        subject=subject,
-        body=body,
-        from_email=MESSAGING_SENDER_EMAIL,
-        to=recipients,
-        alternatives=[(render_to_string(template + '.html', context), 'text/html')],
-        reply_to=[CONTACT_EMAIL])
-    try:
-        if mail.send() != 1:
-            raise RuntimeError(_('Unknown failure???'))
-    except Exception:
-        logger.info(('Could not send mail <{}> to <{}>:\n{}').format(
-                subject, ', '.join(recipients), traceback.format_exc()))
-        # dispatch_general_alert(_('Could not send mail <{}> to <{}>:\n{}').format(
-        #     subject, ', '.join(recipients), traceback.format_exc()))
+    mail_queue.put(subject, template, context, recipients, bcc)
 
 
 # class DiscordInterface:
@@ -249,6 +379,55 @@ def send_mail_wrapper(subject, template, context, recipients):
 # discord_interface = DiscordInterface()
 
 
+# Messages for websocket groups go through this outbox rather than straight to
+# the channel layer, so that requests don't wait on a round trip to Redis for
+# every unlock, solve and hint notification. The worker collects whatever has
+# been queued over a short window and sends it with one group_send per group.
+class NotificationOutbox(BackgroundQueue):
+    name = 'notification-outbox'
+    BATCH_WINDOW = 0.05
+
+    def __init__(self, synchronous=False):
+        super().__init__(synchronous)
+        self.loop = None
+
+    def start_worker(self):
+        self.loop = None
+        super().start_worker()
+
+    def put(self, group, text_data):
+        super().put((group, text_data))
+
+    @staticmethod
+    def coalesce(items):
+        batches = collections.OrderedDict()
+        for (group, text_data) in items:
+            batches.setdefault(group, []).append(text_data)
+        return batches
+
+    async def send_batches(self, batches):
+        layer = get_channel_layer()
+        await asyncio.gather(*(
+            layer.group_send(group, {'type': 'channel.receive_broadcast', 'data': data[0]})
+            if len(data) == 1 else
+            layer.group_send(group, {'type': 'channel.receive_batch', 'data': data})
+            for (group, data) in batches.items()
+        ))
+
+    def process(self, items):
+        batches = self.coalesce(items)
+        if self.synchronous:
+            async_to_sync(self.send_batches)(batches)
+            return
+        # Keep one event loop for the worker thread, so the channel layer can
+        # reuse its connections.
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.send_batches(batches))
+
+outbox = NotificationOutbox(synchronous=settings.IS_TEST)
+
+
 # A WebsocketConsumer subclass that can exchange messages with a single
 # browser tab.
 class IndividualWebsocketConsumer(WebsocketConsumer):
@@ -286,6 +465,14 @@ class BroadcastWebsocketConsumer(WebsocketConsumer):
         except Exception:
             pass
 
+    # Several messages for the same group, coalesced by NotificationOutbox.
+    def channel_receive_batch(self, event):
+        for text_data in event['data']:
+            try:
+                self.send(text_data=text_data)
+            except Exception:
+                pass
+
 class TeamWebsocketConsumer(BroadcastWebsocketConsumer):
     group_id = None
 
@@ -303,9 +490,7 @@ class TeamWebsocketConsumer(BroadcastWebsocketConsumer):
         except:
             _text_data = text_data
         logger.info(f"TeamWebsocketConsumer text_data: {_text_data}")
-        async_to_sync(get_channel_layer().group_send)(
-            '%s-%d' % (cls.group_id, team.user_id),
-            {'type': 'channel.receive_broadcast', 'data': text_data})
+        outbox.put('%s-%d' % (cls.group_id, team.user_id), text_data)
 
 class TeamNotificationsConsumer(TeamWebsocketConsumer):
     group_id = 'team'
@@ -322,13 +507,14 @@ class AdminWebsocketConsumer(BroadcastWebsocketConsumer):
 
     @classmethod
     def send_to_all(cls, text_data):
-        async_to_sync(get_channel_layer().group_send)(
-            cls.group_id,
-            {'type': 'channel.receive_broadcast', 'data': text_data})
+        outbox.put(cls.group_id, text_data)
 
 class HintsConsumer(AdminWebsocketConsumer):
     group_id = 'hints'
 
+class BigboardConsumer(AdminWebsocketConsumer):
+    group_id = 'bigboard'
+
 def show_unlock_notification(context, unlock):
     if unlock.puzzle.slug == META_META_SLUG:
         text = "终于快写完了！就差最后一个部分了……"
@@ -374,3 +560,15 @@ def show_hint_notification(hint):
         'link': reverse('hints', args=(hint.puzzle.slug,)),
     })
     TeamNotificationsConsumer.send_to_team(hint.team, data)
+
+def send_bigboard_delta(kind, team, puzzle_id):
+    '''
+    Tells open big boards that something happened to one cell. kind is one of
+    'unlock', 'guess', 'solve', 'free' or 'hint'.
+    '''
+    BigboardConsumer.send_to_all(json.dumps({
+        'kind': kind,
+        'team': team.id,
+        'hidden': team.is_hidden,
+        'puzzle': puzzle_id,
+    }))
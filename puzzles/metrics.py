@@ -0,0 +1,166 @@
+# Per-view request metrics: how long each request took, how many database
+# queries it made and how long they took, and how often the cached properties
+# of Context and Team (see context.py) were computed versus reused. They're
+# exported at /bridge/metrics in the Prometheus text format.
+#
+# Each process counts its own requests in memory and copies its totals into
+# the cache every FLUSH_INTERVAL seconds, and the endpoint adds up every
+# process's totals, so it shows the whole site whichever worker serves it.
+import collections
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+FLUSH_INTERVAL = 5
+PIDS_KEY = 'metrics:pids'
+SNAPSHOT_TIMEOUT = 60 * 60
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+CACHE_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+# name -> (help, buckets)
+HISTOGRAMS = {
+    'gph_request_duration_seconds': ('Time to respond to a request', DURATION_BUCKETS),
+    'gph_request_db_queries': ('Database queries made by a request', QUERY_BUCKETS),
+    'gph_request_db_seconds': ('Time a request spent in database queries', DURATION_BUCKETS),
+    'gph_request_context_cache_hits': ('Cached Context/Team properties reused by a request', CACHE_BUCKETS),
+    'gph_request_context_cache_misses': ('Cached Context/Team properties computed by a request', CACHE_BUCKETS),
+}
+CACHE_COUNTER = 'gph_context_cache_total'
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0
+        # (property, hit) -> count
+        self.cache = collections.Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        # Used as a database execute_wrapper.
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - start
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+def count_cache(name, hit):
+    '''Called by the Context and Team cached properties.'''
+    stats = current_request.get()
+    if stats is not None:
+        stats.cache[(name, hit)] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # (histogram name, view) -> [count per bucket, with +Inf last; sum]
+        self.histograms = {}
+        # (property, result) -> count
+        self.cache_counts = collections.Counter()
+        self.flushed = 0
+
+    def observe(self, view, stats, duration):
+        values = {
+            'gph_request_duration_seconds': duration,
+            'gph_request_db_queries': stats.queries,
+            'gph_request_db_seconds': stats.query_time,
+            'gph_request_context_cache_hits': sum(n for ((_, hit), n) in stats.cache.items() if hit),
+            'gph_request_context_cache_misses': sum(n for ((_, hit), n) in stats.cache.items() if not hit),
+        }
+        with self.lock:
+            for (name, value) in values.items():
+                buckets = HISTOGRAMS[name][1]
+                (counts, total) = self.histograms.get((name, view), ([0] * (len(buckets) + 1), 0))
+                counts[bisect_left(buckets, value)] += 1
+                self.histograms[(name, view)] = (counts, total + value)
+            for ((name, hit), n) in stats.cache.items():
+                self.cache_counts[(name, 'hit' if hit else 'miss')] += n
+            due = time.monotonic() - self.flushed >= FLUSH_INTERVAL
+        if due or settings.IS_TEST:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            snapshot = {
+                'histograms': [(key, list(counts), total) for (key, (counts, total)) in self.histograms.items()],
+                'cache': list(self.cache_counts.items()),
+            }
+            self.flushed = time.monotonic()
+        pid = os.getpid()
+        cache.set('metrics:{}'.format(pid), snapshot, SNAPSHOT_TIMEOUT)
+        pids = cache.get(PIDS_KEY) or []
+        if pid not in pids:
+            cache.set(PIDS_KEY, pids[-200:] + [pid], SNAPSHOT_TIMEOUT)
+
+registry = Registry()
+
+
+def metrics_middleware(get_response):
+    def middleware(request):
+        stats = RequestStats()
+        token = current_request.set(stats)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats))
+                return get_response(request)
+        finally:
+            duration = time.perf_counter() - start
+            current_request.reset(token)
+            match = getattr(request, 'resolver_match', None)
+            registry.observe(match.view_name if match else '', stats, duration)
+    return middleware
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def exposition():
+    '''Returns every process's metrics added up, in Prometheus text format.'''
+    registry.flush()
+    pids = cache.get(PIDS_KEY) or []
+    snapshots = cache.get_many(['metrics:{}'.format(pid) for pid in pids]).values()
+    histograms = {}
+    cache_counts = collections.Counter()
+    for snapshot in snapshots:
+        for (key, counts, total) in snapshot['histograms']:
+            (merged, merged_total) = histograms.get(key, ([0] * len(counts), 0))
+            histograms[key] = ([a + b for (a, b) in zip(merged, counts)], merged_total + total)
+        for (key, n) in snapshot['cache']:
+            cache_counts[tuple(key)] += n
+
+    lines = []
+    for (name, (help, buckets)) in HISTOGRAMS.items():
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} histogram'.format(name))
+        for ((metric, view), (counts, total)) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            label = 'view="{}"'.format(escape(view))
+            cumulative = 0
+            for (bound, count) in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, bound, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(name, label, total))
+            lines.append('{}_count{{{}}} {}'.format(name, label, cumulative))
+    lines.append('# HELP {} Cached Context/Team property lookups'.format(CACHE_COUNTER))
+    lines.append('# TYPE {} counter'.format(CACHE_COUNTER))
+    for ((name, result), n) in sorted(cache_counts.items()):
+        lines.append('{}{{property="{}",result="{}"}} {}'.format(CACHE_COUNTER, escape(name), result, n))
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,9 @@
 import collections
 import datetime
+import json
 import re
 import unicodedata
+from contextlib import contextmanager
 from urllib.parse import quote
 from datetime import timedelta
 import logging
@@ -10,10 +12,10 @@ from django import forms
 from django.core.exceptions import ValidationError
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import F, FilteredRelation, Q, Case, When, Count, Min
-from django.db.models.functions import Coalesce
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import F, FilteredRelation, Q, Case, When, Count, Max, Min, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
@@ -21,6 +23,7 @@ from django.utils.translation import gettext as _
 
 from django.db.models import JSONField  # Use this if you're using Django 3.1 or later and a supported database
 
+from puzzles import catalog, teamstate
 from puzzles.context import context_cache
 
 from puzzles.messaging import (
@@ -32,6 +35,7 @@ from puzzles.messaging import (
     show_unlock_notification,
     show_solve_notification,
     show_hint_notification,
+    send_bigboard_delta,
 )
 
 from puzzles.hunt_config import (
@@ -239,6 +243,13 @@ class Team(models.Model):
         help_text=_('A dictionary to store flexible data related to puzzle genshin game (r3q3).')
     )
 
+    # The team's PuzzleUnlocks are its unlock frontier, and this is the time
+    # until which they're known to be complete. Anything that can unlock more
+    # puzzles (a solve, an admin edit, the next time unlock) pushes this into
+    # the past, and the next read recomputes them. See compute_unlocks.
+    unlocks_valid_until = models.DateTimeField(
+        null=True, blank=True, editable=False, verbose_name=_('Unlocks valid until'))
+
     class Meta:
         verbose_name = '队伍'
         verbose_name_plural = '队伍'
@@ -246,6 +257,22 @@ class Team(models.Model):
     def __str__(self):
         return self.team_name
 
+    # (This has to take explicit arguments, or context_cache would turn it
+    # into a property.)
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        # unlocks_valid_until is only ever written with targeted UPDATEs, so
+        # that a handler saving a Team it loaded a while ago can't overwrite a
+        # concurrent expiry with its stale copy. (Fields that weren't loaded
+        # aren't written either, like Django does by default.)
+        if not self._state.adding and not force_insert and update_fields is None:
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'unlocks_valid_until'
+                and field.attname not in deferred
+            ]
+        super().save(force_insert, force_update, using, update_fields)
+
     def get_emails(self, with_names=False):
         return [
             ((member.email, str(member)) if with_names else member.email)
@@ -290,10 +317,10 @@ class Team(models.Model):
         return Team.leaderboard_teams(current_team, hide_hidden)
 
     @staticmethod
-    def leaderboard_teams(current_team, hide_hidden=True):
+    def leaderboard_entries(current_team, hide_hidden=True):
         '''
-        Returns a list of teams.
-        This depends on the viewing team for hidden teams.
+        Returns a queryset of LeaderboardEntries in team list order, suitable
+        for paginating. This depends on the viewing team for hidden teams.
         '''
 
         q = Q()
@@ -305,49 +332,56 @@ class Team(models.Model):
             q &= Q(is_hidden=False)
             if current_team:
                 # ...but always show current team, regardless of hidden status
-                q |= Q(id=current_team.id)
-
-        all_teams = Team.objects.filter(q, creation_time__lt=HUNT_END_TIME)
-
-        total_solves = collections.defaultdict(int)
-        meta_times = {}
-        for team_id, slug, time in AnswerSubmission.objects.filter(
-            used_free_answer=False, is_correct=True, submitted_datetime__lt=HUNT_END_TIME
-        ).values_list('team__id', 'puzzle__slug', 'submitted_datetime'):
-            total_solves[team_id] += 1
-            if slug == META_META_SLUG:
-                meta_times[team_id] = time
-
-        unsorted_teams = [{
-                'team_name': team.team_name,
-                'is_current': team == current_team,
-                'total_solves': total_solves[team.id],
-                'last_solve_time': team.last_solve_time or team.creation_time,
-                'metameta_solve_time': meta_times.get(team.id),
-                'team': team,
-                'team_member_joint_string': ', '.join([it.name for it in team.teammember_set.all()]),
-                'emails': team.emails,
-                # 'creation_time': team.creation_time.strftime('%m/%d %H:%M:%S'),
-                'creation_time': team.creation_time,
-            } for team in all_teams]
-        return sorted(
-            unsorted_teams,
-            key=lambda d: (
-                d['creation_time']
-            )
+                q |= Q(team_id=current_team.id)
+
+        return (
+            LeaderboardEntry.objects
+            .filter(q, creation_time__lt=HUNT_END_TIME)
+            .select_related('team')
+            .prefetch_related('team__teammember_set')
+            .order_by('creation_time', 'team_id')
         )
 
+    @staticmethod
+    def leaderboard_teams(current_team, hide_hidden=True, entries=None):
+        '''
+        Returns a list of teams, or of the teams in the given page of
+        leaderboard_entries.
+        This depends on the viewing team for hidden teams.
+        '''
+
+        if entries is None:
+            entries = Team.leaderboard_entries(current_team, hide_hidden)
+
+        return [{
+                'id': entry.team_id,
+                'team_name': entry.team.team_name,
+                'is_current': entry.team == current_team,
+                'total_solves': entry.total_solves,
+                'last_solve_time': entry.last_solve_time,
+                'metameta_solve_time': entry.metameta_solve_time,
+                'team': entry.team,
+                'team_member_joint_string': ', '.join([it.name for it in entry.team.teammember_set.all()]),
+                'emails': entry.team.emails,
+                # 'creation_time': team.creation_time.strftime('%m/%d %H:%M:%S'),
+                'creation_time': entry.creation_time,
+            } for entry in entries]
+
     def team(self):
         return self
 
+    def state(self):
+        # Submissions, hints, extra guesses and unlocks; see teamstate.py.
+        return teamstate.get_state(self.id)
+
     def asked_hints(self):
-        return tuple(self.hint_set.select_related('puzzle', 'puzzle__round'))
+        return tuple(self.state.objects(Hint))
 
     def num_hints_total(self):
         '''
         Compute the total number of hints (used + remaining) available to this team.
         '''
-        logger.info(f"self.now: {self.now}")
+        logger.debug('self.now: %s', self.now)
         if not HINTS_ENABLED or self.hunt_is_over:
             return 0
         # HACK dirty timezone process
@@ -372,7 +406,7 @@ class Team(models.Model):
                 count_evenings -= 1
             if self.now.hour < 8:  # not yet granted
                 count_evenings -= 1
-            logger.info(f"count_hints_by_time = {1 + 2 * (count_mornings + count_evenings)} = 1 + 2 * ({count_mornings} + {count_evenings})")
+            logger.debug('count_hints_by_time = 1 + 2 * (%d + %d)', count_mornings, count_evenings)
             # 1 granted on beginning, 2 per morning and 2 per evening
             count_hints_by_time = 1 + 2 * (count_mornings + count_evenings)
             count_hints_by_time = max(0, count_hints_by_time)
@@ -383,8 +417,9 @@ class Team(models.Model):
 
 
     def num_hints_used(self):
-        logger.info(f"{self.team_name} - num_hints_used: {sum(hint.consumes_hint for hint in self.asked_hints)}")
-        return sum(hint.consumes_hint for hint in self.asked_hints)
+        num_hints_used = sum(hint.consumes_hint for hint in self.asked_hints)
+        logger.debug('%s - num_hints_used: %d', self.team_name, num_hints_used)
+        return num_hints_used
 
     def num_hints_remaining(self):
         return self.num_hints_total - self.num_hints_used
@@ -419,15 +454,11 @@ class Team(models.Model):
     def extra_guesses(self):
         return {
             grant.puzzle.slug: grant.extra_guesses
-            for grant in self.extraguessgrant_set.select_related('puzzle')
+            for grant in self.state.objects(ExtraGuessGrant)
         }
 
     def submissions(self):
-        return tuple(
-            self.answersubmission_set
-            .select_related('puzzle', 'puzzle__round')
-            .order_by('-submitted_datetime')
-        )
+        return tuple(self.state.objects(AnswerSubmission))
 
     def solves(self):
         return {
@@ -439,8 +470,7 @@ class Team(models.Model):
     def db_unlocks(self):
         return {
             unlock.puzzle_id: unlock
-            for unlock in self.puzzleunlock_set
-            .select_related('puzzle', 'puzzle__round')
+            for unlock in self.state.objects(PuzzleUnlock)
         }
 
     def main_round_solves(self):
@@ -455,44 +485,106 @@ class Team(models.Model):
             global_solves += 1
         return (global_solves, local_solves)
 
+    @staticmethod
+    def time_unlock(context, puzzle):
+        '''When puzzle unlocks by time alone for this context, or None.'''
+        if 0 <= puzzle.unlock_hours and (
+            puzzle.unlock_hours == 0 or
+            not context.team or
+            context.team.allow_time_unlocks):
+            return context.start_time + datetime.timedelta(hours=puzzle.unlock_hours)
+        return None
+
     @staticmethod
     def compute_unlocks(context):
-        metas_solved = []
+        # A team playing the hunt has its unlocks persisted as PuzzleUnlocks,
+        # which we only recompute once something could have changed them.
+        # Everyone else can't trigger any writes, and what they see only
+        # depends on the clock, so it's cheap to work out on the fly.
+        team = context.team
+        if (team and context.hunt_has_started and
+            not context.hunt_is_prereleased and not context.hunt_is_over):
+            if team.unlocks_valid_until is None or team.unlocks_valid_until <= context.now:
+                Team.refresh_unlocks(context)
+            return collections.OrderedDict(
+                (puzzle, team.db_unlocks[puzzle.id].unlock_datetime)
+                for puzzle in context.all_puzzles
+                if puzzle.id in team.db_unlocks
+            )
+
         puzzles_unlocked = collections.OrderedDict()
-        unlocks = []
         for puzzle in context.all_puzzles:
             unlocked_at = None
-            if 0 <= puzzle.unlock_hours and (
-                puzzle.unlock_hours == 0 or
-                not context.team or
-                context.team.allow_time_unlocks):
-                unlock_time = context.start_time + datetime.timedelta(hours=puzzle.unlock_hours)
-                if unlock_time <= context.now:
-                    unlocked_at = unlock_time
+            unlock_time = Team.time_unlock(context, puzzle)
+            if unlock_time and unlock_time <= context.now:
+                unlocked_at = unlock_time
             if context.hunt_is_prereleased or context.hunt_is_over:
                 unlocked_at = context.start_time
-            elif context.team and context.hunt_has_started:
-                (global_solves, local_solves) = context.team.main_round_solves
-                if 0 <= puzzle.unlock_global <= global_solves and (global_solves or any(metas_solved)):
-                    unlocked_at = context.now
-                # fduph implements a Chinese-style unlock-by-round mechanism, though need local_unlock configure as well
-                _is_round_unlocked = puzzle.round.order == 0 or puzzle.round.order <= sum(metas_solved)
-                _is_puzzled_unlocked_by_round =( 0 <= puzzle.unlock_local <= local_solves[puzzle.round.slug])
-                if _is_round_unlocked and _is_puzzled_unlocked_by_round:
-                    unlocked_at = context.now
-                if puzzle.slug == META_META_SLUG and all(metas_solved):
-                    unlocked_at = context.now
-                if puzzle.is_meta:
-                    metas_solved.append(puzzle.id in context.team.solves)
-                if puzzle.id in context.team.db_unlocks:
-                    unlocked_at = context.team.db_unlocks[puzzle.id].unlock_datetime
-                elif unlocked_at:
-                    unlocks.append(Team.unlock_puzzle(context, puzzle, unlocked_at))
             if unlocked_at:
                 puzzles_unlocked[puzzle] = unlocked_at
+        return puzzles_unlocked
+
+    @staticmethod
+    def refresh_unlocks(context):
+        '''
+        Recompute the unlock frontier of the context's team, persist any new
+        PuzzleUnlocks, and record how long the result stays valid.
+        '''
+        team = context.team
+        valid_until = team.unlocks_valid_until
+        # Past this point the hunt is over for the team and everything is
+        # unlocked without consulting the database.
+        next_check = HUNT_END_TIME - team.start_offset
+        metas_solved = []
+        unlocks = []
+        (global_solves, local_solves) = team.main_round_solves
+        for puzzle in context.all_puzzles:
+            unlocked_at = None
+            unlock_time = Team.time_unlock(context, puzzle)
+            if unlock_time and unlock_time <= context.now:
+                unlocked_at = unlock_time
+            elif unlock_time:
+                next_check = min(next_check, unlock_time)
+            if 0 <= puzzle.unlock_global <= global_solves and (global_solves or any(metas_solved)):
+                unlocked_at = context.now
+            # fduph implements a Chinese-style unlock-by-round mechanism, though need local_unlock configure as well
+            _is_round_unlocked = puzzle.round.order == 0 or puzzle.round.order <= sum(metas_solved)
+            _is_puzzled_unlocked_by_round =( 0 <= puzzle.unlock_local <= local_solves[puzzle.round.slug])
+            if _is_round_unlocked and _is_puzzled_unlocked_by_round:
+                unlocked_at = context.now
+            if puzzle.slug == META_META_SLUG and all(metas_solved):
+                unlocked_at = context.now
+            if puzzle.is_meta:
+                metas_solved.append(puzzle.id in team.solves)
+            if unlocked_at and puzzle.id not in team.db_unlocks:
+                unlocks.append(Team.unlock_puzzle(context, puzzle, unlocked_at))
         if unlocks:
             PuzzleUnlock.objects.bulk_create(unlocks, ignore_conflicts=True)
-        return puzzles_unlocked
+            teamstate.invalidate([team.id])
+            for unlock in unlocks:
+                send_bigboard_delta('unlock', team, unlock.puzzle_id)
+
+        # Only record the result if nothing expired it while we were working;
+        # otherwise the next read has to look again.
+        current = Team.objects.filter(id=team.id)
+        if valid_until is None:
+            current = current.filter(unlocks_valid_until__isnull=True)
+        else:
+            current = current.filter(unlocks_valid_until=valid_until)
+        current.update(unlocks_valid_until=next_check)
+        team.unlocks_valid_until = next_check
+
+    @staticmethod
+    def expire_unlocks(teams=None):
+        '''
+        Mark the unlocks of the given teams (a queryset or list of ids; all
+        teams by default) as needing to be recomputed.
+        '''
+        if teams is None:
+            teams = Team.objects.all()
+        elif not isinstance(teams, models.QuerySet):
+            teams = Team.objects.filter(id__in=teams)
+        teams.update(unlocks_valid_until=timezone.now())
 
     @staticmethod
     def unlock_puzzle(context, puzzle, unlocked_at):
@@ -507,12 +599,34 @@ class Team(models.Model):
 
 
 @receiver(post_save, sender=Team)
-def notify_on_team_creation(sender, instance, created, **kwargs):
-    pass
+def notify_on_team_creation(sender, instance, created, update_fields, **kwargs):
+    if created:
+        LeaderboardEntry.objects.create(
+            team=instance,
+            is_hidden=instance.is_hidden,
+            creation_time=instance.creation_time,
+            last_solve_time=instance.creation_time,
+        )
+    elif update_fields is None or {'is_hidden', 'creation_time'} & set(update_fields):
+        # Only touches the row if either copied field actually changed.
+        LeaderboardEntry.objects.filter(team=instance).exclude(
+            is_hidden=instance.is_hidden,
+            creation_time=instance.creation_time,
+        ).update(
+            is_hidden=instance.is_hidden,
+            creation_time=instance.creation_time,
+        )
     # if created:
     #     dispatch_general_alert(_('Team created: {}').format(instance.team_name))
 
 
+@receiver(post_save, sender=Round)
+@receiver(post_save, sender=Puzzle)
+def expire_unlocks_on_puzzle_update(sender, instance, **kwargs):
+    # Unlock requirements may have changed for everyone.
+    Team.expire_unlocks()
+
+
 class TeamMember(models.Model):
     '''A person on a team.'''
 
@@ -557,6 +671,11 @@ class PuzzleUnlock(models.Model):
         verbose_name_plural = '解锁'
 
 
+@receiver(post_delete, sender=PuzzleUnlock)
+def expire_unlocks_on_unlock_deletion(sender, instance, **kwargs):
+    Team.expire_unlocks([instance.team_id])
+
+
 class AnswerSubmission(models.Model):
     '''Represents a team making a solve attempt on a puzzle (right or wrong).'''
 
@@ -579,11 +698,146 @@ class AnswerSubmission(models.Model):
         verbose_name = '提交答案'
         verbose_name_plural = '提交答案'
 
+    def counts_for_leaderboard(self):
+        return (
+            self.is_correct and not self.used_free_answer and
+            self.submitted_datetime < HUNT_END_TIME
+        )
+
+
+class LeaderboardEntry(models.Model):
+    '''
+    A team's standing, kept up to date as answers come in, so that listing
+    teams or finding one team's rank doesn't have to go through every
+    submission. Only solves during the hunt count, and free answers don't.
+    '''
+
+    team = models.OneToOneField(
+        Team, on_delete=models.CASCADE, related_name='leaderboard_entry', verbose_name='队伍')
+
+    # Copied from the team so the list and rank queries don't need a join.
+    is_hidden = models.BooleanField(default=False, verbose_name=_('Hidden'))
+    creation_time = models.DateTimeField(verbose_name=_('Creation time'))
+
+    total_solves = models.IntegerField(default=0, verbose_name=_('Total solves'))
+    metameta_solve_time = models.DateTimeField(
+        null=True, blank=True, verbose_name=_('Metameta solve time'))
+    # The team's creation time if it hasn't solved anything yet.
+    last_solve_time = models.DateTimeField(verbose_name=_('Last solve time'))
+
+    class Meta:
+        verbose_name = '排行'
+        verbose_name_plural = '排行'
+        indexes = [
+            models.Index(
+                fields=['is_hidden', 'metameta_solve_time', '-total_solves', 'last_solve_time'],
+                name='leaderboard_rank_idx',
+            ),
+            models.Index(fields=['is_hidden', 'creation_time'], name='leaderboard_list_idx'),
+        ]
+
+    def __str__(self):
+        return '%s: %s' % (self.team, self.total_solves)
+
+    def rank(self):
+        '''
+        1 + the number of visible teams strictly ahead of this one, ordering
+        by metameta solve time, then number of solves, then last solve time.
+        '''
+        if self.metameta_solve_time:
+            ahead = Q(metameta_solve_time__lt=self.metameta_solve_time)
+            tied = Q(metameta_solve_time=self.metameta_solve_time)
+        else:
+            ahead = Q(metameta_solve_time__isnull=False)
+            tied = Q(metameta_solve_time__isnull=True)
+        ahead |= tied & (
+            Q(total_solves__gt=self.total_solves) |
+            Q(total_solves=self.total_solves, last_solve_time__lt=self.last_solve_time)
+        )
+        return LeaderboardEntry.objects.filter(
+            ahead, is_hidden=False, creation_time__lt=HUNT_END_TIME).count() + 1
+
+    @staticmethod
+    def solve_stats(teams=None):
+        solves = AnswerSubmission.objects.filter(
+            used_free_answer=False, is_correct=True, submitted_datetime__lt=HUNT_END_TIME)
+        if teams is not None:
+            solves = solves.filter(team__in=teams)
+        return solves.values('team_id').annotate(
+            total_solves=Count('id'),
+            last_solve_time=Max('submitted_datetime'),
+            metameta_solve_time=Max(
+                'submitted_datetime', filter=Q(puzzle__slug=META_META_SLUG)),
+        )
+
+    @staticmethod
+    def record_solve(submission):
+        '''Count a newly created submission towards its team's standing.'''
+        if not submission.counts_for_leaderboard():
+            return
+        solve_time = Value(submission.submitted_datetime, output_field=models.DateTimeField())
+        updates = {
+            'total_solves': F('total_solves') + 1,
+            'last_solve_time': Greatest('last_solve_time', solve_time),
+        }
+        if submission.puzzle.slug == META_META_SLUG:
+            updates['metameta_solve_time'] = Coalesce('metameta_solve_time', solve_time)
+        if not LeaderboardEntry.objects.filter(team_id=submission.team_id).update(**updates):
+            # The team predates the leaderboard table.
+            LeaderboardEntry.rebuild([submission.team_id])
+
+    @staticmethod
+    def refresh(team_id):
+        '''
+        Recount a team's standing from scratch, after a submission was edited
+        or deleted. Does nothing if the team has no entry (e.g. because it's
+        being deleted).
+        '''
+        stats = LeaderboardEntry.solve_stats([team_id]).first() or {}
+        LeaderboardEntry.objects.filter(team_id=team_id).update(
+            total_solves=stats.get('total_solves', 0),
+            last_solve_time=stats.get('last_solve_time') or F('creation_time'),
+            metameta_solve_time=stats.get('metameta_solve_time'),
+        )
+
+    @staticmethod
+    def rebuild(teams=None):
+        '''
+        Recreate the entries of the given teams (Teams or ids, default all) from
+        their submissions.
+        '''
+        team_query = Team.objects.all()
+        if teams is not None:
+            team_query = team_query.filter(id__in=teams)
+        stats = {row['team_id']: row for row in LeaderboardEntry.solve_stats(teams)}
+        entries = []
+        for team in team_query.only('id', 'is_hidden', 'creation_time'):
+            row = stats.get(team.id, {})
+            entries.append(LeaderboardEntry(
+                team=team,
+                is_hidden=team.is_hidden,
+                creation_time=team.creation_time,
+                total_solves=row.get('total_solves', 0),
+                metameta_solve_time=row.get('metameta_solve_time'),
+                last_solve_time=row.get('last_solve_time') or team.creation_time,
+            ))
+        with transaction.atomic():
+            LeaderboardEntry.objects.filter(team__in=team_query).delete()
+            LeaderboardEntry.objects.bulk_create(entries, batch_size=500)
+        return len(entries)
+
 
 
 @receiver(post_save, sender=AnswerSubmission)
 def notify_on_answer_submission(sender, instance, created, **kwargs):
+    if not created:
+        # Presumably an admin changed it by hand.
+        LeaderboardEntry.refresh(instance.team_id)
     if created:
+        send_bigboard_delta(
+            'free' if instance.used_free_answer else
+            'solve' if instance.is_correct else 'guess',
+            instance.team, instance.puzzle_id)
         now = timezone.localtime()
         def format_time_ago(timestamp):
             if not timestamp:
@@ -637,6 +891,8 @@ def notify_on_answer_submission(sender, instance, created, **kwargs):
             #     correct=instance.is_correct)
         if not instance.is_correct:
             return
+        Team.expire_unlocks([instance.team_id])
+        LeaderboardEntry.record_solve(instance)
         show_solve_notification(instance)
         obsoleted_hints = Hint.objects.filter(
             team=instance.team,
@@ -651,6 +907,11 @@ def notify_on_answer_submission(sender, instance, created, **kwargs):
             hint.save()
 
 
+@receiver(post_delete, sender=AnswerSubmission)
+def update_leaderboard_on_answer_deletion(sender, instance, **kwargs):
+    LeaderboardEntry.refresh(instance.team_id)
+
+
 class ExtraGuessGrant(models.Model):
     '''Extra guesses granted to a particular team.'''
 
@@ -670,6 +931,152 @@ class ExtraGuessGrant(models.Model):
         verbose_name_plural ='额外回答次数'
 
 
+class PuzzleGameState(models.Model):
+    '''
+    A team's progress in an interactive puzzle, as stored by its handler in
+    puzzlehandlers/. Keeping these out of the Team row means a handler only
+    writes its own state, and that state isn't loaded on every request.
+    '''
+
+    team = models.ForeignKey(Team, on_delete=models.CASCADE, related_name='game_states', verbose_name='队伍')
+    # The slug of the puzzle whose handler owns this state.
+    puzzle = models.CharField(max_length=255, verbose_name='题目')
+    data = JSONField(default=dict, verbose_name=_('Data'))
+    # Bumped by every save, which only goes through if nobody else has saved
+    # in the meantime. (Row locks cover this on databases that have them.)
+    version = models.PositiveIntegerField(default=0, editable=False, verbose_name=_('Version'))
+    # Which version of its handler's format the data is in; see GAMES.
+    schema_version = models.PositiveSmallIntegerField(default=0, verbose_name=_('Schema version'))
+    modified_time = models.DateTimeField(auto_now=True, verbose_name=_('Modified time'))
+
+    Game = collections.namedtuple('Game', ('default', 'legacy_field', 'schema_version'))
+    # puzzle slug -> Game(function returning a new state, Team field the state
+    # used to be kept in if any, current schema version). States are copied
+    # from the legacy field the first time, as schema version 0. When a
+    # handler changes its format, it should bump the version here and
+    # register a function to upgrade old states with @upgrade. Every state is
+    # upgraded once, the first time it's read, or in bulk with
+    # `./manage.py upgrade_game_state`.
+    GAMES = {
+        'r2q8': Game(get_default_puzzle_bingo_game_data, 'puzzle_bingo_game_data', 1),
+        # The draws themselves are GachaDraws.
+        'r3q3': Game(lambda: {'draws': 0}, 'puzzle_genshin_game_data', 1),
+    }
+    LEGACY_FIELDS = tuple(game.legacy_field for game in GAMES.values() if game.legacy_field)
+    # (puzzle slug, schema version) -> function(team, data) returning the
+    # data upgraded from the previous version
+    UPGRADES = {}
+
+    class Conflict(Exception):
+        pass
+
+    def __str__(self):
+        return '%s: %s' % (self.team, self.puzzle)
+
+    class Meta:
+        unique_together = ('team', 'puzzle')
+        verbose_name = _('puzzle game state')
+        verbose_name_plural = _('puzzle game states')
+
+    @classmethod
+    def game(cls, puzzle):
+        return cls.GAMES.get(puzzle, cls.Game(dict, None, 0))
+
+    @classmethod
+    def upgrade(cls, puzzle, schema_version):
+        def decorator(fn):
+            cls.UPGRADES[(puzzle, schema_version)] = fn
+            return fn
+        return decorator
+
+    @classmethod
+    def initial_data(cls, team, puzzle):
+        '''Returns the data and schema version for a team's new state.'''
+        game = cls.game(puzzle)
+        if game.legacy_field:
+            data = Team.objects.filter(id=team.id).values_list(game.legacy_field, flat=True).first()
+            # Teams that never played still have the field's default, which
+            # isn't worth upgrading.
+            unplayed = json.dumps(Team._meta.get_field(game.legacy_field).get_default())
+            if data and json.dumps(data) != unplayed:
+                return (data, 0)
+        return (game.default(), game.schema_version)
+
+    @classmethod
+    def get_data(cls, team, puzzle):
+        '''
+        Returns the team's state for reading. This doesn't write anything,
+        unless the state needs upgrading.
+        '''
+        row = cls.objects.filter(team=team, puzzle=puzzle).values_list('data', 'schema_version').first()
+        (data, schema_version) = row or cls.initial_data(team, puzzle)
+        if schema_version == cls.game(puzzle).schema_version:
+            return data
+        with cls.locked(team, puzzle) as state:
+            return state.data
+
+    @classmethod
+    @contextmanager
+    def locked(cls, team, puzzle):
+        '''
+        Loads the team's state for modifying. Change the data of the yielded
+        object in place or replace it; it's saved at the end of the block if
+        anything changed, and nobody else can change it in between.
+        '''
+        with transaction.atomic():
+            states = cls.objects.select_for_update().filter(team=team, puzzle=puzzle)
+            state = states.first()
+            if state is None:
+                (data, schema_version) = cls.initial_data(team, puzzle)
+                cls.objects.get_or_create(
+                    team=team, puzzle=puzzle,
+                    defaults={'data': data, 'schema_version': schema_version})
+                state = states.get()
+            original = (json.dumps(state.data), state.schema_version)
+            state.upgrade_schema(team)
+            yield state
+            if (json.dumps(state.data), state.schema_version) != original:
+                state.save_data()
+
+    def upgrade_schema(self, team):
+        while self.schema_version < self.game(self.puzzle).schema_version:
+            self.schema_version += 1
+            self.data = self.UPGRADES[(self.puzzle, self.schema_version)](team, self.data)
+
+    def save_data(self):
+        updated = PuzzleGameState.objects.filter(id=self.id, version=self.version).update(
+            data=self.data, schema_version=self.schema_version,
+            version=F('version') + 1, modified_time=timezone.now())
+        if not updated:
+            raise PuzzleGameState.Conflict(str(self))
+        self.version += 1
+
+
+class GachaDraw(models.Model):
+    '''
+    One item drawn in the gacha puzzle (r3q3). Teams' draws are only ever
+    appended, numbered from 1 in the order they were drawn.
+    '''
+
+    KINDS = ('错乱诗', '多频段', '概率数', '高斯钟', '观测窗')
+
+    team = models.ForeignKey(Team, on_delete=models.CASCADE, verbose_name='队伍')
+    number = models.PositiveIntegerField(verbose_name=_('Number'))
+    kind = models.PositiveSmallIntegerField(choices=list(enumerate(KINDS)), verbose_name=_('Kind'))
+    text = models.CharField(max_length=64, verbose_name=_('Text'))
+
+    def __str__(self):
+        return '%s #%d: %s' % (self.team, self.number, self.text)
+
+    class Meta:
+        unique_together = ('team', 'number')
+        verbose_name = _('gacha draw')
+        verbose_name_plural = _('gacha draws')
+
+    def as_item(self):
+        return {self.text: self.KINDS[self.kind]}
+
+
 
 class PuzzleMessage(models.Model):
     '''A "keep going" message shown on submitting a specific wrong answer.'''
@@ -697,6 +1104,16 @@ class PuzzleMessage(models.Model):
         return ''.join([c.upper() for c in nfkd_form if c.isalnum()])
 
 
+@receiver(post_save, sender=Round)
+@receiver(post_delete, sender=Round)
+@receiver(post_save, sender=Puzzle)
+@receiver(post_delete, sender=Puzzle)
+@receiver(post_save, sender=PuzzleMessage)
+@receiver(post_delete, sender=PuzzleMessage)
+def invalidate_catalog(sender, instance, **kwargs):
+    catalog.invalidate()
+
+
 class Erratum(models.Model):
     '''An update made to the hunt while it's running that should be announced.'''
 
@@ -927,4 +1344,20 @@ def notify_on_hint_update(sender, instance, created, update_fields, **kwargs):
             #     {'hint': instance, 'link': link},
             #     instance.recipients())
             show_hint_notification(instance)
+            if instance.status == Hint.ANSWERED and not instance.is_followup:
+                send_bigboard_delta('hint', instance.team, instance.puzzle_id)
+
+
 
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+@receiver(post_save, sender=AnswerSubmission)
+@receiver(post_delete, sender=AnswerSubmission)
+@receiver(post_save, sender=Hint)
+@receiver(post_delete, sender=Hint)
+@receiver(post_save, sender=ExtraGuessGrant)
+@receiver(post_delete, sender=ExtraGuessGrant)
+@receiver(post_save, sender=PuzzleUnlock)
+@receiver(post_delete, sender=PuzzleUnlock)
+def invalidate_team_state(sender, instance, **kwargs):
+    teamstate.invalidate([instance.id if sender is Team else instance.team_id])
@@ -2,10 +2,11 @@ import json
 from functools import wraps
 
 from django.http import HttpResponse
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_http_methods, require_POST
 
 from ratelimit.decorators import ratelimit
-from ratelimit.utils import get_usage_count
+
+from puzzles.throttle import TokenBucket, add_header
 
 # Example usage:
 from . import interactive_demo, r2q8, r3q3
@@ -30,46 +31,47 @@ def simple_ratelimit(handler, rate):
         return HttpResponse(handler(request))
     return rate_limiter
 
-def check_ratelimit(request, rate):
-    data = get_usage_count(request, group=request.path, rate=rate, key='user_or_ip')
-    return data['count'] >= data['limit']
-
-def update_ratelimit(request, rate):
-    get_usage_count(request, group=request.path, rate=rate, key='user_or_ip', increment=True)
-
-def error_ratelimit(handler, rate, error, check_response=None, encode_response=None):
+def error_ratelimit(handler, rate, error, check_response=None, encode_response=None, burst=None, methods=('POST',)):
     '''
-    A handler that checks and reports errors to the client.
+    A handler that checks and reports errors to the client. The limit is a
+    token bucket per team (see puzzles/throttle.py) that allows bursts of
+    burst requests, by default the count in rate, and the response says how
+    many are left in an X-RateLimit-Remaining header.
 
     error should be a message, in the same format (HTML, JSON, etc.) as the
     data that handler would return, that can be interpreted in the browser to
     tell the user what's going on.
 
     This decorator is designed so that if the user is not currently blocked,
-    you can run the handler and use its output to decide whether to increment
-    the rate limit counter or not. For example, you might only count incorrect
-    guesses towards the limit. If you don't care about this, don't pass
+    you can run the handler and use its output to decide whether the request
+    counts towards the limit or not: if check_response returns true, its
+    token is given back. For example, you might only count incorrect guesses
+    towards the limit. If you don't care about this, don't pass
     check_response.
 
     encode_response is run on either error or the handler output. This lets you
     for example use Python dicts for error, handler, and check_response, while
-    still serializing to JSON in the end.
+    still serializing to JSON in the end. A handler can also return a whole
+    HttpResponse, which is sent as is.
+
+    methods are the HTTP methods allowed, by default just POST.
     '''
-    @require_POST
+    bucket = TokenBucket(handler.__module__ + '.' + handler.__name__, rate, burst)
+
+    @require_http_methods(methods)
     @wraps(handler)
     def rate_limiter(request):
-        if check_ratelimit(request, rate):
+        if not bucket.take(request):
             response = error
-            update_ratelimit(request, rate)
         else:
-            if check_response is None:
-                update_ratelimit(request, rate)
             response = handler(request)
-            if check_response is not None and not check_response(response):
-                update_ratelimit(request, rate)
-        if encode_response is not None:
-            response = encode_response(response)
-        return HttpResponse(response)
+            if check_response is not None and check_response(response):
+                bucket.refund(request)
+        if not isinstance(response, HttpResponse):
+            if encode_response is not None:
+                response = encode_response(response)
+            response = HttpResponse(response)
+        return add_header(request, response)
     return rate_limiter
 
 
@@ -77,12 +79,12 @@ def error_ratelimit(handler, rate, error, check_response=None, encode_response=N
 # See https://django-ratelimit.readthedocs.io/en/stable/rates.html for the rate
 # limit string.
 
-# FIXME check why this is not working
+# Every submission counts: the handlers answer 'correct' to almost everything.
 r2q8_submit = error_ratelimit(
     r2q8.submit, 
-    '1/m', 
+    '60/m', 
     {'error': '我们当前限制本题的提交频率为每分钟60次。如果你认为频率限制过于严格，请联系管理员。'}, 
-    lambda response: response['correct'], 
+    None, 
     json.dumps
 )
 
@@ -90,6 +92,17 @@ r3q3_submit = error_ratelimit(
     r3q3.submit, 
     '30/m', 
     {'error': '我们当前限制本题的提交频率为每分钟30次。如果你认为频率限制过于严格，请联系管理员。'}, 
-    lambda response: response['correct'], 
+    None, 
     json.dumps
 )
+
+# Paging back through the draw history reads the database, so it's limited
+# too, though more loosely.
+r3q3_history = error_ratelimit(
+    r3q3.history,
+    '60/m',
+    {'error': '我们当前限制抽取历史的查询频率为每分钟60次。请稍后再试。', 'items': [], 'before': None},
+    None,
+    json.dumps,
+    methods=('GET',),
+)
@@ -0,0 +1,165 @@
+# Word lists and dictionaries for the puzzle handlers, stored as sorted string
+# tables that are memory-mapped rather than parsed into Python sets and dicts.
+# Each table is packed into a file next to its source at deploy time (by the
+# pack_tables command), so importing a handler costs nothing and all the
+# workers on a server share the same pages. If a packed file is missing or
+# older than its source, the table is parsed and packed in memory instead,
+# which works but costs each worker the time and memory packing avoids.
+#
+# A packed file has a magic string, then the number of rows and columns as
+# uint32s, then for each column the row count + 1 offsets of its strings (as
+# uint32s from the start of the file), then the UTF-8 strings. Numbers are in
+# native byte order, since the files are only read where they're packed. Rows
+# are sorted by their first column, which is what lookups bisect on.
+import logging
+import mmap
+from collections.abc import Sequence
+import os
+import struct
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+MAGIC = b'PACKED1\n'
+HEADER = struct.Struct('=8sII')
+
+logger = logging.getLogger(__name__)
+
+
+def pack_bytes(rows: Iterable[Tuple[str, ...]], columns: int) -> bytes:
+    rows = sorted(set(rows))
+    blobs = [[row[column].encode() for row in rows] for column in range(columns)]
+    offset = HEADER.size + 4 * columns * (len(rows) + 1)
+    offsets = []
+    for column in blobs:
+        for blob in column:
+            offsets.append(offset)
+            offset += len(blob)
+        offsets.append(offset)
+    return b''.join([
+        HEADER.pack(MAGIC, len(rows), columns),
+        struct.pack('=%dI' % len(offsets), *offsets),
+        *(b''.join(column) for column in blobs),
+    ])
+
+
+def pack(path: str, rows: Iterable[Tuple[str, ...]], columns: int) -> None:
+    data = pack_bytes(rows, columns)
+    # Write to a file of our own and rename it, in case a server is reading
+    # the old one.
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+
+
+class PackedTable:
+    def __init__(self, data: bytes, name: str = 'table'):
+        self.data = data
+        (magic, self.rows, self.columns) = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError('{} is not a packed table'.format(name))
+        self.offsets = memoryview(self.data)[HEADER.size:HEADER.size + 4 * self.columns * (self.rows + 1)].cast('I')
+
+    @classmethod
+    def open(cls, path: str) -> 'PackedTable':
+        with open(path, 'rb') as fp:
+            return cls(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ), path)
+
+    def raw(self, column: int, i: int) -> bytes:
+        i += column * (self.rows + 1)
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def find(self, key: str) -> Optional[int]:
+        'Returns the row whose first column is key, if any.'
+        key = key.encode()
+        (lo, hi) = (0, self.rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(0, mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.rows and self.raw(0, lo) == key:
+            return lo
+        return None
+
+
+class PackedWords(Sequence):
+    'A sorted, read-only set of strings that can also be indexed like a list.'
+
+    def __init__(self, table: PackedTable):
+        self.table = table
+
+    def __len__(self) -> int:
+        return self.table.rows
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < self.table.rows:
+            raise IndexError(i)
+        return self.table.raw(0, i).decode()
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+    def __contains__(self, word) -> bool:
+        return isinstance(word, str) and self.table.find(word) is not None
+
+    def find(self, word: str) -> Optional[int]:
+        return self.table.find(word)
+
+
+class PackedDict:
+    'A read-only dict from strings to strings.'
+
+    def __init__(self, table: PackedTable):
+        self.table = table
+
+    def __len__(self) -> int:
+        return self.table.rows
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self.table.find(key) is not None
+
+    def __getitem__(self, key: str) -> str:
+        i = self.table.find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.table.raw(1, i).decode()
+
+    def get(self, key: str, default=None):
+        i = self.table.find(key) if isinstance(key, str) else None
+        return default if i is None else self.table.raw(1, i).decode()
+
+    def keys(self) -> PackedWords:
+        return PackedWords(self.table)
+
+
+def packed_path(name: str) -> str:
+    return name + '.packed'
+
+
+def load(name: str, sources: List[str], read: Callable[[], Iterable[Tuple[str, ...]]], columns: int = 1) -> PackedTable:
+    '''
+    Returns the table packed at packed_path(name), or if it's missing or older
+    than any of the sources, packs the rows from read() in memory. Nothing is
+    written here; see build().
+    '''
+    path = packed_path(name)
+    try:
+        if os.path.getmtime(path) >= max(map(os.path.getmtime, sources)):
+            return PackedTable.open(path)
+        logger.warning('Stale packed table at %s, parsing %s in memory', path, name)
+    except (OSError, ValueError):
+        logger.warning('No packed table at %s, parsing %s in memory', path, name)
+    return PackedTable(pack_bytes(read(), columns), name)
+
+
+def build(name: str, sources: List[str], read: Callable[[], Iterable[Tuple[str, ...]]], columns: int = 1) -> str:
+    '''Packs the rows from read() into packed_path(name), and returns that path.'''
+    path = packed_path(name)
+    pack(path, read(), columns)
+    return path
+
+
+def read_lines(source: str) -> List[Tuple[str]]:
+    with open(source) as fp:
+        return [(line,) for line in fp.read().split('\n')]
@@ -1,16 +1,23 @@
+import bisect
+import functools
+import hashlib
 import json
 import logging
+import mmap
+import os
 import random
 import re
+import struct
 import traceback
-from typing import Tuple, Dict, List, Callable
+from typing import Tuple, Dict, List, Callable, Optional, Sequence
 from collections import OrderedDict
 
 from django.views.decorators.http import require_POST
 
 from puzzles.messaging import log_puzzle_info
-from ..models import Team
-from .r2q8_data import SPOIL_TEXT, IPA_DICT, CHEMICAL_ELEMENTS, VOWELS, WORD_SET, ADJ_SET, ANIMAL_SET, COUNTRY_SET
+from ..models import PuzzleGameState
+from . import r2q8_data
+from .r2q8_data import SPOIL_TEXT, CHEMICAL_ELEMENTS, VOWELS, COUNTRY_SET
 
 logger = logging.getLogger(__name__)
 SPOIL_COST = 50
@@ -19,6 +26,18 @@ COIN_REWARD = 5
 
 MILESTONE = "DIYBINGOCARD"
 
+# Built by `./manage.py build_r2q8_masks`; see compiled_rules() below.
+MASKS_PATH = os.path.join(os.path.dirname(__file__), 'r2q8_masks.bin')
+MASKS_MAGIC = b'R2Q8MSK2'
+# Part of the masks' digest, so that masks built for other rules are ignored.
+# Bump it whenever you change what any rule's checker (or anything it calls)
+# returns for some word.
+RULES_VERSION = 1
+# Data the rules read besides the dictionary, which is also in the digest.
+RULES_DATA = [os.path.join(r2q8_data.DATA_DIR, name) for name in ('adjectives.txt', 'animals.txt', 'ipa.json')]
+
+COUNTRY_NAMES = frozenset(country.replace(' ', '').replace('-', '').upper() for country in COUNTRY_SET)
+
 
 # utils
 def clear_word(word: str):
@@ -41,7 +60,7 @@ def has_duplicate_letters(word: str) -> bool:
 def can_form_word_by_removing_one_letter(word: str) -> bool:
     for i in range(len(word)):
         new_word = word[:i] + word[i + 1:]
-        if new_word in WORD_SET:
+        if new_word in r2q8_data.WORD_SET:
             return True
     return False
 
@@ -53,17 +72,19 @@ def is_component_word(word: str) -> bool:
     for i in range(2, len(word) - 2):
         prefix = word[:i]
         suffix = word[i:]
-        if prefix in WORD_SET and suffix in WORD_SET:
+        if prefix in r2q8_data.WORD_SET and suffix in r2q8_data.WORD_SET:
             return True
     return False
 
+@functools.lru_cache(maxsize=None)
+def five_letter_words() -> frozenset:
+    return frozenset(word for word in r2q8_data.WORD_SET if len(word) == 5)
+
 def contains_five_letter_word(word: str) -> bool:
     if len(word) < 6:
         return False
-    for dict_word in WORD_SET:
-        if len(dict_word) == 5 and dict_word in word:
-            return True
-    return False
+    five_letter = five_letter_words()
+    return any(word[i:i + 5] in five_letter for i in range(len(word) - 4))
 
 def is_alternating_vowel_consonant(word: str) -> bool:
     for i in range(len(word) - 1):
@@ -85,10 +106,7 @@ def get_n_closed_region(word: str) -> int:
     return total_regions
 
 def is_country_name(word: str) -> bool:
-    for country in COUNTRY_SET:
-        if country.replace(' ', '').replace('-', '').upper() == word:
-            return True
-    return False
+    return word in COUNTRY_NAMES
 
 def get_match_deg(word: str, line: str) -> int:
     return sum(1 for letter in word if letter in line.upper())
@@ -120,26 +138,26 @@ def has_almost_line(word: str) -> bool:
     return n_almost_line == 1
 
 RULES_LIST: List[Tuple[int, str, Callable[[str], bool]]] = [
-    (0,  '含有音标/ɪ/', lambda word: bool(word in IPA_DICT and 'ɪ' in IPA_DICT[word])),
+    (0,  '含有音标/ɪ/', lambda word: bool(word in r2q8_data.IPA_DICT and 'ɪ' in r2q8_data.IPA_DICT[word])),
     (1,  '化学元素',    lambda word: bool(word in CHEMICAL_ELEMENTS)),
     (2,  '偶数长度',    lambda word: bool(len(word) % 2 == 0)),
     (3,  '含有E和L',    lambda word: bool('E' in word and 'L' in word)),
     (4,  '长度为6',     lambda word: bool(len(word) == 6)),
     (5,  'ED结尾',     lambda word: bool(word.endswith('ED'))),
     (6,  '含有L',       lambda word: bool('L' in word)),
-    (7,  '哑音B',      lambda word: bool(word in IPA_DICT and count(IPA_DICT[word], 'b') < count(word.replace(r'(.)\1+', r'\1'), 'B'))),
+    (7,  '哑音B',      lambda word: bool(word in r2q8_data.IPA_DICT and count(r2q8_data.IPA_DICT[word], 'b') < count(word.replace(r'(.)\1+', r'\1'), 'B'))),
     (8,  '含有I',      lambda word: bool('I' in word)),
     (9,  '去1字母成词', lambda word: can_form_word_by_removing_one_letter(word)),
     (10, '含有Y',      lambda word: bool('Y' in word)),
     (11, '含有M',      lambda word: bool('M' in word)),
-    (12, '形容词',     lambda word: bool(word in ADJ_SET)),
+    (12, '形容词',     lambda word: bool(word in r2q8_data.ADJ_SET)),
     (13, '合成词',     lambda word: is_component_word(word)),
     (14, '含有5字母词', lambda word: contains_five_letter_word(word)),
     (15, '元辅音相间', lambda word: is_alternating_vowel_consonant(word)),
     (16, '大写字母有2个封闭区域', lambda word: get_n_closed_region(word) == 2),
     (17, '含有N',      lambda word: bool('N' in word)),
     (18, '辅音比元音多1个', lambda word: len([char for char in word if char not in VOWELS]) - len([char for char in word if char in VOWELS]) == 1),
-    (19, '动物',       lambda word: bool(word in ANIMAL_SET)),
+    (19, '动物',       lambda word: bool(word in r2q8_data.ANIMAL_SET)),
     (20, '含有T',      lambda word: bool('T' in word)),
     (21, '3个元音',    lambda word: len([char for char in word if char in VOWELS]) == 3),
     (22, '长度7或8',   lambda word: bool(len(word) in (7, 8))),
@@ -149,24 +167,132 @@ RULES_LIST: List[Tuple[int, str, Callable[[str], bool]]] = [
     (26, '恰在一条线上差一点BIJNGO', lambda word: has_almost_line(word)),
 ]
 
+# Evaluating every rule costs tens of microseconds a word, so we precompute
+# which rules each dictionary word triggers as a bitmask (bit i for rule i),
+# and for each rule the list of words that trigger it, for samples. These are
+# stored in a file of little-endian uint32s:
+#
+#     magic, digest of RULES_VERSION, RULES_DATA, the rule names and words
+#     one mask per word, in sorted dictionary order
+#     len(RULES_LIST) + 1 offsets into the word ids below
+#     ids (indices in the sorted dictionary) of the words triggering each rule
+#
+# so that a stale file is ignored. It's mapped into memory, so forked workers
+# share it. Without the file, rules are just evaluated when needed.
+def evaluate_rules(word: str) -> int:
+    mask = 0
+    for (idx, _name, checker) in RULES_LIST:
+        if checker(word):
+            mask |= 1 << idx
+    return mask
+
+def dictionary_words() -> Sequence[str]:
+    return r2q8_data.WORD_SET
+
+def masks_header(words: List[str]) -> bytes:
+    digest = hashlib.sha256()
+    digest.update('{}\n'.format(RULES_VERSION).encode())
+    for path in RULES_DATA:
+        with open(path, 'rb') as fp:
+            digest.update(hashlib.sha256(fp.read()).digest())
+    for (_idx, name, _checker) in RULES_LIST:
+        digest.update(name.encode() + b'\n')
+    digest.update('\n'.join(words).encode())
+    return MASKS_MAGIC + digest.digest()
+
+def build_masks(path: str = MASKS_PATH) -> int:
+    words = dictionary_words()
+    masks = [evaluate_rules(word) for word in words]
+    ids = [[i for (i, mask) in enumerate(masks) if mask >> idx & 1] for (idx, _name, _checker) in RULES_LIST]
+    offsets = [0]
+    for rule_ids in ids:
+        offsets.append(offsets[-1] + len(rule_ids))
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(masks_header(words))
+        for numbers in (masks, offsets, *ids):
+            fp.write(struct.pack('<%dI' % len(numbers), *numbers))
+    os.replace(path + '.tmp', path)
+    return len(words)
+
+class CompiledRules:
+    def __init__(self, words: List[str], data: bytes):
+        self.words = words
+        self.data = data
+        self.masks_start = len(masks_header([]))
+        self.offsets_start = self.masks_start + 4 * len(words)
+        self.ids_start = self.offsets_start + 4 * (len(RULES_LIST) + 1)
+
+    def uint(self, start: int, i: int) -> int:
+        return struct.unpack_from('<I', self.data, start + 4 * i)[0]
+
+    def mask(self, word: str) -> Optional[int]:
+        i = bisect.bisect_left(self.words, word)
+        if i < len(self.words) and self.words[i] == word:
+            return self.uint(self.masks_start, i)
+        return None
+
+    def sample(self, rule_index: int) -> Optional[str]:
+        start = self.uint(self.offsets_start, rule_index)
+        end = self.uint(self.offsets_start, rule_index + 1)
+        if start == end:
+            return None
+        return self.words[self.uint(self.ids_start, random.randrange(start, end))]
+
+@functools.lru_cache(maxsize=None)
+def compiled_rules() -> Optional[CompiledRules]:
+    '''Returns the precomputed rules, or None if there's no valid file.'''
+    words = dictionary_words()
+    try:
+        with open(MASKS_PATH, 'rb') as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        logger.warning('No r2q8 masks at %s, evaluating rules per guess', MASKS_PATH)
+        return None
+    header = masks_header(words)
+    compiled = CompiledRules(words, data)
+    if (data[:len(header)] != header or len(data) < compiled.ids_start or
+            len(data) != compiled.ids_start + 4 * compiled.uint(compiled.offsets_start, len(RULES_LIST))):
+        logger.warning('Stale r2q8 masks at %s, evaluating rules per guess', MASKS_PATH)
+        return None
+    return compiled
+
+def rule_mask(word: str) -> int:
+    compiled = compiled_rules()
+    mask = compiled and compiled.mask(word)
+    if mask is None:
+        mask = evaluate_rules(word)
+    return mask
+
+def triggered_rules(word: str) -> List[int]:
+    mask = rule_mask(word)
+    return [idx for (idx, _name, _checker) in RULES_LIST if mask >> idx & 1]
+
+# Rules that are about membership of a list take samples from that list.
+SAMPLE_LISTS = {
+    1: 'CHEMICAL_ELEMENTS',
+    12: 'ADJ_SET',
+    19: 'ANIMAL_SET',
+    23: 'COUNTRY_SET',
+}
+
 def get_sample_word(rule_index: int) -> str:
-    if rule_index == 1:
-        word = random.sample(CHEMICAL_ELEMENTS, 1)[0]
-    elif rule_index == 12:
-        word = random.sample(ADJ_SET, 1)[0]
-    elif rule_index == 19:
-        word = random.sample(ANIMAL_SET, 1)[0]
-    elif rule_index == 23:
-        word = random.sample(COUNTRY_SET, 1)[0]
+    word = None
+    if rule_index in SAMPLE_LISTS:
+        word = random.choice(getattr(r2q8_data, SAMPLE_LISTS[rule_index]))
+    elif compiled_rules() is not None:
+        word = compiled_rules().sample(rule_index)
     else:
         checker = RULES_LIST[rule_index][2]
-        for trial, word in enumerate(random.sample(WORD_SET, len(WORD_SET))):
+        words = dictionary_words()
+        for trial, word in enumerate(random.sample(words, len(words))):
             if checker(word):
-                logger.info(f"trial: {trial}")
+                logger.debug('trial: %d', trial)
                 break
         else:
-            word = "发生了些意外……请联系管理员。"
-    logger.info(f"word: {word}")
+            word = None
+    if word is None:
+        word = "发生了些意外……请联系管理员。"
+    logger.debug('word: %s', word)
     return word
 
 # key operations
@@ -201,137 +327,138 @@ def update(puzzle_bingo_game_data, triggered_rules_indice, guessed_word: str, ma
     return puzzle_bingo_game_data
 
 
-@require_POST
-def submit(request):
-    try:
-        # get user data
-        puzzle_bingo_game_data = request.context.team.puzzle_bingo_game_data
-        if not puzzle_bingo_game_data:
-            puzzle_bingo_game_data = team.get_default_puzzle_bingo_game_data()
+# 数据结构改动: 版本兼容性. Runs once per team; see PuzzleGameState.GAMES.
+@PuzzleGameState.upgrade('r2q8', 1)
+def upgrade_known_rules(team, puzzle_bingo_game_data):
+    if isinstance(puzzle_bingo_game_data["known_rules"], list):
+        indice = puzzle_bingo_game_data["known_rules"]
+    else:
+        indice = list(puzzle_bingo_game_data["known_rules"].keys())
+    if 25 not in indice:
+        indice.append(25)
+    if 26 not in indice:
+        indice.append(26)
+    puzzle_bingo_game_data["known_rules"] = {int(idx): RULES_LIST[int(idx)][1] for idx in indice}
+
+    if puzzle_bingo_game_data["bingo_spoiled"] == True:
+        puzzle_bingo_game_data["bingo_spoiled"] = SPOIL_TEXT
+    return puzzle_bingo_game_data
+
+
+def play(request, puzzle_bingo_game_data):
+    # JSON object keys are always strings. This doesn't change what's saved.
+    puzzle_bingo_game_data["known_rules"] = {
+        int(idx): rule for (idx, rule) in puzzle_bingo_game_data["known_rules"].items()}
+
+    bingo_coin_num = puzzle_bingo_game_data["bingo_coin_num"]
+    bingo_spoiled = puzzle_bingo_game_data["bingo_spoiled"]
+
+    # switch case guess_a_word / do_spoil / buy_a_sample
+    body = json.loads(request.body)
+    mode = body.get("mode")
+    logger.debug('r2q8: mode=%s, body=%s', mode, body)
+    if mode == "guess_a_word":
+        # submittion & rules check
+        word = body.get("word", "")
+        word = clear_word(word)
+        if word not in r2q8_data.WORD_SET:
+            ret_dict = {
+                'error': '请参照我们提供的字典来选择单词。', 
+                'correct': True,
+                'triggered_rules': {},
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
+        else:
+            triggered_rules_indice = triggered_rules(word)
+            puzzle_bingo_game_data = update(puzzle_bingo_game_data, triggered_rules_indice, guessed_word=word)
+            ret_dict = {
+                'error': 'BINGO! FDUPH账户已到账 999999999 金。现在给我们发送一份你自己制作的BINGO卡片吧~' if word == MILESTONE else '', 
+                'correct': True,
+                'triggered_rules': {idx: word for idx in triggered_rules_indice},  # trigger时不给rule内容，五个连成一线变成known才给
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
+    elif mode == "do_spoil":
+        if bingo_coin_num >= SPOIL_COST and not bingo_spoiled:
+            puzzle_bingo_game_data["bingo_spoiled"] = SPOIL_TEXT
+            puzzle_bingo_game_data["bingo_coin_num"] -= SPOIL_COST
+            ret_dict = {
+                'error': '', 
+                'spoil_text': SPOIL_TEXT,
+                'correct': True,
+                'triggered_rules': {},
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
+        elif bingo_spoiled:
+            err_msg = f'你已经暗箱操作过了！'
+            ret_dict = {
+                'error': err_msg,
+                'correct': True,
+                'triggered_rules': {},
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
         else:
-            # logger.info(puzzle_bingo_game_data)
-            # 数据结构改动: 版本兼容性
-            if isinstance(puzzle_bingo_game_data["known_rules"], list):
-                indice = puzzle_bingo_game_data["known_rules"]
-            else:
-                indice = list(puzzle_bingo_game_data["known_rules"].keys())
-            if 25 not in indice:
-                indice.append(25)
-            if 26 not in indice:
-                indice.append(26)
-            puzzle_bingo_game_data["known_rules"] = {int(idx): RULES_LIST[int(idx)][1] for idx in indice}
-            request.context.team.save()
-
-            if puzzle_bingo_game_data["bingo_spoiled"] == True:
-                puzzle_bingo_game_data["bingo_spoiled"] = SPOIL_TEXT
-            # elif puzzle_bingo_game_data["bingo_spoiled"] == False:
-            #     puzzle_bingo_game_data["bingo_spoiled"] = ''
-
-        bingo_coin_num = puzzle_bingo_game_data["bingo_coin_num"]
-        bingo_spoiled = puzzle_bingo_game_data["bingo_spoiled"]
-
-        # switch case guess_a_word / do_spoil / buy_a_sample
-        body = json.loads(request.body)
-        mode = body.get("mode")
-        logger.info(f"[I] r2q8: mode={mode}, body={body}")
-        if mode == "guess_a_word":
-            # submittion & rules check
-            word = body.get("word", "")
-            word = clear_word(word)
-            if word not in WORD_SET:
-                ret_dict = {
-                    'error': '请参照我们提供的字典来选择单词。', 
-                    'correct': True,
-                    'triggered_rules': {},
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
-            else:
-                logger.info(f"{word} in ADJ_SET: {word in ADJ_SET}")
-                triggered_rules_indice = [item[0] for item in RULES_LIST if item[2](word)]
-                puzzle_bingo_game_data = update(puzzle_bingo_game_data, triggered_rules_indice, guessed_word=word)
-                request.context.team.save()
-                ret_dict = {
-                    'error': 'BINGO! FDUPH账户已到账 999999999 金。现在给我们发送一份你自己制作的BINGO卡片吧~' if word == MILESTONE else '', 
-                    'correct': True,
-                    'triggered_rules': {idx: word for idx in triggered_rules_indice},  # trigger时不给rule内容，五个连成一线变成known才给
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
-        elif mode == "do_spoil":
-            if bingo_coin_num >= SPOIL_COST and not bingo_spoiled:
-                puzzle_bingo_game_data["bingo_spoiled"] = SPOIL_TEXT
-                puzzle_bingo_game_data["bingo_coin_num"] -= SPOIL_COST
-                request.context.team.save()
-                ret_dict = {
-                    'error': '', 
-                    'spoil_text': SPOIL_TEXT,
-                    'correct': True,
-                    'triggered_rules': {},
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
-            elif bingo_spoiled:
-                err_msg = f'你已经暗箱操作过了！'
-                ret_dict = {
-                    'error': err_msg,
-                    'correct': True,
-                    'triggered_rules': {},
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
-            else:
-                err_msg = f'你没有足够的奖金来暗箱操作（需要{SPOIL_COST}）'
-                ret_dict = {
-                    'error': err_msg,
-                    'correct': True,
-                    'triggered_rules': {},
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
-        elif mode == "buy_a_sample":
-            if bingo_coin_num < BUY_A_SAMPLE_COST:
-                ret_dict = {
-                    'error': '请先凭借智慧积累一些财富吧……',
-                    'correct': True,
-                    'sample_word': '',
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
-            elif 'rule_index' in body and isinstance(body['rule_index'], int) and 0 <= body['rule_index'] <= 26:
-                sample_word = get_sample_word(body['rule_index'])
-                puzzle_bingo_game_data["bingo_coin_num"] -= BUY_A_SAMPLE_COST
-                request.context.team.save()
-                ret_dict = {
-                    'error': '',
-                    'correct': True,
-                    'sample_word': sample_word,
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
-            else:
-                ret_dict = {
-                    'error': '发生未知错误，请联系管理员。',
-                    'correct': True,
-                    'sample_word': '',
-                    'bingo_coin_num': bingo_coin_num,
-                    'bingo_spoiled': bingo_spoiled
-                }
+            err_msg = f'你没有足够的奖金来暗箱操作（需要{SPOIL_COST}）'
+            ret_dict = {
+                'error': err_msg,
+                'correct': True,
+                'triggered_rules': {},
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
+    elif mode == "buy_a_sample":
+        if bingo_coin_num < BUY_A_SAMPLE_COST:
+            ret_dict = {
+                'error': '请先凭借智慧积累一些财富吧……',
+                'correct': True,
+                'sample_word': '',
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
+        elif 'rule_index' in body and isinstance(body['rule_index'], int) and 0 <= body['rule_index'] <= 26:
+            sample_word = get_sample_word(body['rule_index'])
+            puzzle_bingo_game_data["bingo_coin_num"] -= BUY_A_SAMPLE_COST
+            ret_dict = {
+                'error': '',
+                'correct': True,
+                'sample_word': sample_word,
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
         else:
-            logger.info(f"Warning: unknown mode in r2q8: {mode}")
-            ret_dict = {'error': '发生未知错误，请联系管理员。'}
+            ret_dict = {
+                'error': '发生未知错误，请联系管理员。',
+                'correct': True,
+                'sample_word': '',
+                'bingo_coin_num': bingo_coin_num,
+                'bingo_spoiled': bingo_spoiled
+            }
+    else:
+        logger.info(f"Warning: unknown mode in r2q8: {mode}")
+        ret_dict = {'error': '发生未知错误，请联系管理员。'}
+
+    # when no error, ret_dict['error'] must be empty
+    # ret_dict['error'] = ''
+    # logger.info(f"[I] r2q8: ret_dict={ret_dict}")
+    return ret_dict
+
 
-        # when no error, ret_dict['error'] must be empty
-        # ret_dict['error'] = ''
-        # logger.info(f"[I] r2q8: ret_dict={ret_dict}")
-        return ret_dict
+@require_POST
+def submit(request):
+    try:
+        # Nothing is saved if this fails partway through.
+        with PuzzleGameState.locked(request.context.team, 'r2q8') as state:
+            return play(request, state.data)
     except:
         logger.info(traceback.format_exc())
+        puzzle_bingo_game_data = PuzzleGameState.get_data(request.context.team, 'r2q8')
         return {
             'error': '发生未知错误，请联系管理员。',
             'correct': True,
             'triggered_rules': {},
-            'bingo_coin_num': bingo_coin_num,
-            'bingo_spoiled': bingo_spoiled
+            'bingo_coin_num': puzzle_bingo_game_data["bingo_coin_num"],
+            'bingo_spoiled': puzzle_bingo_game_data["bingo_spoiled"]
         }
-
@@ -5,11 +5,11 @@ import traceback
 from typing import Tuple, Dict, List, Callable, Literal
 from collections import OrderedDict
 
-from django.views.decorators.http import require_POST
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET, require_POST
 
 from puzzles.messaging import log_puzzle_info
-from puzzles.utils import get_default_puzzle_genshin_game_data
-from ..models import Team
+from ..models import GachaDraw, PuzzleGameState
 from .r3q3_data import CHAR_SAMPLE_DICT, UNCOPYRIGHTABLE_WORDS
 
 
@@ -79,28 +79,65 @@ def get_one() -> Dict[str, Literal['poem', 'freq', 'prob', 'bell', 'wndw']]:
 
 
 
+# Draws are kept as GachaDraws, and the team's PuzzleGameState just counts
+# them, so a draw is a couple of small writes however many came before.
+def record_draws(team, draws: int, items: List[Dict[str, str]]):
+    GachaDraw.objects.bulk_create([
+        GachaDraw(team=team, number=draws + i, kind=GachaDraw.KINDS.index(kind), text=str(text))
+        for (i, item) in enumerate(items, 1)
+        for (text, kind) in item.items()
+    ])
+
+@PuzzleGameState.upgrade('r3q3', 1)
+def upgrade_history(team, data):
+    '''Moves draws from before GachaDraw out of the team's state.'''
+    history = data.pop("history", [])
+    record_draws(team, 0, history)
+    data["draws"] = len(history)
+    return data
+
+HISTORY_PAGE_SIZE = 100
+
+@require_GET
+def history(request):
+    '''Returns a page of the team's draws, newest first, before the draw numbered ?before=.'''
+    team = request.context.team
+    if not team:
+        return JsonResponse({'items': [], 'before': None})
+    # Old draws must have been moved here first.
+    PuzzleGameState.get_data(team, 'r3q3')
+    draws = GachaDraw.objects.filter(team=team).order_by('-number')
+    before = request.GET.get('before')
+    if before and before.isdigit():
+        draws = draws.filter(number__lt=int(before))
+    page = list(draws[:HISTORY_PAGE_SIZE + 1])
+    return JsonResponse({
+        'items': [draw.as_item() for draw in page[:HISTORY_PAGE_SIZE]],
+        'before': page[HISTORY_PAGE_SIZE - 1].number if len(page) > HISTORY_PAGE_SIZE else None,
+    })
+
+
 @require_POST
 def submit(request):
     try:
-        # get user data
-        puzzle_genshin_game_data = request.context.team.puzzle_genshin_game_data
-        if not puzzle_genshin_game_data:
-            puzzle_genshin_game_data = get_default_puzzle_genshin_game_data()
-
         body = json.loads(request.body)
         get_num = body.get("num")
         if get_num not in [1, 10]:
             raise ValueError('Expect get num to be 1 or 10.')
-        if len(puzzle_genshin_game_data["history"]) >= 6000:
-            return {
-                'error': '你并不需要那么多次抽取来解决本题。', 
-                'correct': True,
-            }
-
-        new_items = [get_one() for _ in range(get_num)]
-        puzzle_genshin_game_data["history"].extend(new_items)
+
+        team = request.context.team
+        with PuzzleGameState.locked(team, 'r3q3') as state:
+            draws = state.data["draws"]
+            if draws >= 6000:
+                return {
+                    'error': '你并不需要那么多次抽取来解决本题。', 
+                    'correct': True,
+                }
+
+            new_items = [get_one() for _ in range(get_num)]
+            record_draws(team, draws, new_items)
+            state.data["draws"] = draws + len(new_items)
         new_items_text = [list(item.keys())[0] for item in new_items]
-        request.context.team.save()
         return {
             'error': '', 
             'correct': True,
@@ -1,7 +1,10 @@
 import json
+import os
 
-with open('puzzles/puzzlehandlers/char_sample.json') as fp:
+DATA_DIR = os.path.dirname(__file__)
+
+with open(os.path.join(DATA_DIR, 'char_sample.json')) as fp:
     CHAR_SAMPLE_DICT = json.load(fp)
 
-with open('puzzles/puzzlehandlers/uncopyrightable_words.txt') as fp:
+with open(os.path.join(DATA_DIR, 'uncopyrightable_words.txt')) as fp:
     UNCOPYRIGHTABLE_WORDS = fp.read().strip().split()
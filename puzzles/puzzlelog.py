@@ -0,0 +1,127 @@
+# The puzzle log, everything handlers pass to messaging.log_puzzle_info, is
+# also kept in an SQLite file next to puzzle.log, indexed by puzzle, team and
+# time, so the viewer on the bridge can show one team's or one puzzle's
+# entries without reading all of them. Entries are written from a background
+# thread like the other logs (see gph/logutils.py), a batch per transaction.
+# Entry ids increase in the order entries were written, which is what pages
+# are ordered by.
+import logging
+import sqlite3
+import threading
+
+from gph.logutils import QueuedHandler
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entry (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    puzzle TEXT NOT NULL,
+    team TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entry_puzzle ON entry (puzzle, id);
+CREATE INDEX IF NOT EXISTS entry_team ON entry (team, id);
+CREATE INDEX IF NOT EXISTS entry_time ON entry (time);
+'''
+
+
+# Paths whose schema this process has already made sure of.
+_created = set()
+_created_lock = threading.Lock()
+
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=10)
+    # Lets the viewer read while workers write.
+    connection.execute('PRAGMA journal_mode=WAL')
+    if path not in _created:
+        with _created_lock:
+            if path not in _created:
+                connection.executescript(SCHEMA)
+                _created.add(path)
+    return connection
+
+
+class PuzzleLogStore(logging.Handler):
+    '''
+    Saves records from log_puzzle_info when flush_buffer is called. Meant to be
+    the target of a QueuedHandler.
+    '''
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.rows = []
+        self.rows_lock = threading.Lock()
+
+    def emit(self, record):
+        if hasattr(record, 'puzzle'):
+            with self.rows_lock:
+                self.rows.append((record.created, str(record.puzzle), str(record.team), str(record.content)))
+
+    def flush_buffer(self):
+        with self.rows_lock:
+            (rows, self.rows) = (self.rows, [])
+        if not rows:
+            return
+        # A connection per batch, since batches are few and connections
+        # can't be shared with forked processes.
+        with self.lock:
+            try:
+                connection = connect(self.path)
+                try:
+                    with connection:
+                        connection.executemany(
+                            'INSERT INTO entry (time, puzzle, team, content) VALUES (?, ?, ?, ?)', rows)
+                finally:
+                    connection.close()
+            except sqlite3.Error:
+                logger.exception('Saving %d puzzle log entries failed', len(rows))
+
+    def close(self):
+        self.flush_buffer()
+        super().close()
+
+
+class QueuedPuzzleLogHandler(QueuedHandler):
+    def __init__(self, filename):
+        super().__init__(PuzzleLogStore(filename))
+        self.filename = filename
+
+
+def query(path, puzzle='', team='', search='', before=None, after=None, limit=PAGE_SIZE):
+    '''
+    Returns up to limit entries matching the filters, as dicts, newest first.
+    With before, only entries older than that id (for paging back); with
+    after, only the oldest ones newer than that id (for following the tail).
+    '''
+    conditions = []
+    params = []
+    for (column, value) in (('puzzle', puzzle), ('team', team)):
+        if value:
+            conditions.append('{} = ?'.format(column))
+            params.append(value)
+    if search:
+        conditions.append("content LIKE ? ESCAPE '\\'")
+        params.append('%{}%'.format(search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')))
+    if before is not None:
+        conditions.append('id < ?')
+        params.append(before)
+    if after is not None:
+        conditions.append('id > ?')
+        params.append(after)
+    sql = 'SELECT id, time, puzzle, team, content FROM entry {} ORDER BY id {} LIMIT ?'.format(
+        'WHERE ' + ' AND '.join(conditions) if conditions else '',
+        'ASC' if after is not None else 'DESC')
+    connection = connect(path)
+    try:
+        rows = connection.execute(sql, params + [limit]).fetchall()
+    finally:
+        connection.close()
+    if after is not None:
+        rows.reverse()
+    return [dict(zip(('id', 'time', 'puzzle', 'team', 'content'), row)) for row in rows]
@@ -78,6 +78,7 @@ class Shortcuts:
     def prerelease_testsolver(team):
         team.is_prerelease_testsolver ^= True
         team.save()
+        models.Team.expire_unlocks([team.id])
     prerelease_testsolver.__doc__ = "切换是否内测"
 
     @heading
@@ -87,6 +88,7 @@ class Shortcuts:
     def set_offset_to_start_now(team, now):
         team.start_offset = hunt_config.HUNT_START_TIME - now
         team.save()
+        models.Team.expire_unlocks([team.id])
     set_offset_to_start_now.__doc__ = "立刻开始"
 
     if hunt_config.HINTS_ENABLED:
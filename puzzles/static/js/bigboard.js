@@ -0,0 +1,82 @@
+// Applies the deltas sent by send_bigboard_delta (in messaging.py) to a
+// rendered big board, so it stays current without reloading. Ranks and
+// percentages only update on reload.
+function watchBigboard(hideHidden) {
+    openSocket('/ws/bigboard', data => {
+        const {kind, team, hidden, puzzle} = JSON.parse(data);
+        if (hidden && hideHidden)
+            return;
+
+        const bumpTotal = row => {
+            const td = document.querySelector(`tr[data-row="${row}"] td[data-puzzle="${puzzle}"]`);
+            if (!td)
+                return 0;
+            td.textContent = +td.textContent + 1;
+            return +td.textContent;
+        };
+        bumpTotal(kind === 'unlock' ? 'unlocks' : kind === 'hint' ? 'hints' : 'guesses');
+        const position = kind === 'solve' ? bumpTotal('solves') : 0;
+        if (kind === 'free')
+            bumpTotal('free');
+
+        const row = document.querySelector(`tr[data-team="${team}"]`);
+        const cell = row && row.querySelector(`td[data-puzzle="${puzzle}"]`);
+        if (!cell)
+            return;
+        const [solves, metas, hints] = row.querySelectorAll('td[data-solves], td[data-metas], td[data-used]');
+        const done = cell.classList.contains('S') || cell.classList.contains('F');
+        switch (kind) {
+            case 'unlock':
+                if (!done && !cell.classList.contains('W'))
+                    cell.classList.add('U');
+                break;
+            case 'guess':
+                cell.dataset.wrong++;
+                solves.dataset.wrong++;
+                if (!done)
+                    cell.classList.replace('U', 'W') || cell.classList.add('W');
+                break;
+            case 'solve':
+                cell.dataset.position = position;
+                cell.classList.remove('U', 'W');
+                cell.classList.add('S');
+                solves.dataset.solves++;
+                break;
+            case 'free':
+                cell.classList.remove('U', 'W');
+                cell.classList.add('F');
+                solves.dataset.free++;
+                break;
+            case 'hint':
+                cell.dataset.hints++;
+                cell.classList.add('H');
+                hints.dataset.used++;
+                hints.textContent = `${hints.dataset.used} / ${hints.dataset.total}`;
+                break;
+        }
+        // Free answers count as meta solves too, as in bigboard.build_snapshot.
+        if ((kind === 'solve' || kind === 'free') &&
+                document.querySelector(`th[data-puzzle="${puzzle}"]`).hasAttribute('data-meta')) {
+            metas.dataset.metas++;
+            metas.textContent = metas.dataset.metas;
+        }
+        renderCell(cell);
+        renderTeamSolves(solves);
+    });
+}
+
+function renderCell(td) {
+    const {position, wrong, hints} = td.dataset;
+    td.innerHTML =
+        (position || '') +
+        (+wrong ? ` &minus;${wrong}` : '') +
+        (+hints ? `<small>+${hints}</small>` : '');
+}
+
+function renderTeamSolves(td) {
+    const {solves, wrong, free} = td.dataset;
+    td.innerHTML =
+        (+solves ? solves : '') +
+        (+wrong ? ` &minus;${wrong}` : '') +
+        (+free ? `<small>+${free}</small>` : '');
+}
@@ -0,0 +1,99 @@
+# Hunt-wide counters shared by the puzzle list, the stats pages and the big
+# board. They're computed with grouped queries rather than by walking every
+# submission in Python, and cached for a little while since the same numbers
+# get requested by every visitor once stats are public after the hunt.
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from puzzles.hunt_config import HUNT_END_TIME
+from puzzles.models import AnswerSubmission, Hint
+
+# How stale the numbers are allowed to be, in seconds. Pass refresh=True to
+# any of these to skip the cache and store new numbers.
+STATS_TIMEOUT = 30
+
+
+def cached(key, compute, refresh):
+    if refresh:
+        value = compute()
+        cache.set('stats:' + key, value, STATS_TIMEOUT)
+        return value
+    return cache.get_or_set('stats:' + key, compute, STATS_TIMEOUT)
+
+
+def puzzle_stats(refresh=False):
+    '''
+    Returns a dict from puzzle id to numbers of correct answers, guesses, teams
+    that guessed and teams that solved, only counting visible teams, answers
+    submitted before the end of the hunt and not free answers. Puzzles
+    without guesses are left out.
+    '''
+    def compute():
+        correct = Q(is_correct=True)
+        return {
+            row['puzzle_id']: row
+            for row in AnswerSubmission.objects.filter(
+                used_free_answer=False,
+                team__is_hidden=False,
+                submitted_datetime__lt=HUNT_END_TIME,
+            ).values('puzzle_id').annotate(
+                correct=Count('id', filter=correct),
+                guesses=Count('id'),
+                teams=Count('team_id', distinct=True),
+                solve_teams=Count('team_id', distinct=True, filter=correct),
+            ).order_by()
+        }
+    return cached('puzzles', compute, refresh)
+
+
+def wrong_guess_counts(hide_hidden=True, refresh=False):
+    '''Returns a dict from (team id, puzzle id) to the number of wrong guesses.'''
+    def compute():
+        guesses = AnswerSubmission.objects.filter(is_correct=False)
+        if hide_hidden:
+            guesses = guesses.filter(team__is_hidden=False)
+        return {
+            (team_id, puzzle_id): count
+            for (team_id, puzzle_id, count) in guesses
+            .values_list('team_id', 'puzzle_id')
+            .annotate(count=Count('*'))
+            .order_by()
+        }
+    return cached('wrong-guesses:%d' % hide_hidden, compute, refresh)
+
+
+def answered_hint_counts(refresh=False):
+    '''Returns a dict from (team id, puzzle id) to the number of answered hints.'''
+    def compute():
+        return {
+            (team_id, puzzle_id): count
+            for (team_id, puzzle_id, count) in Hint.objects
+            .filter(status=Hint.ANSWERED, is_followup=False)
+            .values_list('team_id', 'puzzle_id')
+            .annotate(count=Count('*'))
+            .order_by()
+        }
+    return cached('answered-hints', compute, refresh)
+
+
+def hint_counts(refresh=False):
+    '''
+    Returns a pair of dicts from puzzle id to the number of hints from visible
+    teams, and from (puzzle id, team id) to the number of those that used up
+    one of the team's hints.
+    '''
+    def compute():
+        hints = Hint.objects.exclude(team__is_hidden=True)
+        by_puzzle = dict(
+            hints.values_list('puzzle_id').annotate(count=Count('*')).order_by())
+        consumed = {
+            (puzzle_id, team_id): count
+            for (puzzle_id, team_id, count) in hints
+            .exclude(status__in=(Hint.REFUNDED, Hint.OBSOLETE))
+            .exclude(is_followup=True)
+            .values_list('puzzle_id', 'team_id')
+            .annotate(count=Count('*'))
+            .order_by()
+        }
+        return (by_puzzle, consumed)
+    return cached('hints', compute, refresh)
@@ -0,0 +1,117 @@
+# A team's submissions, hints, extra guesses and unlocks are read on nearly
+# every page the team loads, but only change when the team does something or
+# staff answer a hint. So, like the catalog, we keep each team's rows in the
+# shared cache, plus the most recently used ones in each process, labeled
+# with a version token per team that lives in the shared cache. Saving or
+# deleting any of those rows, or the team, replaces the team's token (see the
+# receivers in models.py), so a page load usually costs one cache read
+# instead of a query for each kind of row.
+#
+# The rows are kept as plain values, and each Team gets its own model
+# instances made from them, with puzzles from the catalog, since views change
+# some of them (e.g. marking an unlock as viewed) before saving.
+import collections
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from puzzles.catalog import get_catalog
+
+VERSION_KEY = 'team-state:{}:version'
+STATE_KEY = 'team-state:{}:{}'
+# Old states are never read again once the version changes.
+STATE_TIMEOUT = 60 * 60 * 24
+# Teams whose state each process keeps, most recently used first out.
+LOCAL_SIZE = 2000
+
+_lock = threading.Lock()
+_local_states = collections.OrderedDict()
+
+
+def tables():
+    '''(model, ordering) of each kind of row in a team's state.'''
+    from puzzles.models import AnswerSubmission, ExtraGuessGrant, Hint, PuzzleUnlock
+    return (
+        (AnswerSubmission, ('-submitted_datetime',)),
+        (Hint, ('id',)),
+        (ExtraGuessGrant, ('id',)),
+        (PuzzleUnlock, ('id',)),
+    )
+
+
+def field_names(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+class TeamState:
+    '''One version of a team's rows. Shared between requests; don't change it.'''
+
+    def __init__(self, version, rows):
+        self.version = version
+        # model label -> tuple of value tuples in field_names order
+        self.rows = rows
+
+    def objects(self, model):
+        '''Returns new instances of the team's rows of model.'''
+        puzzles = get_catalog().puzzles_by_id
+        names = field_names(model)
+        objects = []
+        for values in self.rows[model._meta.label]:
+            obj = model.from_db(DEFAULT_DB_ALIAS, names, values)
+            puzzle = puzzles.get(obj.puzzle_id)
+            # (Otherwise it's loaded if anyone asks.)
+            if puzzle is not None:
+                obj.puzzle = puzzle
+            objects.append(obj)
+        return objects
+
+
+def load_rows(team_id):
+    return {
+        model._meta.label: tuple(
+            model.objects.filter(team_id=team_id).order_by(*ordering).values_list(*field_names(model)))
+        for (model, ordering) in tables()
+    }
+
+
+def current_version(team_id):
+    key = VERSION_KEY.format(team_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def get_state(team_id):
+    version = current_version(team_id)
+    with _lock:
+        state = _local_states.get(team_id)
+        if state is not None and state.version == version:
+            _local_states.move_to_end(team_id)
+            return state
+    key = STATE_KEY.format(team_id, version)
+    rows = cache.get(key)
+    if rows is None:
+        rows = load_rows(team_id)
+        cache.set(key, rows, STATE_TIMEOUT)
+    state = TeamState(version, rows)
+    with _lock:
+        _local_states[team_id] = state
+        _local_states.move_to_end(team_id)
+        while len(_local_states) > LOCAL_SIZE:
+            _local_states.popitem(last=False)
+    return state
+
+
+def invalidate(team_ids):
+    '''Make every process reload the given teams' states the next time they're used.'''
+    team_ids = list(team_ids)
+    def bump():
+        cache.set_many({VERSION_KEY.format(team_id): uuid.uuid4().hex for team_id in team_ids}, None)
+    bump()
+    # As with the catalog, someone might load the old rows before this
+    # transaction commits, so bump again once it has.
+    transaction.on_commit(bump)
@@ -53,6 +53,13 @@ def format_time(timestamp, format='DATE_TIME'):
     return mark_safe('<time datetime="%s" data-format="%s">%s</time>'
         % (timestamp.isoformat(), formats.get_format(format), text))
 
+@register.simple_tag(takes_context=True)
+def game_state(context, puzzle):
+    '''{% game_state 'slug' as state %} loads the team's state for a puzzle handler.'''
+    from puzzles.models import PuzzleGameState
+    team = context['request'].context.team
+    return PuzzleGameState.get_data(team, puzzle) if team else None
+
 @register.simple_tag
 def percentage(a, b):
     return '' if b == 0 else '%s%%' % (100 * a // b)
@@ -1,11 +1,39 @@
+import csv
+import gzip
+import io
+import json
 import logging
-from datetime import datetime
+import mmap
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
 
 import django.urls as urls
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import Client, TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import Client, TestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from .models import Puzzle, Round, Team, AnswerSubmission
+from gph import logutils
+
+from . import bigboard, catalog, messaging, metrics, puzzlelog, stats, teamstate, throttle, warmup
+from .management.commands import benchmark, erratum_emails, generate_scale_hunt, loadtest
+from .puzzlehandlers import packed, r2q8
+from .hunt_config import HUNT_START_TIME
+from .models import (
+    Puzzle, Round, Team, AnswerSubmission, PuzzleUnlock, PuzzleMessage, LeaderboardEntry,
+    PuzzleGameState, GachaDraw, Hint, ExtraGuessGrant, TeamMember,
+)
 
 # wow, we log a lot of things as INFO
 logging.disable(logging.INFO)
@@ -118,3 +146,964 @@ class Misc(TestCase):
 
         response = c.get(urls.reverse("team", args=(self.team_b.team_name,)))
         self.assertEqual(response.status_code, 200)
+
+
+class Unlocks(TestCase):
+    def setUp(self):
+        self.user = create_user("c")
+        # Pretend the team has just started, so the hunt is ongoing for it.
+        self.team = Team(
+            user=self.user,
+            team_name="Team C",
+            start_offset=HUNT_START_TIME - timezone.now(),
+        )
+        self.team.save()
+
+        self.round = Round(name="Sample Round", slug="sample")
+        self.round.save()
+        self.first = Puzzle(
+            name="First",
+            slug="first",
+            body_template="sample.html",
+            answer="FIRST",
+            round=self.round,
+            order=1,
+            unlock_local=0,
+        )
+        self.first.save()
+        self.second = Puzzle(
+            name="Second",
+            slug="second",
+            body_template="sample.html",
+            answer="SECOND",
+            round=self.round,
+            order=2,
+            unlock_local=1,
+        )
+        self.second.save()
+
+        self.client = Client()
+        self.client.login(username="c", password="csecret")
+
+    def get_unlocked(self):
+        response = self.client.get(urls.reverse("round", args=(self.round.slug,)))
+        self.assertEqual(response.status_code, 200)
+        return [puzzle['puzzle'].slug for puzzle in response.context[0]['round']['puzzles']]
+
+    def test_unlocks_are_reused_until_expired(self):
+        self.assertEqual(self.get_unlocked(), ["first"])
+        self.assertTrue(PuzzleUnlock.objects.filter(team=self.team, puzzle=self.first).exists())
+        self.team.refresh_from_db()
+        self.assertIsNotNone(self.team.unlocks_valid_until)
+
+        with mock.patch.object(Team, 'refresh_unlocks') as refresh:
+            self.assertEqual(self.get_unlocked(), ["first"])
+        refresh.assert_not_called()
+
+        AnswerSubmission(
+            team=self.team,
+            puzzle=self.first,
+            submitted_answer="FIRST",
+            is_correct=True,
+            used_free_answer=False,
+        ).save()
+        self.assertEqual(self.get_unlocked(), ["first", "second"])
+
+    def test_stale_team_save_keeps_expiry(self):
+        self.get_unlocked()
+        stale = Team.objects.get(id=self.team.id)
+        Team.expire_unlocks([self.team.id])
+        expired = Team.objects.get(id=self.team.id).unlocks_valid_until
+        stale.total_hints_awarded += 1
+        stale.save()
+        self.assertEqual(Team.objects.get(id=self.team.id).unlocks_valid_until, expired)
+
+
+class Leaderboard(TestCase):
+    def setUp(self):
+        # Pretend the hunt is still going, so that solves count.
+        patcher = mock.patch('puzzles.models.HUNT_END_TIME', timezone.now() + timedelta(days=1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.round = Round(name="Sample Round", slug="sample")
+        self.round.save()
+        self.puzzles = []
+        for i in range(3):
+            puzzle = Puzzle(
+                name="Puzzle %d" % i,
+                slug="puzzle-%d" % i,
+                body_template="sample.html",
+                answer="ANSWER",
+                round=self.round,
+            )
+            puzzle.save()
+            self.puzzles.append(puzzle)
+        self.teams = []
+        for i in range(3):
+            team = Team(user=create_user("t%d" % i), team_name="Team %d" % i)
+            team.save()
+            self.teams.append(team)
+
+    def solve(self, team, puzzle):
+        AnswerSubmission(
+            team=team,
+            puzzle=puzzle,
+            submitted_answer="ANSWER",
+            is_correct=True,
+            used_free_answer=False,
+        ).save()
+
+    def test_entries_follow_solves(self):
+        self.solve(self.teams[1], self.puzzles[0])
+        self.solve(self.teams[1], self.puzzles[1])
+        self.solve(self.teams[2], self.puzzles[0])
+        ranks = [team.leaderboard_entry.rank() for team in Team.objects.order_by('id')]
+        self.assertEqual(ranks, [3, 1, 2])
+
+        AnswerSubmission.objects.filter(team=self.teams[1]).delete()
+        entry = LeaderboardEntry.objects.get(team=self.teams[1])
+        self.assertEqual(entry.total_solves, 0)
+        self.assertEqual(entry.last_solve_time, self.teams[1].creation_time)
+
+    def test_rebuild_matches_incremental(self):
+        self.solve(self.teams[0], self.puzzles[2])
+        self.solve(self.teams[2], self.puzzles[1])
+        before = list(LeaderboardEntry.objects.order_by('team_id').values(
+            'team_id', 'total_solves', 'last_solve_time', 'metameta_solve_time'))
+        LeaderboardEntry.rebuild()
+        after = list(LeaderboardEntry.objects.order_by('team_id').values(
+            'team_id', 'total_solves', 'last_solve_time', 'metameta_solve_time'))
+        self.assertEqual(before, after)
+
+    def test_team_page_rank(self):
+        self.solve(self.teams[2], self.puzzles[0])
+        c = Client()
+        c.login(username="t0", password="t0secret")
+        response = c.get(urls.reverse("team", args=(self.teams[2].team_name,)))
+        self.assertEqual(response.context['rank'], 1)
+
+        with self.assertNumQueries(1):
+            self.teams[0].leaderboard_entry.rank()
+
+
+class Catalog(TestCase):
+    def setUp(self):
+        self.round = Round(name="Sample Round", slug="sample")
+        self.round.save()
+        self.puzzle = Puzzle(
+            name="Sample",
+            slug="sample",
+            body_template="sample.html",
+            answer="SAMPLE",
+            round=self.round,
+        )
+        self.puzzle.save()
+
+    def test_catalog_is_reused_until_edited(self):
+        self.assertEqual(catalog.get_catalog().puzzles, (self.puzzle,))
+        with self.assertNumQueries(0):
+            puzzle = catalog.get_catalog().puzzles_by_slug["sample"]
+            self.assertEqual(list(puzzle.puzzlemessage_set.all()), [])
+
+        PuzzleMessage(puzzle=self.puzzle, guess="NEAR", response="Keep going").save()
+        puzzle = catalog.get_catalog().puzzles_by_slug["sample"]
+        self.assertEqual([m.guess for m in puzzle.puzzlemessage_set.all()], ["NEAR"])
+
+        self.puzzle.name = "Renamed"
+        self.puzzle.save()
+        self.assertEqual(catalog.get_catalog().puzzles_by_slug["sample"].name, "Renamed")
+
+    def test_puzzle_messages_match_semicleaned_guess(self):
+        PuzzleMessage(puzzle=self.puzzle, guess="Near Miss", response="Keep going").save()
+        PuzzleMessage(puzzle=self.puzzle, guess="near-miss!", response="Really").save()
+        PuzzleMessage(puzzle=self.puzzle, guess="Other", response="No").save()
+        messages = catalog.get_catalog().puzzle_messages(
+            self.puzzle, PuzzleMessage.semiclean_guess("NEAR MISS"))
+        self.assertEqual([m.response for m in messages], ["Keep going", "Really"])
+        self.assertEqual(catalog.get_catalog().puzzle_messages(self.puzzle, "SAMPLE"), [])
+
+
+class TeamState(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.round = Round.objects.create(name="Sample Round", slug="sample")
+        self.puzzle = Puzzle.objects.create(
+            name="Sample", slug="sample", body_template="sample.html", answer="SAMPLE", round=self.round)
+        self.team = Team.objects.create(user=create_user("a"), team_name="Team A")
+
+    def fresh_team(self):
+        # A new request gets a new Team.
+        return Team.objects.get(id=self.team.id)
+
+    def test_state_is_reused_until_changed(self):
+        AnswerSubmission.objects.create(
+            team=self.team, puzzle=self.puzzle, submitted_answer="WRONG", is_correct=False, used_free_answer=False)
+        self.assertEqual([s.submitted_answer for s in self.fresh_team().submissions], ["WRONG"])
+        team = self.fresh_team()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(team.submissions), 1)
+            self.assertEqual(team.submissions[0].puzzle.round.slug, "sample")
+            self.assertEqual((team.asked_hints, team.extra_guesses, team.db_unlocks), ((), {}, {}))
+
+        AnswerSubmission.objects.create(
+            team=self.team, puzzle=self.puzzle, submitted_answer="SAMPLE", is_correct=True, used_free_answer=False)
+        self.assertEqual(list(self.fresh_team().solves), [self.puzzle.id])
+        Hint.objects.create(team=self.team, puzzle=self.puzzle, hint_question="Help")
+        self.assertEqual([h.hint_question for h in self.fresh_team().asked_hints], ["Help"])
+        ExtraGuessGrant.objects.create(team=self.team, puzzle=self.puzzle, extra_guesses=3)
+        self.assertEqual(self.fresh_team().extra_guesses, {"sample": 3})
+        unlock = PuzzleUnlock.objects.create(team=self.team, puzzle=self.puzzle, unlock_datetime=timezone.now())
+        self.assertIsNone(self.fresh_team().db_unlocks[self.puzzle.id].view_datetime)
+        unlock.view_datetime = timezone.now()
+        unlock.save()
+        self.assertIsNotNone(self.fresh_team().db_unlocks[self.puzzle.id].view_datetime)
+        Hint.objects.all().delete()
+        self.assertEqual(self.fresh_team().asked_hints, ())
+
+    def test_teams_get_their_own_objects(self):
+        PuzzleUnlock.objects.create(team=self.team, puzzle=self.puzzle, unlock_datetime=timezone.now())
+        unlock = self.fresh_team().db_unlocks[self.puzzle.id]
+        unlock.view_datetime = timezone.now()
+        self.assertIsNone(self.fresh_team().db_unlocks[self.puzzle.id].view_datetime)
+
+    def test_shared_cache(self):
+        self.assertEqual(self.fresh_team().submissions, ())
+        # Another process has the state cached, but not this one.
+        teamstate._local_states.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(teamstate.get_state(self.team.id).objects(AnswerSubmission), [])
+
+    def test_local_cache_is_bounded(self):
+        with mock.patch.object(teamstate, 'LOCAL_SIZE', 2):
+            for team_id in (1001, 1002, 1003):
+                teamstate.get_state(team_id)
+            self.assertEqual(list(teamstate._local_states)[-2:], [1002, 1003])
+            self.assertLessEqual(len(teamstate._local_states), 2)
+
+
+class Stats(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('puzzles.stats.HUNT_END_TIME', timezone.now() + timedelta(days=1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.round = Round(name="Sample Round", slug="sample")
+        self.round.save()
+        self.puzzle = Puzzle(
+            name="Sample",
+            slug="sample",
+            body_template="sample.html",
+            answer="SAMPLE",
+            round=self.round,
+        )
+        self.puzzle.save()
+        self.teams = []
+        for i in range(3):
+            team = Team(user=create_user("s%d" % i), team_name="Stats %d" % i, is_hidden=i == 2)
+            team.save()
+            self.teams.append(team)
+
+    def test_puzzle_stats(self):
+        for (team, answer) in [
+            (self.teams[0], "WRONG"),
+            (self.teams[0], "SAMPLE"),
+            (self.teams[1], "WRONG"),
+            (self.teams[2], "SAMPLE"),
+        ]:
+            AnswerSubmission(
+                team=team,
+                puzzle=self.puzzle,
+                submitted_answer=answer,
+                is_correct=answer == "SAMPLE",
+                used_free_answer=False,
+            ).save()
+        row = stats.puzzle_stats()[self.puzzle.id]
+        self.assertEqual(
+            (row['correct'], row['guesses'], row['teams'], row['solve_teams']),
+            (1, 3, 2, 1))
+        with self.assertNumQueries(0):
+            stats.puzzle_stats()
+
+
+class Bigboard(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "adminsecret")
+        self.round = Round(name="Sample Round", slug="sample")
+        self.round.save()
+        self.puzzle = Puzzle(
+            name="Sample",
+            slug="sample",
+            body_template="sample.html",
+            answer="SAMPLE",
+            round=self.round,
+        )
+        self.puzzle.save()
+        self.team = Team(user=create_user("d"), team_name="Team D")
+        self.team.save()
+
+    def test_snapshot_is_shared_and_deltas_are_sent(self):
+        c = Client()
+        c.login(username="admin", password="adminsecret")
+        with mock.patch('puzzles.bigboard.build_snapshot', wraps=bigboard.build_snapshot) as build:
+            for _ in range(2):
+                response = c.get(urls.reverse("bigboard"))
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual([row['team']['id'] for row in response.context['board']], [self.team.id])
+
+        with mock.patch('puzzles.messaging.BigboardConsumer.send_to_all') as send:
+            AnswerSubmission(
+                team=self.team,
+                puzzle=self.puzzle,
+                submitted_answer="WRONG",
+                is_correct=False,
+                used_free_answer=False,
+            ).save()
+        self.assertEqual(json.loads(send.call_args[0][0]), {
+            'kind': 'guess', 'team': self.team.id, 'hidden': False, 'puzzle': self.puzzle.id})
+
+
+class Outbox(TestCase):
+    def test_messages_are_coalesced_per_group(self):
+        outbox = messaging.NotificationOutbox()
+        sent = []
+        done = threading.Event()
+
+        async def send_batches(batches):
+            sent.append(batches)
+            done.set()
+
+        outbox.send_batches = send_batches
+        outbox.put('team-1', 'a')
+        outbox.put('team-2', 'b')
+        outbox.put('team-1', 'c')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(sent, [{'team-1': ['a', 'c'], 'team-2': ['b']}])
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class Mail(TestCase):
+    def setUp(self):
+        self.queue = messaging.MailQueue(synchronous=True)
+        self.queue.RECIPIENTS_PER_MESSAGE = 2
+        self.queue.RETRY_DELAY = 0
+        self.puzzle = Puzzle.objects.create(
+            name="Erratic", slug="erratic", answer="ERR", order=0,
+            round=Round.objects.create(name="Round", slug="round", order=0))
+        self.context = {'puzzle': self.puzzle, 'text': 'Oops', 'hunt_title': 'Hunt'}
+
+    def test_recipients_are_split_into_bcc_batches(self):
+        recipients = ['%s@example.com' % c for c in 'abcde']
+        self.queue.put('Erratum', 'erratum_email', self.context, recipients, bcc=True)
+        self.assertEqual([m.bcc for m in mail.outbox], [recipients[:2], recipients[2:4], recipients[4:]])
+        self.assertTrue(all(m.to == [] for m in mail.outbox))
+        self.assertIn('Oops', mail.outbox[0].body)
+
+    def test_failed_sends_are_retried(self):
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                side_effect=[ConnectionError(), 1]) as send:
+            self.queue.put('Erratum', 'erratum_email', self.context, ['a@example.com'])
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(self.queue.failures, 0)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                side_effect=ConnectionError()) as send:
+            self.queue.put('Erratum', 'erratum_email', self.context, ['a@example.com'])
+        self.assertEqual(send.call_count, self.queue.MAX_ATTEMPTS)
+        self.assertEqual(self.queue.failures, 1)
+
+    def test_erratum_command_reports_failures(self):
+        team = Team.objects.create(user=create_user("erratic"), team_name="Erratic")
+        TeamMember.objects.create(team=team, name="A", email="a@example.com")
+        PuzzleUnlock.objects.create(team=team, puzzle=self.puzzle, unlock_datetime=timezone.now())
+        with mock.patch.object(messaging, 'mail_queue', self.queue), \
+                mock.patch.object(erratum_emails, 'mail_queue', self.queue), \
+                override_settings(IS_TEST=False):
+            call_command('erratum_emails', 'erratic', send='Oops', stdout=io.StringIO())
+            self.assertEqual(len(mail.outbox), 1)
+            with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                    side_effect=ConnectionError()):
+                with self.assertRaisesMessage(CommandError, 'Could not send 1 of the erratum messages'):
+                    call_command('erratum_emails', 'erratic', send='Oops', stdout=io.StringIO())
+
+
+class R2q8Rules(TestCase):
+    def tearDown(self):
+        r2q8.compiled_rules.cache_clear()
+
+    def test_rules(self):
+        self.assertTrue(r2q8.contains_five_letter_word('ICELAND'))
+        self.assertFalse(r2q8.contains_five_letter_word('RAVEN'))
+        self.assertTrue(r2q8.is_country_name('VIETNAM'))
+        self.assertEqual(r2q8.triggered_rules('ICELAND'),
+            [3, 6, 8, 13, 14, 16, 17, 18, 21, 22, 23, 24, 25, 26])
+
+    def test_packed_tables(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'words.txt')
+            with open(source, 'w') as fp:
+                fp.write('PEAR\nAPPLE\nÉCLAIR')
+            load = lambda: packed.load(source, [source], lambda: packed.read_lines(source))
+            # Until the table is built, it's parsed in memory.
+            with self.assertLogs(packed.logger, 'WARNING'):
+                words = packed.PackedWords(load())
+            self.assertEqual(list(words), ['APPLE', 'PEAR', 'ÉCLAIR'])
+            self.assertFalse(os.path.exists(source + '.packed'))
+            self.assertEqual(packed.build(source, [source], lambda: packed.read_lines(source)), source + '.packed')
+            with self.assertNoLogs(packed.logger, 'WARNING'):
+                words = packed.PackedWords(load())
+            self.assertIsInstance(words.table.data, mmap.mmap)
+            self.assertEqual(list(words), ['APPLE', 'PEAR', 'ÉCLAIR'])
+            self.assertIn('ÉCLAIR', words)
+            self.assertNotIn('PEA', words)
+            self.assertEqual(words.find('PEAR'), 1)
+
+            # A packed table older than its source isn't used.
+            with open(source, 'w') as fp:
+                fp.write('FIG')
+            os.utime(source, (time.time() + 10, time.time() + 10))
+            with self.assertLogs(packed.logger, 'WARNING'):
+                self.assertEqual(list(packed.PackedWords(load())), ['FIG'])
+
+            packed.pack(source + '.packed', [('B', 'bee'), ('A', 'ay')], 2)
+            pronunciations = packed.PackedDict(packed.PackedTable.open(source + '.packed'))
+            self.assertEqual(pronunciations['A'], 'ay')
+            self.assertEqual(pronunciations.get('C'), None)
+            self.assertEqual(list(pronunciations.keys()), ['A', 'B'])
+
+    def test_masks_match_rules(self):
+        words = ['ICELAND', 'PLATINUM', 'BADGER', 'CLIMBED', 'TOYED']
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'masks.bin')
+            with mock.patch.object(r2q8, 'MASKS_PATH', path):
+                r2q8.compiled_rules.cache_clear()
+                with self.assertLogs(r2q8.logger, 'WARNING'):
+                    self.assertIsNone(r2q8.compiled_rules())
+                uncompiled = [r2q8.rule_mask(word) for word in words]
+                with mock.patch.object(r2q8, 'dictionary_words', lambda: sorted(words)):
+                    r2q8.build_masks(path)
+                    r2q8.compiled_rules.cache_clear()
+                    self.assertIsNotNone(r2q8.compiled_rules())
+                    self.assertEqual([r2q8.rule_mask(word) for word in words], uncompiled)
+                    for (idx, _name, checker) in r2q8.RULES_LIST:
+                        if idx not in r2q8.SAMPLE_LISTS:
+                            sample = r2q8.get_sample_word(idx)
+                            self.assertTrue(sample in words and checker(sample) or
+                                not any(map(checker, words)), (idx, sample))
+                    # So are masks built before a rule or its data changed.
+                    with mock.patch.object(r2q8, 'RULES_VERSION', r2q8.RULES_VERSION + 1):
+                        r2q8.compiled_rules.cache_clear()
+                        with self.assertLogs(r2q8.logger, 'WARNING'):
+                            self.assertIsNone(r2q8.compiled_rules())
+                    animals = os.path.join(tmp, 'animals.txt')
+                    with open(animals, 'w') as fp:
+                        fp.write('BADGER')
+                    with mock.patch.object(r2q8, 'RULES_DATA', r2q8.RULES_DATA[:1] + [animals] + r2q8.RULES_DATA[2:]):
+                        r2q8.compiled_rules.cache_clear()
+                        with self.assertLogs(r2q8.logger, 'WARNING'):
+                            self.assertIsNone(r2q8.compiled_rules())
+                # Masks built for a different dictionary are ignored.
+                r2q8.compiled_rules.cache_clear()
+                with self.assertLogs(r2q8.logger, 'WARNING'):
+                    self.assertIsNone(r2q8.compiled_rules())
+
+
+class Warmup(TestCase):
+    def test_warm_up_loads_catalog(self):
+        with mock.patch.object(warmup, 'WARM_UPS', (warmup.warm_catalog,)), \
+                mock.patch.object(warmup.connections, 'close_all') as close_all:
+            self.assertEqual(list(warmup.warm_up()), ['warm_catalog'])
+        close_all.assert_called_once()
+        with self.assertNumQueries(0):
+            catalog.get_catalog()
+
+
+class GameState(TestCase):
+    def setUp(self):
+        self.user = create_user("gamer")
+        self.team = Team.objects.create(user=self.user, team_name="Gamers")
+
+    def test_seeded_from_team(self):
+        self.assertEqual(PuzzleGameState.get_data(self.team, 'r2q8')['bingo_coin_num'], 10)
+        self.assertFalse(PuzzleGameState.objects.exists())
+        # Old states are copied and upgraded the first time they're read.
+        self.team.puzzle_genshin_game_data = {'history': [{'A': '高斯钟'}]}
+        self.team.save()
+        self.assertEqual(PuzzleGameState.get_data(self.team, 'r3q3'), {'draws': 1})
+        self.assertEqual(GachaDraw.objects.get().text, 'A')
+        state = PuzzleGameState.objects.get()
+        self.assertEqual((state.version, state.schema_version), (1, 1))
+        self.team.refresh_from_db()
+        self.assertEqual(self.team.puzzle_genshin_game_data, {'history': [{'A': '高斯钟'}]})
+
+    def test_upgraded_once(self):
+        PuzzleGameState.objects.create(team=self.team, puzzle='r2q8', data={
+            'bingo_coin_num': 10, 'known_rules': [3], 'bingo_spoiled': True, 'word_history': []})
+        client = Client()
+        client.force_login(self.user)
+        submit = lambda: json.loads(client.post(
+            urls.reverse('r2q8'), json.dumps({'mode': 'guess_a_word', 'word': 'ZZZ'}),
+            content_type='application/json').content)
+        self.assertEqual(submit()['bingo_spoiled'], r2q8.SPOIL_TEXT)
+        state = PuzzleGameState.objects.get()
+        self.assertEqual((state.version, state.schema_version), (1, 1))
+        self.assertEqual(sorted(state.data['known_rules']), ['25', '26', '3'])
+        # Nothing changes after that, so nothing is written.
+        with mock.patch.object(PuzzleGameState, 'save_data') as save_data:
+            submit()
+        save_data.assert_not_called()
+
+    def test_upgrade_command(self):
+        other = Team.objects.create(user=create_user("other"), team_name="Others")
+        self.team.puzzle_genshin_game_data = {'history': [{'A': '高斯钟'}, {'B': '多频段'}]}
+        self.team.save()
+        PuzzleGameState.objects.create(team=other, puzzle='r3q3', data={'history': [{'C': '观测窗'}]})
+        out = io.StringIO()
+        call_command('upgrade_game_state', 'r3q3', stdout=out)
+        self.assertIn('Upgraded 2 r3q3 states', out.getvalue())
+        self.assertEqual(PuzzleGameState.get_data(self.team, 'r3q3'), {'draws': 2})
+        self.assertEqual(PuzzleGameState.get_data(other, 'r3q3'), {'draws': 1})
+        self.assertEqual(GachaDraw.objects.count(), 3)
+        call_command('upgrade_game_state', stdout=out)
+        self.assertEqual(GachaDraw.objects.count(), 3)
+
+    def test_only_changes_are_saved(self):
+        with PuzzleGameState.locked(self.team, 'r2q8') as state:
+            pass
+        with PuzzleGameState.locked(self.team, 'r2q8') as state:
+            state.data['bingo_coin_num'] = 10
+        self.assertEqual(PuzzleGameState.objects.get().version, 0)
+        with self.assertRaises(ValueError):
+            with PuzzleGameState.locked(self.team, 'r2q8') as state:
+                state.data['bingo_coin_num'] = 20
+                raise ValueError
+        with PuzzleGameState.locked(self.team, 'r2q8') as state:
+            state.data['bingo_coin_num'] = 30
+        state = PuzzleGameState.objects.get()
+        self.assertEqual((state.version, state.data['bingo_coin_num']), (1, 30))
+
+    def test_concurrent_save_conflicts(self):
+        with self.assertRaises(PuzzleGameState.Conflict):
+            with PuzzleGameState.locked(self.team, 'r2q8') as state:
+                # Only possible without row locks, e.g. on SQLite.
+                PuzzleGameState.objects.update(version=5)
+                state.data['bingo_coin_num'] = 20
+        self.assertEqual(PuzzleGameState.get_data(self.team, 'r2q8')['bingo_coin_num'], 10)
+
+    def test_handler_updates_state(self):
+        client = Client()
+        client.force_login(self.user)
+        response = client.post(
+            urls.reverse('r3q3'), json.dumps({'num': 10}), content_type='application/json')
+        self.assertEqual(len(json.loads(response.content)['new_items_text']), 10)
+        self.assertEqual(PuzzleGameState.get_data(self.team, 'r3q3'), {'draws': 10})
+
+    def test_gacha_history(self):
+        # Draws from before GachaDraw are moved over on the first draw.
+        self.team.puzzle_genshin_game_data = {'history': [{'A': '高斯钟'}, {5: '概率数'}]}
+        self.team.save()
+        client = Client()
+        client.force_login(self.user)
+        with mock.patch('puzzles.puzzlehandlers.r3q3.HISTORY_PAGE_SIZE', 3):
+            for _ in range(2):
+                client.post(urls.reverse('r3q3'), json.dumps({'num': 1}), content_type='application/json')
+            self.assertEqual(
+                list(GachaDraw.objects.order_by('number').values_list('number', 'text')[:2]),
+                [(1, 'A'), (2, '5')])
+            page = client.get(urls.reverse('r3q3-history')).json()
+            self.assertEqual(len(page['items']), 3)
+            self.assertEqual(page['before'], 2)
+            page = client.get(urls.reverse('r3q3-history'), {'before': page['before']}).json()
+            self.assertEqual(page, {'items': [{'A': '高斯钟'}], 'before': None})
+
+
+class Throttle(TestCase):
+    def setUp(self):
+        throttle.buckets().clear()
+        self.user = create_user("hammer")
+        self.team = Team.objects.create(user=self.user, team_name="Hammers")
+
+    def test_bucket(self):
+        request = mock.Mock(context=mock.Mock(team=self.team))
+        bucket = throttle.TokenBucket('test', '2/m', burst=3)
+        with mock.patch('puzzles.throttle.time.time', return_value=1000):
+            self.assertEqual([bucket.take(request) for _ in range(4)], [True, True, True, False])
+            self.assertEqual(request.ratelimit_remaining, 0)
+            bucket.refund(request)
+            self.assertTrue(bucket.take(request))
+            # Other puzzles have their own buckets.
+            self.assertTrue(bucket.take(request, 'other'))
+        with mock.patch('puzzles.throttle.time.time', return_value=1030):
+            self.assertTrue(bucket.take(request))
+            self.assertFalse(bucket.take(request))
+        with mock.patch('puzzles.throttle.time.time', return_value=10000):
+            bucket.take(request)
+            self.assertEqual(request.ratelimit_remaining, 2)
+
+    def test_handler(self):
+        client = Client()
+        client.force_login(self.user)
+        post = lambda: client.post(
+            urls.reverse('r2q8'), json.dumps({'mode': 'guess_a_word', 'word': 'ZZZ'}),
+            content_type='application/json')
+        self.assertEqual(post()['X-RateLimit-Remaining'], '59')
+        with mock.patch('puzzles.throttle.time.time', return_value=time.time()):
+            for _ in range(59):
+                post()
+            response = post()
+        self.assertEqual(response['X-RateLimit-Remaining'], '0')
+        self.assertIn('每分钟60次', json.loads(response.content)['error'])
+
+    @mock.patch('puzzles.context.HUNT_CLOSE_TIME', timezone.now() + timedelta(days=1))
+    @mock.patch('puzzles.context.HUNT_END_TIME', timezone.now() + timedelta(days=1))
+    @mock.patch('puzzles.views.HUNT_END_TIME', timezone.now() + timedelta(days=1))
+    def test_repeated_guesses_are_free(self):
+        puzzle = Puzzle.objects.create(
+            name="Hammered", slug="hammered", answer="NAIL", unlock_global=0,
+            round=Round.objects.create(name="Round", slug="round"))
+        PuzzleUnlock.objects.create(team=self.team, puzzle=puzzle, unlock_datetime=timezone.now())
+        client = Client()
+        client.force_login(self.user)
+        solve = lambda answer: client.post(urls.reverse('solve', args=('hammered',)), {'answer': answer})
+        self.assertEqual(solve('SCREW')['X-RateLimit-Remaining'], '9')
+        with mock.patch('puzzles.throttle.time.time', return_value=time.time()):
+            for _ in range(20):
+                self.assertNotIn('X-RateLimit-Remaining', solve('SCREW'))
+            self.assertEqual(solve('BOLT')['X-RateLimit-Remaining'], '8')
+        self.assertEqual(AnswerSubmission.objects.count(), 2)
+
+    def test_history_is_limited(self):
+        client = Client()
+        client.force_login(self.user)
+        get = lambda: client.get(urls.reverse('r3q3-history'))
+        response = get()
+        self.assertEqual(response['X-RateLimit-Remaining'], '59')
+        self.assertEqual(response.json(), {'items': [], 'before': None})
+        with mock.patch('puzzles.throttle.time.time', return_value=time.time()):
+            for _ in range(59):
+                get()
+            response = get()
+        self.assertIn('error', json.loads(response.content))
+        self.assertEqual(client.post(urls.reverse('r3q3-history')).status_code, 405)
+
+
+class Logging(TestCase):
+    def record(self, msg, **kwargs):
+        record = logging.LogRecord('puzzles', logging.INFO, __file__, 1, msg, None, None)
+        record.__dict__.update(kwargs)
+        return record
+
+    def test_queued_rotating_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.log')
+            handler = logutils.QueuedRotatingFileHandler(path, maxBytes=100, backupCount=2)
+            for i in range(10):
+                handler.handle(self.record('line {:02}'.format(i)))
+            handler.flush()
+            with open(path) as fp:
+                self.assertEqual(fp.read().split('\n')[-2], 'line 09')
+            for line in ('x' * 100, 'y' * 100):
+                handler.handle(self.record(line))
+            handler.close()
+            self.assertEqual(sorted(os.listdir(tmp)), ['test.log', 'test.log.1', 'test.log.2', 'test.log.lock'])
+            with open(path) as fp:
+                self.assertEqual(fp.read(), 'y' * 100 + '\n')
+
+    def test_rotation_by_several_processes(self):
+        # Each worker has its own handler on the same file.
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.log')
+            handlers = [logutils.BufferedRotatingFileHandler(path, maxBytes=100, backupCount=3) for _ in range(2)]
+            for (handler, line) in zip(handlers, ('a' * 60, 'b' * 30)):
+                handler.emit(self.record(line))
+                handler.flush_buffer()
+            # Both found the file full before either rotated it.
+            for handler in handlers:
+                handler.doRollover()
+            for handler in handlers:
+                handler.emit(self.record('c'))
+                handler.close()
+            self.assertEqual(sorted(os.listdir(tmp)), ['test.log', 'test.log.1', 'test.log.lock'])
+            with open(path + '.1') as fp:
+                self.assertEqual(fp.read(), 'a' * 60 + '\n' + 'b' * 30 + '\n')
+            with open(path) as fp:
+                self.assertEqual(fp.read(), 'c\nc\n')
+
+    def test_filters(self):
+        sample = logutils.SampleFilter()
+        self.assertTrue(sample.filter(self.record('kept')))
+        self.assertFalse(sample.filter(self.record('dropped', sample=0)))
+        self.assertTrue(sample.filter(self.record('error', sample=0, levelno=logging.ERROR)))
+        limit = logutils.RateLimitFilter(per_second=1, burst=2)
+        with mock.patch('gph.logutils.time.monotonic', return_value=100):
+            self.assertEqual([limit.filter(self.record('hot')) for _ in range(5)], [True, True, False, False, False])
+            # Errors from the same line aren't limited.
+            self.assertTrue(limit.filter(self.record('hot', levelno=logging.ERROR)))
+        with mock.patch('gph.logutils.time.monotonic', return_value=101):
+            record = self.record('hot')
+            self.assertTrue(limit.filter(record))
+        self.assertEqual(record.getMessage(), 'hot')
+        self.assertEqual(logutils.DroppedCountFormatter('%(message)s').format(record), 'hot (3 similar records dropped)')
+        self.assertEqual(logging.Formatter('%(message)s').format(record), 'hot')
+
+
+class PuzzleLog(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'puzzle.sqlite3')
+        handler = puzzlelog.QueuedPuzzleLogHandler(self.path)
+        for i in range(5):
+            for team in ('Alpha', 'Beta'):
+                handler.handle(logging.makeLogRecord({
+                    'puzzle': 'r2q8', 'team': team, 'content': 'guess {}%'.format(i)}))
+        handler.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_query(self):
+        entries = puzzlelog.query(self.path, team='Alpha', limit=2)
+        self.assertEqual([entry['content'] for entry in entries], ['guess 4%', 'guess 3%'])
+        entries = puzzlelog.query(self.path, team='Alpha', limit=2, before=entries[-1]['id'])
+        self.assertEqual([entry['content'] for entry in entries], ['guess 2%', 'guess 1%'])
+        entries = puzzlelog.query(self.path, team='Beta', after=entries[-1]['id'], limit=2)
+        self.assertEqual([entry['content'] for entry in entries], ['guess 2%', 'guess 1%'])
+        self.assertEqual(len(puzzlelog.query(self.path, search='3%')), 2)
+        self.assertEqual(puzzlelog.query(self.path, search='_'), [])
+
+    def test_schema_is_created_once(self):
+        with mock.patch.object(puzzlelog, 'SCHEMA', 'NOT SQL'):
+            self.assertEqual(len(puzzlelog.query(self.path)), 10)
+        self.assertEqual(puzzlelog.query(self.path, puzzle='r3q3'), [])
+
+    def test_view(self):
+        admin = User.objects.create_superuser("admin", "admin@example.com", "adminsecret")
+        client = Client()
+        client.force_login(admin)
+        with override_settings(LOGGING={'handlers': {'puzzle-store': {'filename': self.path}}}):
+            response = client.get(urls.reverse('puzzle-log'), {'team': 'Beta', 'search': 'guess'})
+            self.assertEqual(len(response.context['entries']), 5)
+            self.assertContains(response, 'guess 4%')
+            response = client.get(urls.reverse('puzzle-log'), {'after': '8', 'format': 'json'})
+            self.assertEqual([entry['team'] for entry in response.json()['entries']], ['Beta', 'Alpha'])
+
+
+class Exports(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "adminsecret")
+        self.team = Team.objects.create(user=create_user("exporter"), team_name="Exporters")
+        hidden = Team.objects.create(user=create_user("hidden"), team_name="Hidden", is_hidden=True)
+        round = Round.objects.create(name="Round", slug="round")
+        self.puzzle = Puzzle.objects.create(
+            name="Export", slug="export", answer="EXPORT", round=round, unlock_global=0)
+        for (team, answer) in ((self.team, "WRONG"), (hidden, "HIDDEN"), (self.team, "EXPORT")):
+            AnswerSubmission.objects.create(
+                team=team, puzzle=self.puzzle, submitted_answer=answer,
+                is_correct=answer == "EXPORT", used_free_answer=False)
+        PuzzleUnlock.objects.create(team=self.team, puzzle=self.puzzle, unlock_datetime=timezone.now())
+        self.client = Client()
+        self.client.force_login(self.admin)
+
+    def get_csv(self, name, **params):
+        response = self.client.get(urls.reverse(name), params)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        if params.get('gzip'):
+            content = gzip.decompress(content)
+        return (response['X-Export-Cursor'], list(csv.reader(io.StringIO(content.decode()))))
+
+    def test_guesses(self):
+        (cursor, rows) = self.get_csv('guess-csv')
+        self.assertEqual([row[1:] for row in rows], [
+            ['Exporters', 'Export', 'WRONG', 'N'],
+            ['Exporters', 'Export', 'EXPORT', 'Y'],
+        ])
+        self.assertEqual(self.get_csv('guess-csv', gzip=1), (cursor, rows))
+        self.assertEqual(self.get_csv('guess-csv', since=cursor), (cursor, []))
+        AnswerSubmission.objects.create(
+            team=self.team, puzzle=self.puzzle, submitted_answer="AGAIN",
+            is_correct=False, used_free_answer=False)
+        (next_cursor, rows) = self.get_csv('guess-csv', since=cursor)
+        self.assertEqual([row[3] for row in rows], ['AGAIN'])
+        self.assertGreater(int(next_cursor), int(cursor))
+
+    def test_unlocks(self):
+        (_cursor, rows) = self.get_csv('unlock-csv')
+        self.assertEqual([row[1:] for row in rows], [['', 'Exporters', 'Export']])
+        (_cursor, rows) = self.get_csv('survey-csv')
+        self.assertEqual(rows, [])
+
+    def test_asgi(self):
+        # Production serves gph.asgi, which sends the body from the event loop.
+        messages = []
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        async def send(message):
+            messages.append(message)
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': urls.reverse('guess-csv'), 'query_string': b'gzip=1',
+            'headers': [(b'cookie', '{}={}'.format(
+                settings.SESSION_COOKIE_NAME, self.client.cookies[settings.SESSION_COOKIE_NAME].value).encode())],
+        }
+        async_to_sync(ASGIHandler())(scope, receive, send)
+        self.assertEqual(messages[0]['status'], 200)
+        content = gzip.decompress(b''.join(message.get('body', b'') for message in messages[1:]))
+        self.assertEqual([row[3] for row in csv.reader(io.StringIO(content.decode()))], ['WRONG', 'EXPORT'])
+
+
+class Metrics(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.client = Client()
+
+    def test_exposition(self):
+        Team.objects.create(user=create_user("measured"), team_name="Measured")
+        self.client.get(urls.reverse('teams'))
+        self.assertEqual(self.client.get(urls.reverse('metrics')).status_code, 404)
+        with override_settings(METRICS_TOKEN='sesame'):
+            response = self.client.get(urls.reverse('metrics'), HTTP_AUTHORIZATION='Bearer sesame')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('gph_request_duration_seconds_count{view="teams"} 1', text)
+        self.assertIn('gph_request_db_queries_bucket{view="teams",le="+Inf"} 1', text)
+        self.assertIn('# TYPE gph_request_db_seconds histogram', text)
+        self.assertRegex(text, r'gph_context_cache_total\{property="Context.team",result="miss"\} \d+')
+
+
+class ScaleHunt(TestCase):
+    def test_generate(self):
+        before = timezone.now()
+        team_ids = generate_scale_hunt.generate(teams=30, puzzles=20, guesses=2000, hours=24)
+        self.assertEqual(len(team_ids), 30)
+        self.assertEqual(AnswerSubmission.objects.count(), 2000)
+        self.assertEqual(LeaderboardEntry.objects.count(), 30)
+        start = before - timedelta(hours=24)
+        for guess in AnswerSubmission.objects.all():
+            unlock = PuzzleUnlock.objects.get(team_id=guess.team_id, puzzle_id=guess.puzzle_id)
+            self.assertLessEqual(start, unlock.unlock_datetime)
+            self.assertLessEqual(unlock.unlock_datetime, guess.submitted_datetime)
+            self.assertLessEqual(guess.submitted_datetime, timezone.now())
+        self.assertTrue(Hint.objects.exists())
+        for state in PuzzleGameState.objects.all():
+            self.assertEqual(state.schema_version, PuzzleGameState.game(state.puzzle).schema_version)
+        # Teams played by the hunt's own unlock rules, so reading their
+        # unlocks doesn't turn up anything new.
+        team = Team.objects.get(id=team_ids[0])
+        unlocks = PuzzleUnlock.objects.filter(team=team).count()
+        self.client.force_login(team.user)
+        self.client.get(urls.reverse('puzzles'))
+        self.assertEqual(PuzzleUnlock.objects.filter(team=team).count(), unlocks)
+        # auto_now is back to normal afterwards.
+        self.assertGreaterEqual(Hint.objects.create(team=team, puzzle=Puzzle.objects.first()).submitted_datetime, before)
+
+
+class LoadTest(TestCase):
+    def test_report(self):
+        stats = loadtest.Stats()
+        for i in range(1, 101):
+            stats.record('puzzle', 200 if i % 10 else 500, i / 1000)
+        stats.record('solve', 'ClientOSError', 2.0)
+        report = stats.report(duration=10)
+        self.assertEqual(report['puzzle']['requests'], 100)
+        self.assertEqual(report['puzzle']['per_second'], 10)
+        self.assertEqual(report['puzzle']['statuses'], {200: 90, 500: 10})
+        self.assertEqual((report['puzzle']['p50'], report['puzzle']['p95'], report['puzzle']['p99']), (0.05, 0.095, 0.099))
+        self.assertEqual(report['solve']['p99'], 2.0)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+
+class Benchmark(TestCase):
+    def test_benchmarks_run(self):
+        generate_scale_hunt.generate(teams=10, puzzles=20, guesses=200)
+        team = Team.objects.order_by('id').first()
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'adminsecret')
+        for (name, setup) in benchmark.BENCHMARKS.items():
+            # Without the r2q8 masks, this one searches the whole dictionary.
+            if name != 'get_sample_word':
+                with self.subTest(name):
+                    setup(team, admin)()
+        self.assertIn('<table>', benchmark.BENCHMARKS['puzzleblock'](team, admin)())
+
+    def test_measure(self):
+        calls = []
+        (best, median) = benchmark.measure(lambda: calls.append(1), repeat=3)
+        self.assertLessEqual(best, median)
+        self.assertGreater(len(calls), 3)
+
+
+@tag('performance')
+class QueryBudget(TestCase):
+    '''
+    Each view must stay within a number of queries that doesn't grow with the
+    number of teams or puzzles, and a generous time limit. Skip these with
+    --exclude-tag performance when iterating on something else.
+    '''
+    TIME_BUDGET = 2.0
+
+    @classmethod
+    def setUpTestData(cls):
+        generate_scale_hunt.generate(teams=500, puzzles=80, guesses=50000)
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'adminsecret')
+        cls.team = Team.objects.filter(is_hidden=False).order_by('id').first()
+
+    def setUp(self):
+        cache.clear()
+        throttle.buckets().clear()
+
+    def check(self, client, budgets):
+        for (name, args, max_queries, *seconds) in budgets:
+            with self.subTest(view=name):
+                url = urls.reverse(name, args=args)
+                # The first visit fills caches and recalculates unlocks.
+                self.assertEqual(client.get(url).status_code, 200)
+                start = time.time()
+                with CaptureQueriesContext(connection) as queries:
+                    response = client.get(url)
+                elapsed = time.time() - start
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(queries), max_queries, '\n'.join(q['sql'] for q in queries))
+                self.assertLess(elapsed, seconds[0] if seconds else self.TIME_BUDGET)
+
+    def test_anonymous(self):
+        self.check(Client(), [
+            ('index', (), 2),
+            ('puzzles', (), 2),
+            ('puzzle', ('puzzle-0',), 2),
+            ('teams', (), 3),
+            ('team', (self.team.team_name,), 6),
+        ])
+
+    @mock.patch('puzzles.context.HUNT_CLOSE_TIME', timezone.now() + timedelta(days=1))
+    def test_team(self):
+        client = Client()
+        client.force_login(self.team.user)
+        self.check(client, [
+            ('index', (), 5),
+            ('puzzles', (), 5),
+            ('puzzle', ('puzzle-0',), 5),
+            ('solve', ('puzzle-0',), 6),
+            ('hints', ('puzzle-0',), 6),
+            ('teams', (), 6),
+            ('team', (self.team.team_name,), 9),
+        ])
+
+    def test_superuser(self):
+        client = Client()
+        client.force_login(self.admin)
+        self.check(client, [
+            ('puzzles', (), 6),
+            ('puzzle', ('puzzle-0',), 6),
+            ('teams', (), 6),
+            ('teams-unhidden', (), 6),
+            ('team', (self.team.team_name,), 9),
+            # These two render a cell for every team and puzzle, or every
+            # open hint, so they get more time.
+            ('bigboard', (), 5, 10.0),
+            ('hint-list', (), 8, 4.0),
+            ('stats', ('puzzle-0',), 10),
+            ('hunt-stats', (), 8),
+        ])
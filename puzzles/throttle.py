@@ -0,0 +1,143 @@
+# Token-bucket rate limits for endpoints teams can hit a lot, like interactive
+# puzzle handlers and answer submission. Each bucket holds up to `burst`
+# tokens and refills at `rate`; a request takes a token, and is refused if
+# there isn't one. Taking a token is a single atomic step: a Lua script on the
+# Redis server behind the cache when there is one, or a dict behind a lock in
+# this process otherwise (which is fine for dev and tests, but not shared
+# between workers).
+import logging
+import math
+import threading
+import time
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'X-RateLimit-Remaining'
+
+# KEYS[1]: bucket key; ARGV: burst, tokens per second, tokens to take. A
+# negative number of tokens gives them back. Returns whether they were taken
+# and what's left, as a string so Redis doesn't round it to an integer.
+TAKE_SCRIPT = '''
+-- Needed before Redis 5 to write after reading the clock.
+if redis.replicate_commands then redis.replicate_commands() end
+local burst = tonumber(ARGV[1])
+local per_second = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = clock[1] + clock[2] / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * per_second)
+local taken = 0
+if tokens >= cost then
+    tokens = math.min(burst, tokens - cost)
+    taken = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / per_second) + 1)
+return {taken, tostring(tokens)}
+'''
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+def parse_rate(rate):
+    '''Turns a rate like '60/m' or '5/10s' into tokens per second.'''
+    (count, _, period) = rate.partition('/')
+    seconds = int(period[:-1] or 1) * PERIODS[period[-1]]
+    return int(count) / seconds
+
+
+class LocalBuckets:
+    'The fallback when the cache isn\'t Redis.'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, key, burst, per_second, cost):
+        with self.lock:
+            now = time.time()
+            (tokens, last) = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0, now - last) * per_second)
+            taken = tokens >= cost
+            if taken:
+                tokens = min(burst, tokens - cost)
+            self.buckets[key] = (tokens, now)
+            return (taken, tokens)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RedisBuckets:
+    def __init__(self, connection):
+        self.script = connection.register_script(TAKE_SCRIPT)
+
+    def take(self, key, burst, per_second, cost):
+        (taken, tokens) = self.script(keys=[key], args=[burst, per_second, cost])
+        return (bool(taken), float(tokens))
+
+    def clear(self):
+        pass
+
+
+_buckets = None
+
+def buckets():
+    global _buckets
+    if _buckets is None:
+        try:
+            from django_redis import get_redis_connection
+            _buckets = RedisBuckets(get_redis_connection('default'))
+        except (ImportError, NotImplementedError):
+            _buckets = LocalBuckets()
+    return _buckets
+
+
+class TokenBucket:
+    '''
+    A rate limit, kept separately for each team (or IP address, for people
+    not logged in) and optionally each scope, like a puzzle slug. burst is how
+    many requests can be made at once after being idle; it defaults to the
+    count in rate.
+    '''
+
+    def __init__(self, name, rate, burst=None):
+        self.name = name
+        self.per_second = parse_rate(rate)
+        self.burst = burst or int(rate.partition('/')[0])
+
+    def key(self, request, scope=None):
+        team = request.context.team
+        who = 'team:{}'.format(team.id) if team else 'ip:{}'.format(request.META.get('REMOTE_ADDR'))
+        return cache.make_key(':'.join(filter(None, ('throttle', self.name, scope, who))))
+
+    def take(self, request, scope=None, tokens=1):
+        '''
+        Takes tokens from the bucket if there are enough, and returns whether
+        it did. Either way, the whole tokens left are stored on the request
+        and reported in the response header by add_header.
+        '''
+        try:
+            (taken, left) = buckets().take(self.key(request, scope), self.burst, self.per_second, tokens)
+        except Exception:
+            # Better to let everyone through than nobody.
+            logger.exception('Rate limit %s failed', self.name)
+            return True
+        request.ratelimit_remaining = math.floor(left)
+        return taken
+
+    def refund(self, request, scope=None, tokens=1):
+        'Gives back tokens for a request that turned out not to count.'
+        self.take(request, scope, -tokens)
+
+
+def add_header(request, response):
+    remaining = getattr(request, 'ratelimit_remaining', None)
+    if remaining is not None:
+        response[HEADER] = str(remaining)
+    return response
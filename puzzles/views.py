@@ -1,5 +1,6 @@
 import csv
 import datetime
+import hmac
 import itertools
 import json
 import logging
@@ -7,7 +8,9 @@ logger = logging.getLogger(__name__)
 import os
 import re
 import requests
+import tempfile
 import traceback
+import zlib
 from collections import defaultdict, OrderedDict, Counter
 from functools import wraps
 from typing import List
@@ -19,12 +22,14 @@ from django.contrib.auth import login, update_session_auth_hash
 from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib.auth.models import User
 from django.contrib.auth.tokens import default_token_generator
-from django.db.models import F, Q, Avg, Count
+from django.core.paginator import Paginator
+from django.db.models import F, Q, Avg, Count, Max
 from django.forms import formset_factory, modelformset_factory
-from django.http import HttpResponse, Http404
+from django.http import FileResponse, HttpResponse, Http404, JsonResponse
 from django.shortcuts import redirect, render
 from django.template import TemplateDoesNotExist
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.encoding import force_bytes
 from django.utils.html import escape
 from django.utils.http import urlsafe_base64_encode
@@ -44,6 +49,7 @@ from puzzles.models import (
     PuzzleMessage,
     Survey,
     Hint,
+    LeaderboardEntry,
 )
 
 from puzzles.forms import (
@@ -67,11 +73,16 @@ from puzzles.hunt_config import (
     HUNT_END_TIME,
     HUNT_CLOSE_TIME,
     MAX_MEMBERS_PER_TEAM,
+    TEAMS_PER_PAGE,
     ONE_HINT_AT_A_TIME,
     INTRO_ROUND_SLUG,
     META_META_SLUG,
 )
 
+from puzzles import bigboard as bigboard_service
+from puzzles import stats as stats_service
+from puzzles import metrics as metrics_service
+from puzzles import puzzlelog, throttle
 from puzzles.messaging import send_mail_wrapper, show_victory_notification
 from puzzles.shortcuts import dispatch_shortcut
 
@@ -85,7 +96,7 @@ def validate_puzzle(require_team=False):
     def decorator(f):
         @wraps(f)
         def inner(request, slug):
-            puzzle = Puzzle.objects.select_related().filter(slug=slug).first()
+            puzzle = request.context.catalog.puzzles_by_slug.get(slug)
             request.context.puzzle = puzzle
             if not puzzle or puzzle not in request.context.unlocks:
                 messages.error(request, _('Invalid puzzle name.'))
@@ -313,6 +324,7 @@ def team(request, team_name):
         if not is_own_team: raise Http404
         user_team.allow_time_unlocks = request.POST.get('enable') == 'true'
         user_team.save()
+        Team.expire_unlocks([user_team.id])
         return redirect('team', team_name)
     can_view_info = is_own_team or request.context.is_superuser
     team_query = Team.objects.filter(team_name=team_name)
@@ -323,16 +335,8 @@ def team(request, team_name):
         messages.error(request, '没有队伍使用这个用户名：{}'.format(team_name))
         return redirect('teams')
 
-    # This Team.leaderboard_teams() call is expensive, but is
-    # the only way right now to calculate rank accurately.
-    # Hopefully it is not an issue in practice (especially
-    # after all this database optimization --beta)
-    leaderboard_ids = Team.leaderboard_teams(user_team)#.values_list('id', flat=True)
-    rank = None
-    for i, leaderboard_id in enumerate(leaderboard_ids):
-        if team.id == leaderboard_id:
-            rank = i + 1 # ranks are 1-indexed
-            break
+    entry = LeaderboardEntry.objects.filter(team=team).first()
+    rank = entry.rank() if entry else None
 
     guesses = defaultdict(int)
     correct = {}
@@ -391,8 +395,12 @@ def teams_generic(request, hide_hidden):
     team_name = request.GET.get('team')
     user_team = request.context.team
 
+    paginator = Paginator(Team.leaderboard_entries(user_team, hide_hidden=hide_hidden), TEAMS_PER_PAGE)
+    page = paginator.get_page(request.GET.get('page'))
+
     return render(request, 'teams.html', {
-        'teams': Team.leaderboard(user_team, hide_hidden=hide_hidden),
+        'teams': Team.leaderboard_teams(user_team, entries=page),
+        'page': page,
         'current_team': user_team,
     })
 
@@ -480,7 +488,7 @@ def puzzles(request):
 
 @require_GET
 def round(request, slug):
-    round = Round.objects.filter(slug=slug).first()
+    round = request.context.catalog.rounds_by_slug.get(slug)
     if round:
         rounds = render_puzzles(request)
         if slug in rounds:
@@ -503,20 +511,10 @@ def render_puzzles(request):
         solved = team.solves
         hints = Counter(hint.puzzle_id for hint in team.asked_hints)
 
-    correct = defaultdict(int)
-    guesses = defaultdict(int)
-    teams = defaultdict(set)
+    solve_stats = {}
     full_stats = request.context.is_superuser or request.context.hunt_is_over
     if full_stats or INITIAL_STATS_AVAILABLE:
-        for submission in AnswerSubmission.objects.filter(
-            used_free_answer=False,
-            team__is_hidden=False,
-            submitted_datetime__lt=HUNT_END_TIME,
-        ):
-            if submission.is_correct:
-                correct[submission.puzzle_id] += 1
-            guesses[submission.puzzle_id] += 1
-            teams[submission.puzzle_id].add(submission.team_id)
+        solve_stats = stats_service.puzzle_stats()
 
     fields = Survey.fields()
     survey_averages = dict() # puzzle.id -> [average rating for field in fields]
@@ -546,12 +544,8 @@ def render_puzzles(request):
         if puzzle.id in hints:
             data['hints'] = hints[puzzle.id]
         data['full_stats'] = full_stats
-        if puzzle.id in guesses:
-            data['solve_stats'] = {
-                'correct': correct[puzzle.id],
-                'guesses': guesses[puzzle.id],
-                'teams': len(teams[puzzle.id]),
-            }
+        if puzzle.id in solve_stats:
+            data['solve_stats'] = solve_stats[puzzle.id]
         if puzzle.id in survey_averages:
             data['survey_stats'] = [{
                 'average': average,
@@ -590,6 +584,15 @@ def puzzle(request):
         data['template_name'] = template_name
         return render(request, 'puzzle.html', data)
 
+# Guesses per team per puzzle, and hint requests per team. Only guesses that
+# are saved count, not repeats of earlier ones.
+SOLVE_THROTTLE = throttle.TokenBucket('solve', '10/m')
+HINTS_THROTTLE = throttle.TokenBucket('hints', '5/m')
+
+def solve_throttled(request, puzzle):
+    messages.error(request, '你提交答案的频率过高，请稍后再试。')
+    return throttle.add_header(request, redirect('solve', puzzle.slug))
+
 @validate_puzzle(require_team=True)
 @require_before_hunt_closed_or_admin
 def solve(request):
@@ -607,17 +610,13 @@ def solve(request):
         if request.context.guesses_remaining <= 0:
             messages.error(request, '你在本题的回答次数已用尽。若需要补充更多回答次数，请联系管理员。')
             return redirect('solve', puzzle.slug)
-        
         # Currently they are implemented in the same way:
         # `PuzzleMessage.semiclean_guess` and `Puzzle.normalize_answer`
         # This is why the trick can work: compare in `solve.html`
         # submitted_answer (normalized_answer) vs. semicleaned_guess (semiclean_guess)
         semicleaned_guess = PuzzleMessage.semiclean_guess(request.POST.get('answer'))
         normalized_answer = Puzzle.normalize_answer(request.POST.get('answer'))
-        puzzle_messages = [
-            message for message in puzzle.puzzlemessage_set.all()
-            if semicleaned_guess == message.semicleaned_guess
-        ]
+        puzzle_messages = request.context.catalog.puzzle_messages(puzzle, semicleaned_guess)
         tried_before = any(
             normalized_answer == submission.submitted_answer
             for submission in request.context.puzzle_submissions
@@ -628,6 +627,8 @@ def solve(request):
         if request.context.now > HUNT_END_TIME - team.start_offset:
             form.add_error(None, f'你只能在 {HUNT_END_TIME - team.start_offset} 前提交答案。请耐心等待本活动于 {HUNT_END_TIME} 结束。')
         if puzzle_messages and not tried_before:
+            if not SOLVE_THROTTLE.take(request, puzzle.slug):
+                return solve_throttled(request, puzzle)
             # Save milestones to show in `solve` page. Instead, players are not allow to re-enter the milestone triggers.
             AnswerSubmission(
                 team=team,
@@ -648,6 +649,8 @@ def solve(request):
         elif tried_before:
             form.add_error(None, '你已经在本题中尝试过回答 %s 了。' % normalized_answer)
         elif form.is_valid():
+            if not SOLVE_THROTTLE.take(request, puzzle.slug):
+                return solve_throttled(request, puzzle)
             AnswerSubmission(
                 team=team,
                 puzzle=puzzle,
@@ -659,7 +662,7 @@ def solve(request):
             if is_correct:
                 if not request.context.hunt_is_over:
                     team.last_solve_time = request.context.now
-                    team.save()
+                    team.save(update_fields=['last_solve_time'])
                 messages.success(request, '回答正确！答案： %s ' % puzzle.answer)
                 if puzzle.slug == META_META_SLUG:
                     # dispatch_victory_alert(
@@ -669,7 +672,7 @@ def solve(request):
                     return redirect('victory')
             else:
                 messages.error(request, '%s 并非正确答案。' % normalized_answer)
-            return redirect('solve', puzzle.slug)
+            return throttle.add_header(request, redirect('solve', puzzle.slug))
 
     elif request.method == 'POST':
         if puzzle.id not in team.solves or not SURVEYS_AVAILABLE:
@@ -690,7 +693,7 @@ def solve(request):
 
     if survey is None and SURVEYS_AVAILABLE:
         survey = SurveyForm()
-    return render(request, 'solve.html', {
+    return throttle.add_header(request, render(request, 'solve.html', {
         'form': form or SubmitAnswerForm(),
         'survey': survey,
         'survey_fields': Survey.fields(),
@@ -707,7 +710,7 @@ def solve(request):
             .filter(puzzle=puzzle, team=team)
             .order_by('-submitted_datetime')
         ],
-    })
+    }))
 
 @validate_puzzle(require_team=True)
 @require_before_hunt_closed_or_admin
@@ -746,10 +749,7 @@ def post_hunt_solve(request):
         semicleaned_guess = PuzzleMessage.semiclean_guess(answer)
         normalized_answer = Puzzle.normalize_answer(answer)
         is_correct = normalized_answer == puzzle.normalized_answer
-        puzzle_messages = [
-            message for message in puzzle.puzzlemessage_set.all()
-            if semicleaned_guess == message.semicleaned_guess
-        ]
+        puzzle_messages = request.context.catalog.puzzle_messages(puzzle, semicleaned_guess)
         form = SubmitAnswerForm(request.GET)
         if puzzle_messages:
             for message in puzzle_messages:
@@ -891,6 +891,9 @@ def hints(request):
         if error and not is_followup:
             messages.error(request, error)
             return redirect('hints', puzzle.slug)
+        if not HINTS_THROTTLE.take(request):
+            messages.error(request, '你请求提示的频率过高，请稍后再试。')
+            return throttle.add_header(request, redirect('hints', puzzle.slug))
         form = RequestHintForm(team, request.POST)
         if form.is_valid():
             if relevant_hints_remaining <= 0 and not is_followup:
@@ -907,7 +910,7 @@ def hints(request):
             messages.success(request, 
                 '我们已收到你的提示请求，将尽快予以回复。'
             )
-            return redirect('hints', puzzle.slug)
+            return throttle.add_header(request, redirect('hints', puzzle.slug))
     else:
         form = RequestHintForm(team)
 
@@ -1013,50 +1016,41 @@ def hunt_stats(request):
             solve_times[puzzle.id, team_id] <=
             solve_times[puzzle.round.meta_id, team_id] - datetime.timedelta(minutes=5))
 
-    total_hints = 0
-    hints_by_puzzle = defaultdict(int)
-    hint_counts = defaultdict(int)
-    for hint in Hint.objects.exclude(team__is_hidden=True):
-        total_hints += 1
-        hints_by_puzzle[hint.puzzle_id] += 1
-        if hint.consumes_hint:
-            hint_counts[hint.puzzle_id, hint.team_id] += 1
-
-    total_guesses = 0
-    total_solves = 0
+    (hints_by_puzzle, hint_counts) = stats_service.hint_counts()
+    total_hints = sum(hints_by_puzzle.values())
+
+    puzzle_stats = stats_service.puzzle_stats()
+    no_stats = {'correct': 0, 'guesses': 0, 'teams': 0, 'solve_teams': 0}
+    total_guesses = sum(row['guesses'] for row in puzzle_stats.values())
+    total_solves = sum(row['correct'] for row in puzzle_stats.values())
     total_metas = 0
-    guesses_by_puzzle = defaultdict(int)
-    solves_by_puzzle = defaultdict(int)
-    guess_teams = defaultdict(set)
+    # Only correct answers are needed individually, to tell forward solves
+    # from backsolves.
     solve_teams = defaultdict(set)
     solve_times = defaultdict(lambda: HUNT_CLOSE_TIME)
-    for submission in (
+    for (puzzle_id, team_id, submitted_datetime) in (
         AnswerSubmission.objects
-        .filter(used_free_answer=False, team__is_hidden=False, submitted_datetime__lt=HUNT_END_TIME)
+        .filter(used_free_answer=False, team__is_hidden=False, submitted_datetime__lt=HUNT_END_TIME, is_correct=True)
+        .values_list('puzzle_id', 'team_id', 'submitted_datetime')
     ):
-        total_guesses += 1
-        guesses_by_puzzle[submission.puzzle_id] += 1
-        guess_teams[submission.puzzle_id].add(submission.team_id)
-        if submission.is_correct:
-            total_solves += 1
-            solves_by_puzzle[submission.puzzle_id] += 1
-            solve_teams[submission.puzzle_id].add(submission.team_id)
-            solve_times[submission.puzzle_id, submission.team_id] = submission.submitted_datetime
+        solve_teams[puzzle_id].add(team_id)
+        solve_times[puzzle_id, team_id] = submitted_datetime
 
     data = []
     for puzzle in request.context.all_puzzles:
+        numbers = puzzle_stats.get(puzzle.id, no_stats)
         if puzzle.is_meta:
-            total_metas += solves_by_puzzle[puzzle.id]
+            total_metas += numbers['correct']
         data.append({'puzzle': puzzle, 'numbers': [
-            solves_by_puzzle[puzzle.id],
-            guesses_by_puzzle[puzzle.id],
-            hints_by_puzzle[puzzle.id],
+            numbers['correct'],
+            numbers['guesses'],
+            hints_by_puzzle.get(puzzle.id, 0),
             len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id)]),
-            len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts[puzzle.id, team_id] < 1]),
-            len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts[puzzle.id, team_id] == 1]),
-            len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts[puzzle.id, team_id] > 1]),
+            len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts.get((puzzle.id, team_id), 0) < 1]),
+            len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts.get((puzzle.id, team_id), 0) == 1]),
+            len([1 for team_id in solve_teams[puzzle.id] if is_forward_solve(puzzle, team_id) and hint_counts.get((puzzle.id, team_id), 0) > 1]),
             len([1 for team_id in solve_teams[puzzle.id] if not is_forward_solve(puzzle, team_id)]),
-            len(guess_teams[puzzle.id] - solve_teams[puzzle.id]),
+            numbers['teams'] - numbers['solve_teams'],
         ]})
 
     return render(request, 'hunt_stats.html', {
@@ -1083,26 +1077,29 @@ def stats(request):
     puzzle_submissions = (
         puzzle.answersubmission_set
         .filter(q, used_free_answer=False, submitted_datetime__lt=HUNT_END_TIME)
-        .order_by('submitted_datetime')
-        .select_related('team')
     )
 
     solve_time_map = {}
-    total_guesses_map = defaultdict(int)
+    total_guesses_map = dict(
+        puzzle_submissions.values_list('team_id').annotate(count=Count('*')).order_by())
     solvers_map = {}
     unlock_time_map = {
         unlock.team_id: unlock.unlock_datetime
         for unlock in puzzle.puzzleunlock_set.exclude(view_datetime=None).all()
     }
-    incorrect_guesses = Counter()
-    for submission in puzzle_submissions:
-        team_id = submission.team_id
-        total_guesses_map[team_id] += 1
-        if submission.is_correct:
-            solve_time_map[team_id] = submission.submitted_datetime
-            solvers_map[team_id] = submission.team
-        else:
-            incorrect_guesses[submission.submitted_answer] += 1
+    for submission in (
+        puzzle_submissions.filter(is_correct=True)
+        .order_by('submitted_datetime')
+        .select_related('team')
+    ):
+        solve_time_map[submission.team_id] = submission.submitted_datetime
+        solvers_map[submission.team_id] = submission.team
+    incorrect_guesses = (
+        puzzle_submissions.filter(is_correct=False)
+        .values_list('submitted_answer')
+        .annotate(count=Count('*'))
+        .order_by('-count', 'submitted_answer')
+    )
     solvers = [{
         'team': solver,
         'is_current': solver == team,
@@ -1119,7 +1116,7 @@ def stats(request):
         'solvers': solvers,
         'solves': len(solvers_map),
         'guesses': sum(total_guesses_map.values()),
-        'answers_tried': incorrect_guesses.most_common(),
+        'answers_tried': list(incorrect_guesses),
         'unlock_count': len(unlock_time_map),
         'hint_count': puzzle.hint_set.filter(q).count(),
     })
@@ -1239,152 +1236,43 @@ def bridge(request):
     })
 
 def bigboard_generic(request, hide_hidden):
-    puzzles = request.context.all_puzzles
-    puzzle_map = {}
-    puzzle_metas = {}
-    meta_meta_id = None
-    for puzzle in puzzles:
-        puzzle_map[puzzle.id] = puzzle
-        if puzzle.slug == META_META_SLUG:
-            meta_meta_id = puzzle.id
-        if not puzzle.is_meta:
-            puzzle_metas[puzzle.id] = puzzle.round.meta_id
-
-    wrong_guesses_map = defaultdict(int) # key (team, puzzle)
-    wrong_guesses_by_team_map = defaultdict(int) # key team
-    solve_position_map = dict() # key (team, puzzle); value n if team is nth to solve this puzzle
-    solve_count_map = defaultdict(int) # puzzle -> number of counts
-    total_guess_map = defaultdict(int) # puzzle -> number of guesses
-    used_hints_map = defaultdict(int) # (team, puzzle) -> number of hints
-    used_hints_by_team_map = defaultdict(int) # team -> number of hints
-    used_hints_by_puzzle_map = defaultdict(int) # puzzle -> number of hints
-    meta_solves_map = defaultdict(int) # team -> number of meta solves
-    solve_time_map = defaultdict(dict) # team -> {puzzle id -> solve time}
-    during_hunt_solve_time_map = defaultdict(dict) # team -> {puzzle id -> solve time}
-    free_answer_map = defaultdict(set) # team -> {puzzle id}
-    free_answer_by_puzzle_map = defaultdict(int) # puzzle -> number of free answers
-
-    correct_q = Q(is_correct=True)
-    incorrect_q = Q(is_correct=False)
-    if hide_hidden:
-        correct_q &= Q(team__is_hidden=False)
-        incorrect_q &= Q(team__is_hidden=False)
-
-    for team_id, puzzle_id, used_free_answer, submitted_datetime in (
-        AnswerSubmission.objects
-        .filter(correct_q)
-        .order_by('submitted_datetime')
-        .values_list('team_id', 'puzzle_id', 'used_free_answer', 'submitted_datetime')
-    ):
-        total_guess_map[puzzle_id] += 1
-        if used_free_answer:
-            free_answer_map[team_id].add(puzzle_id)
-            free_answer_by_puzzle_map[puzzle_id] += 1
-        else:
-            solve_count_map[puzzle_id] += 1
-            solve_position_map[(team_id, puzzle_id)] = solve_count_map[puzzle_id]
-            solve_time_map[team_id][puzzle_id] = submitted_datetime
-            if submitted_datetime < HUNT_END_TIME:
-                during_hunt_solve_time_map[team_id][puzzle_id] = submitted_datetime
-        if puzzle_id not in puzzle_metas:
-            meta_solves_map[team_id] += 1
-
-    for aggregate in (
-        AnswerSubmission.objects
-        .filter(incorrect_q)
-        .values('team_id', 'puzzle_id')
-        .annotate(count=Count('*'))
-    ):
-        team_id = aggregate['team_id']
-        puzzle_id = aggregate['puzzle_id']
-        total_guess_map[puzzle_id] += aggregate['count']
-        wrong_guesses_map[(team_id, puzzle_id)] += aggregate['count']
-        wrong_guesses_by_team_map[team_id] += aggregate['count']
-
-    for aggregate in (
-        Hint.objects
-        .filter(status=Hint.ANSWERED, is_followup=False)
-        .values('team_id', 'puzzle_id')
-        .annotate(count=Count('*'))
-    ):
-        team_id = aggregate['team_id']
-        puzzle_id = aggregate['puzzle_id']
-        used_hints_map[(team_id, puzzle_id)] += aggregate['count']
-        used_hints_by_team_map[team_id] += aggregate['count']
-        used_hints_by_puzzle_map[puzzle_id] += aggregate['count']
-
-    if hide_hidden:
-        teams = Team.objects.filter(is_hidden=False)
-    else:
-        teams = Team.objects.all()
+    snapshot = bigboard_service.get_snapshot(hide_hidden)
+    puzzles = [
+        request.context.catalog.puzzles_by_id[puzzle_id]
+        for puzzle_id in snapshot['puzzle_ids']
+    ]
 
-    # Reproduce Team.leaderboard behavior for ignoring solves after hunt end,
-    # but not _teams_ created after hunt end. They'll just all be at the bottom.
-    leaderboard = sorted(teams, key=lambda team: (
-        during_hunt_solve_time_map[team.id].get(meta_meta_id, HUNT_END_TIME),
-        -len(during_hunt_solve_time_map[team.id]),
-        team.last_solve_time or team.creation_time,
-    ))
+    board = snapshot['board']
     limit = request.META.get('QUERY_STRING', '')
     limit = int(limit) if limit.isdigit() else 0
     if limit:
-        leaderboard = leaderboard[:limit]
-    unlocks = set(PuzzleUnlock.objects.values_list('team_id', 'puzzle_id'))
-    unlock_count_map = defaultdict(int)
-
-    def classes_of(team_id, puzzle_id):
-        unlocked = (team_id, puzzle_id) in unlocks
-        if unlocked:
-            unlock_count_map[puzzle_id] += 1
-        solve_time = solve_time_map[team_id].get(puzzle_id)
-        if puzzle_id in free_answer_map[team_id]:
-            yield 'F' # free answer
-        elif solve_time:
-            yield 'S' # solved
-        elif wrong_guesses_map.get((team_id, puzzle_id)):
-            yield 'W' # wrong
-        elif unlocked:
-            yield 'U' # unlocked
-        if used_hints_map.get((team_id, puzzle_id)):
-            yield 'H' # hinted
-        if solve_time and solve_time > HUNT_END_TIME:
-            yield 'P' # post-hunt solve
-        if solve_time and puzzle_id in puzzle_metas:
-            meta_time = solve_time_map[team_id].get(puzzle_metas[puzzle_id])
-            if meta_time and solve_time > meta_time - datetime.timedelta(minutes=5):
-                yield 'B' # backsolved
-
-    board = []
-    for team in leaderboard:
-        board.append({
-            'team': team,
-            'last_solve_time': max([team.creation_time, *solve_time_map[team.id].values()]),
-            'total_solves': len(solve_time_map[team.id]),
-            'free_solves': len(free_answer_map[team.id]),
-            'wrong_guesses': wrong_guesses_by_team_map[team.id],
-            'used_hints': used_hints_by_team_map[team.id],
-            'finished': solve_position_map.get((team.id, meta_meta_id)),
-            'meta_solves': meta_solves_map[team.id],
-            'entries': [{
-                'wrong_guesses': wrong_guesses_map[(team.id, puzzle.id)],
-                'solve_position': solve_position_map.get((team.id, puzzle.id)),
-                'hints': used_hints_map[(team.id, puzzle.id)],
-                'cls': ' '.join(classes_of(team.id, puzzle.id)),
-            } for puzzle in puzzles]
-        })
+        board = board[:limit]
+    board = [{
+        **row,
+        'entries': [{
+            'puzzle_id': puzzle.id,
+            'solve_position': solve_position,
+            'wrong_guesses': wrong_guesses,
+            'hints': hints,
+            'cls': cls,
+        } for (puzzle, (solve_position, wrong_guesses, hints, cls)) in zip(puzzles, row['cells'])],
+    } for row in board]
 
     annotated_puzzles = [{
         'puzzle': puzzle,
-        'solves': solve_count_map[puzzle.id],
-        'free_solves': free_answer_by_puzzle_map[puzzle.id],
-        'total_guesses': total_guess_map[puzzle.id],
-        'total_unlocks': unlock_count_map[puzzle.id],
-        'hints': used_hints_by_puzzle_map[puzzle.id],
-    } for puzzle in puzzles]
+        'solves': solves,
+        'free_solves': free_solves,
+        'total_guesses': total_guesses,
+        'total_unlocks': total_unlocks,
+        'hints': hints,
+    } for (puzzle, (solves, free_solves, total_guesses, total_unlocks, hints))
+        in zip(puzzles, snapshot['puzzle_totals'])]
 
     return render(request, 'bigboard.html', {
         'board': board,
         'puzzles': annotated_puzzles,
+        'snapshot_time': snapshot['built'],
+        'hide_hidden': hide_hidden,
     })
 
 @require_GET
@@ -1452,55 +1340,163 @@ def biggraph(request):
         'teams': leaderboard
     })
 
+# Lets csv.writer produce a line at a time instead of writing to a file.
+class CsvLine:
+    def write(self, line):
+        return line
+
+CSV_CHUNK_SIZE = 64 * 1024
+# Exports bigger than this are written to disk before they're sent.
+CSV_SPOOL_SIZE = 8 * 1024 * 1024
+
+def join_chunks(lines):
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= CSV_CHUNK_SIZE:
+            yield ''.join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk).encode()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_csv(request, name, queryset, fields, row):
+    '''
+    Sends a CSV download with row(values) for the given fields of each object
+    in queryset, reading the database a chunk at a time so that even the
+    biggest exports don't fill up memory. Rows come in the order they were
+    created. The X-Export-Cursor header is the id of the last one; pass it
+    back as ?since= to get only rows created after it. With ?gzip=1, the
+    download is gzipped.
+
+    The file is written out here, spilling to disk if it gets big, rather than
+    streamed from the query: under ASGI, Django sends streaming responses from
+    the event loop, where the database can't be used.
+    '''
+    since = request.GET.get('since', '')
+    if since.isdigit():
+        queryset = queryset.filter(id__gt=int(since))
+    # Pin the end too, so the cursor matches what's sent.
+    cursor = queryset.aggregate(cursor=Max('id'))['cursor']
+    queryset = queryset.filter(id__lte=cursor or 0)
+    writer = csv.writer(CsvLine())
+    chunks = join_chunks(
+        writer.writerow(row(*values))
+        for values in queryset.order_by('id').values_list(*fields).iterator(chunk_size=2000))
+    filename = 'gph_{}_{}.csv'.format(name, request.context.now.strftime('%Y%m%dT%H%M%S'))
+    content_type = 'text/csv'
+    if request.GET.get('gzip'):
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        content_type = 'application/gzip'
+    export = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_SIZE)
+    for chunk in chunks:
+        export.write(chunk)
+    size = export.tell()
+    export.seek(0)
+    response = FileResponse(export, as_attachment=True, filename=filename, content_type=content_type)
+    response['Content-Length'] = size
+    response['X-Export-Cursor'] = str(cursor or since or 0)
+    return response
+
+def format_csv_time(time):
+    return None if time is None else time.strftime('%Y-%m-%d %H:%M:%S')
+
 @require_GET
 @require_after_hunt_end_or_admin
 def guess_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    fname = 'gph_guesslog_{}.csv'.format(request.context.now.strftime('%Y%m%dT%H%M%S'))
-    response['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
-    writer = csv.writer(response)
-    for ans in (
-        AnswerSubmission.objects
-        .annotate(team_name=F('team__team_name'), puzzle_name=F('puzzle__name'))
-        .order_by('submitted_datetime')
-        .exclude(team__is_hidden=True)
-    ):
-        writer.writerow([
-            ans.submitted_datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            ans.team_name,
-            ans.puzzle_name,
-            ans.submitted_answer,
-            'F' if ans.used_free_answer else ('Y' if ans.is_correct else 'N')])
-    return response
+    return export_csv(
+        request, 'guesslog',
+        AnswerSubmission.objects.exclude(team__is_hidden=True),
+        ('submitted_datetime', 'team__team_name', 'puzzle__name', 'submitted_answer', 'used_free_answer', 'is_correct'),
+        lambda submitted_datetime, team_name, puzzle_name, submitted_answer, used_free_answer, is_correct: [
+            format_csv_time(submitted_datetime),
+            team_name,
+            puzzle_name,
+            submitted_answer,
+            'F' if used_free_answer else ('Y' if is_correct else 'N')])
 
 @require_GET
 @require_admin
 def hint_csv(request):
-    response = HttpResponse(content_type='text/csv')
-    fname = 'gph_hintlog_{}.csv'.format(request.context.now.strftime('%Y%m%dT%H%M%S'))
-    response['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
-    writer = csv.writer(response)
-    for hint in (
-        Hint.objects
-        .annotate(team_name=F('team__team_name'), puzzle_name=F('puzzle__name'))
-        .order_by('submitted_datetime')
-        .exclude(team__is_hidden=True)
-    ):
-        writer.writerow([
-            hint.submitted_datetime.strftime('%Y-%m-%d %H:%M:%S'),
-            None if hint.answered_datetime is None else (
-                hint.answered_datetime.strftime('%Y-%m-%d %H:%M:%S')
-            ),
-            hint.team_name,
-            hint.puzzle_name,
-            hint.response])
-    return response
+    return export_csv(
+        request, 'hintlog',
+        Hint.objects.exclude(team__is_hidden=True),
+        ('submitted_datetime', 'answered_datetime', 'team__team_name', 'puzzle__name', 'response'),
+        lambda submitted_datetime, answered_datetime, team_name, puzzle_name, response: [
+            format_csv_time(submitted_datetime),
+            format_csv_time(answered_datetime),
+            team_name,
+            puzzle_name,
+            response])
+
+@require_GET
+@require_admin
+def unlock_csv(request):
+    return export_csv(
+        request, 'unlocklog',
+        PuzzleUnlock.objects.exclude(team__is_hidden=True),
+        ('unlock_datetime', 'view_datetime', 'team__team_name', 'puzzle__name'),
+        lambda unlock_datetime, view_datetime, team_name, puzzle_name: [
+            format_csv_time(unlock_datetime),
+            format_csv_time(view_datetime),
+            team_name,
+            puzzle_name])
+
+@require_GET
+@require_admin
+def survey_csv(request):
+    ratings = [field.name for field in Survey.fields()]
+    return export_csv(
+        request, 'surveylog',
+        Survey.objects.exclude(team__is_hidden=True),
+        ['submitted_datetime', 'team__team_name', 'puzzle__name', *ratings, 'comments'],
+        lambda submitted_datetime, team_name, puzzle_name, *rest: [
+            format_csv_time(submitted_datetime), team_name, puzzle_name, *rest])
 
 @require_GET
 @require_admin
 def puzzle_log(request):
-    return serve(request, os.path.join(settings.BASE_DIR,
-        settings.LOGGING['handlers']['puzzle']['filename']), document_root='/')
+    '''
+    Searches the puzzle log by puzzle, team and content, a page at a time.
+    With ?format=json, returns the entries as JSON, which the page uses to
+    follow new entries as they come in.
+    '''
+    path = settings.LOGGING['handlers']['puzzle-store']['filename']
+    filters = {key: request.GET.get(key, '').strip() for key in ('puzzle', 'team', 'search')}
+    cursors = {key: int(request.GET[key]) for key in ('before', 'after') if request.GET.get(key, '').isdigit()}
+    entries = puzzlelog.query(path, **filters, **cursors)
+    if request.GET.get('format') == 'json':
+        return JsonResponse({'entries': entries})
+    for entry in entries:
+        entry['time'] = timezone.localtime(
+            datetime.datetime.fromtimestamp(entry['time'], datetime.timezone.utc))
+    return render(request, 'puzzle_log.html', {
+        'entries': entries,
+        'filters': filters,
+        'newest': entries[0]['id'] if entries else 0,
+        'before': entries[-1]['id'] if len(entries) == puzzlelog.PAGE_SIZE else None,
+    })
+
+@require_GET
+def metrics(request):
+    '''Request metrics for Prometheus, for admins or with METRICS_TOKEN.'''
+    token = settings.METRICS_TOKEN
+    if not request.context.is_superuser and not (
+        token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+    ):
+        raise Http404
+    return HttpResponse(metrics_service.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @require_POST
 @require_admin
@@ -0,0 +1,60 @@
+# Loads everything that's expensive to load lazily, so that a process can do
+# it once before it starts handling requests. Under gunicorn with GPH_PRELOAD
+# set (see gph/gunicorn.py), the master process does this before forking, so
+# workers start ready to go and share one copy of the data.
+import logging
+import os
+import time
+
+from django.db import connections
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader import get_template
+
+logger = logging.getLogger(__name__)
+
+
+def warm_catalog():
+    from puzzles.catalog import get_catalog
+    get_catalog()
+
+
+def warm_puzzlehandlers():
+    from puzzles.puzzlehandlers import r2q8, r2q8_data, r3q3_data
+    for name in ('WORD_SET', 'ADJ_SET', 'ANIMAL_SET', 'IPA_DICT'):
+        getattr(r2q8_data, name)
+    r2q8.five_letter_words()
+    r2q8.compiled_rules()
+    r3q3_data.CHAR_SAMPLE_DICT
+
+
+def warm_templates():
+    # Only worth anything when the cached template loader is used, which it
+    # is by default unless DEBUG is on.
+    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
+    for (root, _dirs, files) in os.walk(template_dir):
+        for name in files:
+            if name.endswith(('.html', '.txt', '.svg')):
+                try:
+                    get_template(os.path.relpath(os.path.join(root, name), template_dir))
+                except (TemplateDoesNotExist, TemplateSyntaxError):
+                    pass
+
+
+WARM_UPS = (warm_catalog, warm_puzzlehandlers, warm_templates)
+
+
+def warm_up():
+    '''Returns a dict of how long each step took, in seconds.'''
+    timings = {}
+    for step in WARM_UPS:
+        start = time.time()
+        try:
+            step()
+        except Exception:
+            # Whatever didn't get loaded will just be loaded when needed.
+            logger.exception('Warming up with %s failed', step.__name__)
+        timings[step.__name__] = time.time() - start
+    # Connections mustn't be shared with forked processes.
+    connections.close_all()
+    logger.info('Warmed up in %.2fs', sum(timings.values()))
+    return timings